@@ -1,6 +1,19 @@
+import uuid
+
 from django.contrib import admin
 from django.contrib.auth.admin import UserAdmin
 from .models import User, OTP, Secret
+from .pagination import EstimatedCountPaginator
+
+class LargeTableAdmin(admin.ModelAdmin):
+    """Changelist settings for tables with millions of rows: users joined in
+    the page query, estimated counts on PostgreSQL and newest-first over an
+    index"""
+    list_select_related = ('user',)
+    paginator = EstimatedCountPaginator
+    # Skips the second, unfiltered COUNT(*) behind "N total"
+    show_full_result_count = False
+    ordering = ('-created_at',)
 
 @admin.register(User)
 class CustomUserAdmin(UserAdmin):
@@ -24,15 +37,31 @@ class CustomUserAdmin(UserAdmin):
     )
 
 @admin.register(OTP)
-class OTPAdmin(admin.ModelAdmin):
+class OTPAdmin(LargeTableAdmin):
     list_display = ('user', 'code', 'created_at', 'expires_at', 'is_used')
-    search_fields = ('user__email', 'code')
+    # Exact matches: the email is found through its unique index, not a scan
+    search_fields = ('user__email__exact', 'code__exact')
     list_filter = ('is_used', 'created_at')
     readonly_fields = ('created_at',)
 
 @admin.register(Secret)
-class SecretAdmin(admin.ModelAdmin):
+class SecretAdmin(LargeTableAdmin):
     list_display = ('id', 'user', 'created_at', 'expires_at', 'is_viewed', 'is_destroyed', 'has_passphrase')
-    search_fields = ('id', 'user__email')
+    search_fields = ('user__email__exact',)
+    search_help_text = 'A secret id or the exact email of its owner'
     list_filter = ('is_viewed', 'is_destroyed', 'has_passphrase', 'created_at')
     readonly_fields = ('id', 'created_at', 'encrypted_message', 'encryption_key')
+
+    def save_model(self, request, obj, form, change):
+        # New secrets go through insert() so their owner's summary counts them
+        if change:
+            super().save_model(request, obj, form, change)
+        else:
+            obj.insert()
+
+    def get_search_results(self, request, queryset, search_term):
+        # An id goes straight to the primary key instead of a text search
+        try:
+            return queryset.filter(pk=uuid.UUID(search_term.strip())), False
+        except ValueError:
+            return super().get_search_results(request, queryset, search_term)
@@ -5,3 +5,12 @@ class AppConfig(AppConfig):
     default_auto_field = 'django.db.models.BigAutoField'
     name = 'app'
     verbose_name = 'One-Time Secret'
+
+    def ready(self):
+        from django.db.backends.signals import connection_created
+
+        from . import checks  # registers the system checks
+        from .middleware import install_query_timer
+        from .sqlite import configure_connection
+        connection_created.connect(configure_connection)
+        connection_created.connect(install_query_timer)
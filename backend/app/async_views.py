@@ -0,0 +1,235 @@
+"""Native async versions of the hot endpoints, for deployments under ASGI.
+
+DRF views are sync-only, so under an ASGI server every request to them hops
+through sync_to_async. These views take the same input and give the same
+responses as their DRF counterparts, but talk to the database through
+Django's async ORM and await passphrase hashing on the KDF pool.
+"""
+import functools
+import json
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib.auth.models import AnonymousUser
+from django.http import HttpResponse, JsonResponse
+from django.utils import timezone
+from django.views.decorators.csrf import csrf_exempt
+from django.views.decorators.http import require_http_methods
+from rest_framework import status
+from rest_framework.exceptions import APIException, NotFound, ParseError, Throttled
+from rest_framework.utils.encoders import JSONEncoder
+
+from .authentication import CustomTokenAuthentication, acreate_session_token
+from .models import User, Secret
+from .otp_store import get_otp_store
+from .outbox import aqueue_mail
+from .serializers import SecretCreateSerializer, consumed_secret_data
+from .throttling import LoginRateThrottle, OTPVerifyRateThrottle, SecretViewRateThrottle
+from .views import file_response
+
+def api_response(data, status=status.HTTP_200_OK, headers=None):
+    if settings.OTS_FAST_JSON:
+        from .renderers import dumps
+        return HttpResponse(dumps(data), status=status, headers=headers, content_type='application/json')
+    # DRF's encoder, so dates and UUIDs render exactly like the sync views
+    return JsonResponse(data, status=status, encoder=JSONEncoder, headers=headers, safe=False)
+
+def error_response(exc):
+    headers = {}
+    if exc.status_code == status.HTTP_401_UNAUTHORIZED:
+        headers['WWW-Authenticate'] = CustomTokenAuthentication.keyword
+    wait = getattr(exc, 'wait', None)
+    if wait is not None:
+        headers['Retry-After'] = str(int(wait))
+    return api_response({'detail': exc.detail}, status=exc.status_code, headers=headers)
+
+def request_data(request):
+    if request.content_type == 'application/json':
+        if settings.OTS_FAST_JSON:
+            from .renderers import loads
+            return loads(request.body or b'{}')
+        try:
+            return json.loads(request.body or b'{}')
+        except ValueError as exc:
+            raise ParseError(f'JSON parse error - {exc}')
+    return request.POST
+
+async def check_throttle(request, throttle_class):
+    """Raise Throttled like DRF would. The throttle store (SQLite or the
+    cache) blocks, so it is checked in a thread."""
+    throttle = throttle_class()
+    if not await sync_to_async(throttle.allow_request)(request, None):
+        raise Throttled(throttle.wait())
+
+def async_api_view(*methods):
+    """csrf_exempt + method check + JSON errors for APIExceptions"""
+    def decorator(view):
+        @csrf_exempt
+        @require_http_methods(methods)
+        @functools.wraps(view)
+        async def wrapper(request, *args, **kwargs):
+            request.user = AnonymousUser()
+            try:
+                return await view(request, *args, **kwargs)
+            except APIException as exc:
+                return error_response(exc)
+        return wrapper
+    return decorator
+
+@async_api_view('POST')
+async def login(request):
+    await check_throttle(request, LoginRateThrottle)
+    email = request_data(request).get('email')
+
+    now = timezone.now()
+    try:
+        user = await User.objects.aget(email=email)
+    except User.DoesNotExist:
+        # Auto-register the user
+        try:
+            if not email:
+                raise ValueError('The Email field must be set')
+            user = await User.objects.acreate(email=User.objects.normalize_email(email))
+        except Exception as e:
+            return api_response({
+                'error': 'Failed to create account',
+                'detail': str(e)
+            }, status=status.HTTP_400_BAD_REQUEST)
+    await User.objects.filter(pk=user.pk).aupdate(last_login_at=now)
+    user.last_login_at = now
+
+    # Generate and send OTP (replacing any earlier one)
+    otp = await get_otp_store().aissue(user, now)
+
+    try:
+        await aqueue_mail(
+            'Your OTP for Login',
+            f'Your OTP is: {otp}',
+            settings.DEFAULT_FROM_EMAIL,
+            [email],
+        )
+    except Exception as e:
+        # If email sending fails, still return the OTP in development
+        if settings.DEBUG:
+            return api_response({
+                'message': 'OTP sent to your email',
+                'is_new_user': not user.last_login_at,
+                'debug_otp': otp  # Only include in development
+            })
+        return api_response({
+            'error': 'Failed to send OTP',
+            'detail': str(e)
+        }, status=status.HTTP_500_INTERNAL_SERVER_ERROR)
+
+    return api_response({
+        'message': 'OTP sent to your email',
+        'is_new_user': not user.last_login_at
+    })
+
+@async_api_view('POST')
+async def verify_otp(request):
+    await check_throttle(request, OTPVerifyRateThrottle)
+    data = request_data(request)
+    email = data.get('email')
+    otp = data.get('otp')
+
+    if not email or not otp:
+        return api_response({
+            'error': 'Missing required fields',
+            'detail': 'Email and OTP are required'
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    try:
+        user = await User.objects.aget(email=email)
+    except User.DoesNotExist:
+        return api_response({
+            'error': 'User not found',
+            'detail': 'No user found with this email'
+        }, status=status.HTTP_404_NOT_FOUND)
+
+    current_time = timezone.now()
+    try:
+        await get_otp_store().averify(user, otp, current_time)
+    except ValueError as e:
+        return api_response({
+            'error': 'OTP has expired' if 'expired' in str(e) else 'Invalid OTP',
+            'detail': str(e)
+        }, status=status.HTTP_400_BAD_REQUEST)
+
+    await User.objects.filter(pk=user.pk).aupdate(last_login_at=current_time)
+
+    # Create token with 1-minute expiration
+    key, expires_at = await acreate_session_token(user, current_time)
+    return api_response({
+        'token': key,
+        'expires_at': expires_at
+    })
+
+@async_api_view('POST')
+async def create_secret(request):
+    user_auth = await CustomTokenAuthentication().aauthenticate(request)
+    if user_auth is None:
+        return api_response(
+            {'detail': 'Authentication credentials were not provided.'},
+            status=status.HTTP_401_UNAUTHORIZED,
+            headers={'WWW-Authenticate': CustomTokenAuthentication.keyword},
+        )
+    request.user = user_auth[0]
+
+    serializer = SecretCreateSerializer(data=request_data(request), context={'request': request})
+    if not serializer.is_valid():
+        return api_response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+    if 'file' in serializer.validated_data:
+        return api_response(
+            {'detail': 'File secrets are only supported on /api/secrets/'},
+            status=status.HTTP_400_BAD_REQUEST,
+        )
+
+    secret = serializer.build_secret(serializer.validated_data)
+    secret.encrypt_message(serializer.validated_data['message'])
+    await secret.aset_passphrase(serializer.validated_data.get('passphrase'))
+    await secret.ainsert()
+    return api_response(SecretCreateSerializer(secret).data, status=status.HTTP_201_CREATED)
+
+async def consume(request, pk, passphrase):
+    await check_throttle(request, SecretViewRateThrottle)
+    try:
+        instance, message = await Secret.objects.aconsume(pk, passphrase)
+    except Secret.DoesNotExist:
+        raise NotFound
+    if instance.is_file:
+        return file_response(instance, instance.aiter_file())
+    return api_response(consumed_secret_data(instance, message))
+
+@async_api_view('POST')
+async def view_protected(request, pk):
+    passphrase = request_data(request).get('passphrase')
+    try:
+        return await consume(request, pk, passphrase)
+    except ValueError as e:
+        if "expired" in str(e):
+            error, detail = 'Secret has expired', 'This secret is no longer available'
+        elif "already been viewed or destroyed" in str(e):
+            error, detail = 'Secret is no longer available', 'This secret has already been viewed or destroyed'
+        elif "Passphrase required" in str(e):
+            error, detail = 'Passphrase required', 'Please provide a passphrase to view this secret'
+        elif "Invalid passphrase" in str(e):
+            error, detail = 'Invalid passphrase', 'The provided passphrase is incorrect'
+        else:
+            error, detail = 'Failed to decrypt secret', str(e)
+        return api_response({'error': error, 'detail': detail}, status=status.HTTP_400_BAD_REQUEST)
+
+@async_api_view('GET')
+async def retrieve_secret(request, pk):
+    try:
+        return await consume(request, pk, None)
+    except ValueError as e:
+        if "already been viewed or destroyed" in str(e):
+            error, detail = 'Secret is no longer available', str(e)
+        elif "expired" in str(e):
+            error, detail = 'Secret has expired', str(e)
+        elif "Passphrase required" in str(e):
+            error, detail = 'Passphrase required', 'This secret is passphrase protected'
+        else:
+            error, detail = 'Failed to decrypt secret', str(e)
+        return api_response({'error': error, 'detail': detail}, status=status.HTTP_400_BAD_REQUEST)
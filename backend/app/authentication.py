@@ -1,16 +1,191 @@
+import random
+import string
+import threading
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.exceptions import AuthenticationFailed
+from django.conf import settings
+from django.core.cache import cache
 from django.utils import timezone
-from .models import Token as CustomToken
+from .db_router import aget_fresh, get_fresh, issued_credentials
+from .models import User, Token as CustomToken
+from .signed_tokens import is_signed_token, issue_token, verify_token
+
+TOKEN_CACHE_PREFIX = 'ots:token:'
+USER_CACHE_PREFIX = 'ots:user:'
+# Sessions are short-lived on purpose
+SESSION_LIFETIME = timedelta(minutes=1)
+
+def token_cache_key(key):
+    return f'{TOKEN_CACHE_PREFIX}{key}'
+
+def user_cache_key(user_id):
+    return f'{USER_CACHE_PREFIX}{user_id}'
+
+def new_token_key():
+    return ''.join(random.choices(string.ascii_letters + string.digits, k=40))
+
+def create_session_token(user, now):
+    """Issue a session token; returns ``(key, expires_at)``"""
+    if settings.OTS_SIGNED_TOKENS:
+        key, expires_at = issue_token(user.pk, now, SESSION_LIFETIME)
+    else:
+        token = CustomToken.objects.create(user=user, key=new_token_key(), expires_at=now + SESSION_LIFETIME)
+        key, expires_at = token.key, token.expires_at
+    # Its first requests should see the login, not a lagging replica
+    issued_credentials(f'{CustomTokenAuthentication.keyword} {key}')
+    return key, expires_at
+
+async def acreate_session_token(user, now):
+    if settings.OTS_SIGNED_TOKENS:
+        key, expires_at = issue_token(user.pk, now, SESSION_LIFETIME)
+    else:
+        token = await CustomToken.objects.acreate(user=user, key=new_token_key(), expires_at=now + SESSION_LIFETIME)
+        key, expires_at = token.key, token.expires_at
+    issued_credentials(f'{CustomTokenAuthentication.keyword} {key}')
+    return key, expires_at
+
+def invalidate_user_tokens(user):
+    """Drop cached tokens of a user and revoke their signed tokens; call
+    before deleting their Token rows"""
+    keys = CustomToken.objects.filter(user=user).values_list('key', flat=True)
+    cache.delete_many([token_cache_key(key) for key in keys])
+    if settings.OTS_SIGNED_TOKENS:
+        User.objects.filter(pk=user.pk).update(tokens_valid_after=timezone.now())
+        cache.delete(user_cache_key(user.pk))
+
+def delete_user_tokens(user):
+    """Log a user out everywhere"""
+    invalidate_user_tokens(user)
+    tokens = CustomToken.objects.filter(user=user)
+    # Nothing references tokens, so skip the collector and its transaction
+    tokens._raw_delete(tokens.db)
+
+class TokenUsageBuffer:
+    """Coalesces last_used_at updates in memory and writes them in batches"""
+
+    def __init__(self, flush_interval=30, max_pending=1000):
+        self.flush_interval = flush_interval
+        self.max_pending = max_pending
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def _record(self, token_id, when):
+        """Buffer a timestamp; returns True when a flush is due"""
+        with self._lock:
+            self._pending[token_id] = when
+            return (
+                len(self._pending) >= self.max_pending
+                or time.monotonic() - self._last_flush >= self.flush_interval
+            )
+
+    def touch(self, token_id, when):
+        if self._record(token_id, when):
+            self.flush()
+
+    async def atouch(self, token_id, when):
+        if self._record(token_id, when):
+            await sync_to_async(self.flush)()
+
+    def flush(self):
+        """Write all buffered timestamps; returns the number of tokens updated"""
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        tokens = [CustomToken(pk=pk, last_used_at=when) for pk, when in pending.items()]
+        return CustomToken.objects.bulk_update(tokens, ['last_used_at'], batch_size=500)
+
+token_usage = TokenUsageBuffer()
 
 class CustomTokenAuthentication(TokenAuthentication):
+    # Upper bound for how long a token stays cached (with OTS_AUTH_CACHE);
+    # never past its expiry
+    cache_timeout = 300
+
+    def get_token(self, key):
+        cache_key = token_cache_key(key)
+        token = cache.get(cache_key) if settings.OTS_AUTH_CACHE else None
+        if token is None:
+            try:
+                token = get_fresh(CustomToken.objects.select_related('user'), key=key)
+            except CustomToken.DoesNotExist:
+                raise AuthenticationFailed('Invalid token')
+            timeout = min((token.expires_at - timezone.now()).total_seconds(), self.cache_timeout)
+            if timeout > 0 and settings.OTS_AUTH_CACHE:
+                cache.set(cache_key, token, timeout)
+        return token
+
+    async def aget_token(self, key):
+        cache_key = token_cache_key(key)
+        token = await cache.aget(cache_key) if settings.OTS_AUTH_CACHE else None
+        if token is None:
+            try:
+                token = await aget_fresh(CustomToken.objects.select_related('user'), key=key)
+            except CustomToken.DoesNotExist:
+                raise AuthenticationFailed('Invalid token')
+            timeout = min((token.expires_at - timezone.now()).total_seconds(), self.cache_timeout)
+            if timeout > 0 and settings.OTS_AUTH_CACHE:
+                await cache.aset(cache_key, token, timeout)
+        return token
+
+    def get_user(self, user_id):
+        """The user of a signed token, cached along with its revocation time"""
+        cache_key = user_cache_key(user_id)
+        user = cache.get(cache_key) if settings.OTS_AUTH_CACHE else None
+        if user is None:
+            try:
+                user = get_fresh(User.objects.all(), pk=user_id)
+            except User.DoesNotExist:
+                raise AuthenticationFailed('Invalid token')
+            if settings.OTS_AUTH_CACHE:
+                cache.set(cache_key, user, self.cache_timeout)
+        return user
+
+    async def aget_user(self, user_id):
+        cache_key = user_cache_key(user_id)
+        user = await cache.aget(cache_key) if settings.OTS_AUTH_CACHE else None
+        if user is None:
+            try:
+                user = await aget_fresh(User.objects.all(), pk=user_id)
+            except User.DoesNotExist:
+                raise AuthenticationFailed('Invalid token')
+            if settings.OTS_AUTH_CACHE:
+                await cache.aset(cache_key, user, self.cache_timeout)
+        return user
+
+    def check_revoked(self, user, token):
+        if not token.issued_after(user.tokens_valid_after):
+            raise AuthenticationFailed('Token has been revoked')
+        return (user, token)
+
     def authenticate_credentials(self, key):
-        try:
-            token = CustomToken.objects.get(key=key)
-            if not token.is_valid():
-                raise AuthenticationFailed('Token has expired')
-            token.last_used_at = timezone.now()
-            token.save()
-            return (token.user, token)
-        except CustomToken.DoesNotExist:
-            raise AuthenticationFailed('Invalid token') 
\ No newline at end of file
+        if settings.OTS_SIGNED_TOKENS and is_signed_token(key):
+            token = verify_token(key, timezone.now())
+            return self.check_revoked(self.get_user(token.user_id), token)
+        token = self.get_token(key)
+        if not token.is_valid():
+            raise AuthenticationFailed('Token has expired')
+        token_usage.touch(token.pk, timezone.now())
+        return (token.user, token)
+
+    async def aauthenticate(self, request):
+        """Async counterpart of authenticate() for plain Django async views"""
+        auth = request.headers.get('Authorization', '').split()
+        if not auth or auth[0].lower() != self.keyword.lower():
+            return None
+        if len(auth) != 2:
+            raise AuthenticationFailed('Invalid token header.')
+        if settings.OTS_SIGNED_TOKENS and is_signed_token(auth[1]):
+            token = verify_token(auth[1], timezone.now())
+            return self.check_revoked(await self.aget_user(token.user_id), token)
+        token = await self.aget_token(auth[1])
+        if not token.is_valid():
+            raise AuthenticationFailed('Token has expired')
+        await token_usage.atouch(token.pk, timezone.now())
+        return (token.user, token)
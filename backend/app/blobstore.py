@@ -0,0 +1,88 @@
+import base64
+import os
+import struct
+
+from django.conf import settings
+from django.utils.module_loading import import_string
+
+# Plaintext bytes per encrypted chunk
+CHUNK_SIZE = 64 * 1024
+
+# Every stored chunk is a length prefix followed by a raw Fernet token. The
+# token's plaintext starts with the chunk index and a last-chunk flag, so
+# reordered, dropped or truncated chunks fail to decrypt.
+LENGTH = struct.Struct('>I')
+HEADER = struct.Struct('>I?')
+
+def encrypt_chunks(fernet, chunks):
+    """Encrypt an iterable of plaintext chunks into the blob format"""
+    index = 0
+    pending = None
+    for chunk in chunks:
+        if pending is not None:
+            yield _seal(fernet, index, False, pending)
+            index += 1
+        pending = chunk
+    yield _seal(fernet, index, True, pending or b'')
+
+def _seal(fernet, index, last, data):
+    # Store the raw token instead of its base64 form to save a third of the space
+    token = base64.urlsafe_b64decode(fernet.encrypt(HEADER.pack(index, last) + data))
+    return LENGTH.pack(len(token)) + token
+
+def decrypt_chunks(fernet, stream):
+    """Decrypt a blob written by encrypt_chunks, one chunk at a time"""
+    index = 0
+    while True:
+        prefix = stream.read(LENGTH.size)
+        if len(prefix) != LENGTH.size:
+            raise ValueError("Encrypted file is truncated")
+        (length,) = LENGTH.unpack(prefix)
+        token = stream.read(length)
+        data = fernet.decrypt(base64.urlsafe_b64encode(token))
+        chunk_index, last = HEADER.unpack_from(data)
+        if chunk_index != index:
+            raise ValueError("Encrypted file chunks are out of order")
+        yield data[HEADER.size:]
+        if last:
+            return
+        index += 1
+
+class FileSystemBlobStore:
+    """Stores blobs as files under OTS_BLOB_ROOT"""
+
+    def __init__(self, root=None):
+        self.root = str(root or settings.OTS_BLOB_ROOT)
+
+    def path(self, name):
+        # Fan out into subdirectories so no single directory gets huge
+        return os.path.join(self.root, name[:2], name)
+
+    def save(self, name, chunks):
+        """Write an iterable of bytes to blob `name`; returns the bytes written"""
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        size = 0
+        temp_path = f'{path}.tmp'
+        with open(temp_path, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+                size += len(chunk)
+        os.replace(temp_path, path)
+        return size
+
+    def open(self, name):
+        return open(self.path(name), 'rb')
+
+    def delete(self, name):
+        """Remove blob `name`; returns the bytes freed (0 if it was already gone)"""
+        path = self.path(name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+def get_blob_store():
+    return import_string(settings.OTS_BLOB_STORE)()
@@ -0,0 +1,34 @@
+from django.conf import settings
+from django.core.checks import Error, register
+from django.utils.module_loading import import_string
+
+from .otp_store import CacheOTPStore
+
+SHARED_CACHE_HINT = 'Set CACHE_URL to a cache shared by all workers (e.g. redis://), '
+
+def per_process_cache():
+    return settings.CACHES['default']['BACKEND'] in settings.PER_PROCESS_CACHES
+
+@register()
+def check_otp_store(app_configs, **kwargs):
+    """CacheOTPStore loses codes between workers unless the cache is shared"""
+    if settings.DEBUG or not issubclass(import_string(settings.OTS_OTP_STORE), CacheOTPStore):
+        return []
+    if not per_process_cache():
+        return []
+    return [Error(
+        'OTS_OTP_STORE keeps login OTPs in a per-process cache',
+        hint=SHARED_CACHE_HINT + 'or use app.otp_store.ModelOTPStore.',
+        id='app.E001',
+    )]
+
+@register()
+def check_auth_cache(app_configs, **kwargs):
+    """Other workers keep accepting a logged out token from their own cache"""
+    if settings.DEBUG or not settings.OTS_AUTH_CACHE or not per_process_cache():
+        return []
+    return [Error(
+        'OTS_AUTH_CACHE caches session tokens in a per-process cache',
+        hint=SHARED_CACHE_HINT + 'or set OTS_AUTH_CACHE=False.',
+        id='app.E002',
+    )]
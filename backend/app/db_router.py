@@ -0,0 +1,161 @@
+"""Read replicas (OTS_DB_REPLICAS) with read-your-writes.
+
+ReplicaRouter sends reads to a random replica and everything else to the
+default database (the primary). A request stays on the primary for its
+reads once it has written anything, and unsafe methods (POST, DELETE, ...)
+start out there. ReplicaPinningMiddleware also keeps a client that wrote
+on the primary for OTS_REPLICA_STICKY_SECONDS, so its next requests see
+their own writes however far the replicas lag. That covers the credentials
+the request came with and any it hands out (a new session cookie, a
+session token from verify_otp). Code running outside a
+request (commands, the shell) gets the same per-thread behaviour.
+"""
+import hashlib
+import random
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction
+from django.conf import settings
+from django.core.cache import cache
+from django.db import DEFAULT_DB_ALIAS, connections
+
+PIN_CACHE_PREFIX = 'ots:db-pin:'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+
+class Pin:
+    """Where the reads of one request (or thread) go, and the credentials
+    it issued"""
+    __slots__ = ('primary', 'wrote', 'issued')
+
+    def __init__(self, primary=False):
+        self.primary = primary
+        self.wrote = False
+        self.issued = []
+
+_pin = ContextVar('ots_db_pin')
+
+def current_pin():
+    try:
+        return _pin.get()
+    except LookupError:
+        pin = Pin()
+        _pin.set(pin)
+        return pin
+
+def issued_credentials(credentials):
+    """Record credentials (an Authorization header value) handed out by the
+    current request, to be kept on the primary like the request's own"""
+    if settings.OTS_DB_REPLICAS:
+        current_pin().issued.append(credentials)
+
+@contextmanager
+def pin_scope(primary=False):
+    """A fresh pin for the code inside, e.g. one request"""
+    token = _pin.set(Pin(primary))
+    try:
+        yield _pin.get()
+    finally:
+        _pin.reset(token)
+
+def get_fresh(queryset, **lookup):
+    """queryset.get(), asking the primary if the replica doesn't have the
+    row (yet)"""
+    try:
+        return queryset.get(**lookup)
+    except queryset.model.DoesNotExist:
+        if not settings.OTS_DB_REPLICAS or current_pin().primary:
+            raise
+        return queryset.using(DEFAULT_DB_ALIAS).get(**lookup)
+
+async def aget_fresh(queryset, **lookup):
+    try:
+        return await queryset.aget(**lookup)
+    except queryset.model.DoesNotExist:
+        if not settings.OTS_DB_REPLICAS or current_pin().primary:
+            raise
+        return await queryset.using(DEFAULT_DB_ALIAS).aget(**lookup)
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        replicas = settings.OTS_DB_REPLICAS
+        if not replicas:
+            return None
+        # A transaction on the primary reads what it wrote so far
+        if current_pin().primary or connections[DEFAULT_DB_ALIAS].in_atomic_block:
+            return DEFAULT_DB_ALIAS
+        return random.choice(replicas)
+
+    def db_for_write(self, model, **hints):
+        if not settings.OTS_DB_REPLICAS:
+            return None
+        pin = current_pin()
+        pin.primary = pin.wrote = True
+        # Explicitly, or Django would save a row to the replica it came from
+        return DEFAULT_DB_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # The replicas hold the same rows as the primary
+        aliases = {DEFAULT_DB_ALIAS, *settings.OTS_DB_REPLICAS}
+        if obj1._state.db in aliases and obj2._state.db in aliases:
+            return True
+        return None
+
+def pin_cache_key(credentials):
+    return PIN_CACHE_PREFIX + hashlib.sha256(credentials.encode()).hexdigest()
+
+def request_pin_key(request):
+    """Cache key for the client behind `request` (its token or session),
+    or None for anonymous clients"""
+    credentials = request.headers.get('Authorization') or request.COOKIES.get(settings.SESSION_COOKIE_NAME)
+    return pin_cache_key(credentials) if credentials else None
+
+def written_pin_keys(request_key, pin, response):
+    """Cache keys to keep on the primary after a request that wrote: its
+    own client's, plus those of a session it started (logging in cycles
+    the session key) or tokens it issued"""
+    if not pin.wrote:
+        return []
+    keys = [pin_cache_key(credentials) for credentials in pin.issued]
+    session = response.cookies.get(settings.SESSION_COOKIE_NAME)
+    if session is not None and session.value:
+        keys.append(pin_cache_key(session.value))
+    if request_key is not None:
+        keys.append(request_key)
+    return keys
+
+class ReplicaPinningMiddleware:
+    """Per-request pins, and stickiness to the primary after a write"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        if not settings.OTS_DB_REPLICAS:
+            return self.get_response(request)
+        key = request_pin_key(request)
+        primary = request.method not in SAFE_METHODS or (key is not None and cache.get(key) is not None)
+        with pin_scope(primary) as pin:
+            response = self.get_response(request)
+        keys = written_pin_keys(key, pin, response)
+        if keys:
+            cache.set_many(dict.fromkeys(keys, 1), settings.OTS_REPLICA_STICKY_SECONDS)
+        return response
+
+    async def __acall__(self, request):
+        if not settings.OTS_DB_REPLICAS:
+            return await self.get_response(request)
+        key = request_pin_key(request)
+        primary = request.method not in SAFE_METHODS or (key is not None and await cache.aget(key) is not None)
+        with pin_scope(primary) as pin:
+            response = await self.get_response(request)
+        keys = written_pin_keys(key, pin, response)
+        if keys:
+            await cache.aset_many(dict.fromkeys(keys, 1), settings.OTS_REPLICA_STICKY_SECONDS)
+        return response
@@ -0,0 +1,123 @@
+import asyncio
+import base64
+import hashlib
+import hmac
+import os
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from rest_framework.exceptions import APIException
+
+from .metrics import metrics
+
+# Stored hashes look like b'scrypt$<n>$<r>$<p>$<salt>$<hash>', so the cost
+# settings can change without breaking existing secrets
+PREFIX = b'scrypt$'
+
+class PassphraseBusy(APIException):
+    status_code = 503
+    default_detail = 'Too many passphrase checks in progress, please retry shortly.'
+    default_code = 'passphrase_busy'
+
+def scrypt(passphrase, salt, n, r, p):
+    # V needs 128 * r * n bytes and B 128 * r * p; leave room for the rest
+    maxmem = 128 * r * (n + p + 2) + 1024 * 1024
+    return hashlib.scrypt(passphrase.encode(), salt=salt, n=n, r=r, p=p, maxmem=maxmem, dklen=32)
+
+def make_hash(passphrase, n=None, r=None, p=None):
+    n = n or settings.OTS_PASSPHRASE_SCRYPT_N
+    r = r or settings.OTS_PASSPHRASE_SCRYPT_R
+    p = p or settings.OTS_PASSPHRASE_SCRYPT_P
+    salt = os.urandom(16)
+    digest = scrypt(passphrase, salt, n, r, p)
+    return PREFIX + b'$'.join([
+        str(n).encode(), str(r).encode(), str(p).encode(),
+        base64.b64encode(salt), base64.b64encode(digest),
+    ])
+
+def verify_hash(passphrase, stored):
+    stored = bytes(stored)
+    if not stored.startswith(PREFIX):
+        # Secrets created before hashing stored the passphrase itself
+        return hmac.compare_digest(passphrase.encode(), stored)
+    n, r, p, salt, digest = stored[len(PREFIX):].split(b'$')
+    expected = scrypt(passphrase, base64.b64decode(salt), int(n), int(r), int(p))
+    return hmac.compare_digest(expected, base64.b64decode(digest))
+
+class KDFPool:
+    """Runs KDF calls on a fixed number of threads (hashlib.scrypt releases
+    the GIL) and refuses work once `queue_limit` calls are already waiting,
+    instead of letting request workers pile up behind it."""
+
+    def __init__(self, workers, queue_limit):
+        self.workers = workers
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='kdf')
+        self.slots = threading.BoundedSemaphore(workers + queue_limit)
+
+    def submit(self, fn, *args):
+        if not self.slots.acquire(blocking=False):
+            raise PassphraseBusy()
+
+        def call():
+            # Free the slot before the result is set, so whoever waits on it
+            # can submit again straight away
+            try:
+                return fn(*args)
+            finally:
+                self.slots.release()
+
+        try:
+            return self.executor.submit(call)
+        except BaseException:
+            self.slots.release()
+            raise
+
+    def run(self, fn, *args):
+        return self.submit(fn, *args).result()
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+def get_pool():
+    # Keyed by pid so forked workers never share a parent's threads
+    key = (os.getpid(), settings.OTS_KDF_WORKERS, settings.OTS_KDF_QUEUE_LIMIT)
+    with _pools_lock:
+        if key not in _pools:
+            _pools[key] = KDFPool(settings.OTS_KDF_WORKERS, settings.OTS_KDF_QUEUE_LIMIT)
+        return _pools[key]
+
+# Timings include the wait for a pool thread
+def hash_passphrase(passphrase):
+    with metrics.timer('ots_crypto_duration_seconds', operation='hash_passphrase'):
+        return get_pool().run(make_hash, passphrase)
+
+def check_passphrase(passphrase, stored):
+    with metrics.timer('ots_crypto_duration_seconds', operation='check_passphrase'):
+        return get_pool().run(verify_hash, passphrase, bytes(stored))
+
+def hash_passphrases(passphrases):
+    """Hash several passphrases side by side on the pool, in input order.
+
+    At most one call per pool thread is in flight, so a bulk request keeps
+    every thread busy without taking the queue slots of single checks.
+    """
+    pool = get_pool()
+    hashes = []
+    pending = deque()
+    with metrics.timer('ots_crypto_duration_seconds', operation='hash_passphrases'):
+        for passphrase in passphrases:
+            if len(pending) >= pool.workers:
+                hashes.append(pending.popleft().result())
+            pending.append(pool.submit(make_hash, passphrase))
+        hashes.extend(future.result() for future in pending)
+    return hashes
+
+async def ahash_passphrase(passphrase):
+    with metrics.timer('ots_crypto_duration_seconds', operation='hash_passphrase'):
+        return await asyncio.wrap_future(get_pool().submit(make_hash, passphrase))
+
+async def acheck_passphrase(passphrase, stored):
+    with metrics.timer('ots_crypto_duration_seconds', operation='check_passphrase'):
+        return await asyncio.wrap_future(get_pool().submit(verify_hash, passphrase, bytes(stored)))
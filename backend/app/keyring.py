@@ -0,0 +1,32 @@
+from functools import lru_cache
+
+from cryptography.fernet import Fernet, InvalidToken, MultiFernet
+from django.conf import settings
+
+@lru_cache(maxsize=4)
+def _keyring(keys):
+    fernets = [Fernet(key) for key in keys]
+    return fernets[0], MultiFernet(fernets)
+
+def get_keyring():
+    """MultiFernet over OTS_MASTER_KEYS; the first key wraps new data keys"""
+    return _keyring(tuple(settings.OTS_MASTER_KEYS))[1]
+
+def wrap_key(data_key):
+    return get_keyring().encrypt(data_key)
+
+def unwrap_key(wrapped_key):
+    return get_keyring().decrypt(bytes(wrapped_key))
+
+def rewrap_key(wrapped_key):
+    """Re-wrap a data key under the primary master key.
+
+    Returns None when it already is, so callers can skip the write.
+    """
+    primary, keyring = _keyring(tuple(settings.OTS_MASTER_KEYS))
+    wrapped_key = bytes(wrapped_key)
+    try:
+        primary.decrypt(wrapped_key)
+    except InvalidToken:
+        return keyring.rotate(wrapped_key)
+    return None
@@ -0,0 +1,216 @@
+import json
+import subprocess
+import tempfile
+import threading
+import time
+import uuid
+from pathlib import Path
+
+from django.conf import settings
+from django.core import mail
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, connections
+from django.test import override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from app.models import User
+
+ENDPOINTS = ('login', 'verify_otp', 'create', 'list', 'retrieve', 'view_protected', 'logout')
+PASSPHRASE = 'benchmark passphrase'
+
+def percentile(ordered, pct):
+    """Nearest-rank percentile of an already sorted list"""
+    if not ordered:
+        return 0.0
+    return ordered[min(len(ordered) - 1, max(0, round(pct / 100 * len(ordered)) - 1))]
+
+def git_revision():
+    try:
+        result = subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'],
+            cwd=settings.BASE_DIR, capture_output=True, text=True, timeout=5,
+        )
+    except OSError:
+        return ''
+    return result.stdout.strip()
+
+class VirtualUser:
+    """One API client with its own IP address, so per-IP throttles apply per user"""
+
+    def __init__(self, index, run_id):
+        self.email = f'bench-{run_id}-{index}@example.com'
+        self.client = APIClient(REMOTE_ADDR=f'10.{index >> 16 & 255}.{index >> 8 & 255}.{index & 255}')
+        self.secrets = []  # (id, passphrase)
+
+class Command(BaseCommand):
+    help = 'Load-tests the API hot paths in-process and reports throughput, latency and queries per endpoint'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=50, help='Virtual users, each with its own IP')
+        parser.add_argument('--concurrency', type=int, default=8, help='Threads sending requests')
+        parser.add_argument('--secrets', type=int, default=4,
+                            help='Secrets each user creates and views; half are passphrase protected')
+        parser.add_argument('--output', help='Write the results as JSON to this file')
+        parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+
+    def record(self, endpoint, elapsed, queries, failed):
+        with self.lock:
+            stats = self.results[endpoint]
+            stats['latencies'].append(elapsed)
+            stats['queries'] += queries
+            stats['errors'] += failed
+
+    def call(self, user, endpoint, method, path, data=None, expect=200):
+        with CaptureQueriesContext(connection) as queries:
+            start = time.perf_counter()
+            response = getattr(user.client, method)(path, data, format='json')
+            elapsed = time.perf_counter() - start
+        self.record(endpoint, elapsed, len(queries), response.status_code != expect)
+        return response
+
+    # One method per phase; each runs once per virtual user
+    def login(self, user):
+        self.call(user, 'login', 'post', '/api/users/login/', {'email': user.email})
+
+    def verify_otp(self, user):
+        message = next((m for m in reversed(getattr(mail, 'outbox', [])) if m.to == [user.email]), None)
+        if message is None:
+            return
+        code = message.body.rsplit(':', 1)[1].strip()
+        response = self.call(user, 'verify_otp', 'post', '/api/users/verify_otp/',
+                             {'email': user.email, 'otp': code})
+        if response.status_code == 200:
+            user.client.credentials(HTTP_AUTHORIZATION=f'Token {response.data["token"]}')
+
+    def create(self, user):
+        for i in range(self.secrets_per_user):
+            passphrase = PASSPHRASE if i % 2 else None
+            data = {'message': f'benchmark secret {i}'}
+            if passphrase:
+                data['passphrase'] = passphrase
+            response = self.call(user, 'create', 'post', '/api/secrets/', data, expect=201)
+            if response.status_code == 201:
+                user.secrets.append((response.data['id'], passphrase))
+
+    def list(self, user):
+        self.call(user, 'list', 'get', '/api/secrets/')
+
+    def retrieve(self, user):
+        for pk, passphrase in user.secrets:
+            if not passphrase:
+                self.call(user, 'retrieve', 'get', f'/api/secrets/{pk}/')
+
+    def view_protected(self, user):
+        for pk, passphrase in user.secrets:
+            if passphrase:
+                self.call(user, 'view_protected', 'post', f'/api/secrets/{pk}/view_protected/',
+                          {'passphrase': passphrase})
+
+    def logout(self, user):
+        self.call(user, 'logout', 'post', '/api/users/logout/')
+
+    def run_phase(self, phase, users, concurrency):
+        pending = iter(users)
+        lock = threading.Lock()
+
+        def worker():
+            try:
+                while True:
+                    with lock:
+                        user = next(pending, None)
+                    if user is None:
+                        return
+                    phase(user)
+            finally:
+                connections.close_all()
+
+        threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+        start = time.perf_counter()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        return time.perf_counter() - start
+
+    def summarize(self, endpoint, elapsed):
+        stats = self.results[endpoint]
+        ordered = sorted(stats['latencies'])
+        count = len(ordered)
+        return {
+            'requests': count,
+            'errors': stats['errors'],
+            'rps': round(count / elapsed, 1) if elapsed else 0.0,
+            'p50_ms': round(percentile(ordered, 50) * 1000, 2),
+            'p95_ms': round(percentile(ordered, 95) * 1000, 2),
+            'p99_ms': round(percentile(ordered, 99) * 1000, 2),
+            'queries_per_request': round(stats['queries'] / count, 2) if count else 0.0,
+        }
+
+    def handle(self, *args, **options):
+        baseline = None
+        if options['baseline']:
+            try:
+                baseline = json.loads(Path(options['baseline']).read_text())['endpoints']
+            except (OSError, ValueError, KeyError) as e:
+                raise CommandError(f'Cannot read baseline: {e}')
+
+        self.secrets_per_user = options['secrets']
+        self.lock = threading.Lock()
+        self.results = {endpoint: {'latencies': [], 'queries': 0, 'errors': 0} for endpoint in ENDPOINTS}
+        run_id = uuid.uuid4().hex[:8]
+        users = [VirtualUser(i, run_id) for i in range(options['users'])]
+        started_at = timezone.now()
+
+        # locmem mail (the OTP is read back from mail.outbox) and a private
+        # throttle file, so earlier runs don't count against this one
+        with tempfile.TemporaryDirectory() as tmp, override_settings(
+            ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'],
+            EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend',
+            OTS_EMAIL_OUTBOX=False,
+            OTS_THROTTLE_DB=str(Path(tmp) / 'throttle.sqlite3'),
+        ):
+            try:
+                elapsed = {
+                    endpoint: self.run_phase(getattr(self, endpoint), users, options['concurrency'])
+                    for endpoint in ENDPOINTS
+                }
+            finally:
+                User.objects.filter(email__startswith=f'bench-{run_id}-').delete()
+
+        report = {
+            'started_at': started_at.isoformat(),
+            'revision': git_revision(),
+            'database': connection.vendor,
+            'users': options['users'],
+            'concurrency': options['concurrency'],
+            'secrets_per_user': self.secrets_per_user,
+            'endpoints': {endpoint: self.summarize(endpoint, elapsed[endpoint]) for endpoint in ENDPOINTS},
+        }
+
+        self.stdout.write(
+            f'{options["users"]} users, concurrency {options["concurrency"]}, '
+            f'{self.secrets_per_user} secrets per user ({connection.vendor})'
+        )
+        header = f'{"endpoint":<15} {"reqs":>6} {"err":>4} {"req/s":>8} {"p50 ms":>8} {"p95 ms":>8} {"p99 ms":>8} {"queries":>8}'
+        if baseline:
+            header += f' {"Δreq/s":>8} {"Δp95":>8}'
+        self.stdout.write(header)
+        for endpoint, row in report['endpoints'].items():
+            line = (
+                f'{endpoint:<15} {row["requests"]:>6} {row["errors"]:>4} {row["rps"]:>8.1f} '
+                f'{row["p50_ms"]:>8.2f} {row["p95_ms"]:>8.2f} {row["p99_ms"]:>8.2f} '
+                f'{row["queries_per_request"]:>8.2f}'
+            )
+            previous = baseline.get(endpoint) if baseline else None
+            if previous and previous['rps'] and previous['p95_ms']:
+                line += (
+                    f' {(row["rps"] / previous["rps"] - 1) * 100:>+7.0f}%'
+                    f' {(row["p95_ms"] / previous["p95_ms"] - 1) * 100:>+7.0f}%'
+                )
+            self.stdout.write(line)
+
+        if options['output']:
+            Path(options['output']).write_text(json.dumps(report, indent=2) + '\n')
+            self.stdout.write(self.style.SUCCESS(f'Results written to {options["output"]}'))
@@ -0,0 +1,177 @@
+import http.client
+import importlib.util
+import json
+import os
+import socket
+import statistics
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+
+from app.models import OutboxEmail, User, Secret, Token as CustomToken
+from app.otp_store import get_otp_store
+
+# Each server is benchmarked on the same hot paths, via its own URL prefix
+SERVERS = [
+    ('asgi', ['ots.asgi:application'], '/api/async'),
+    ('wsgi', ['ots.wsgi:application', '--interface', 'wsgi'], '/api'),
+]
+
+def wait_for_port(port, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        try:
+            socket.create_connection(('127.0.0.1', port), timeout=1).close()
+            return
+        except OSError:
+            time.sleep(0.1)
+    raise CommandError(f'Server on port {port} did not start')
+
+def run_load(port, requests, concurrency):
+    """Send (method, path, body, headers) requests; returns latencies and error count"""
+    local = threading.local()
+    pending = iter(requests)
+    lock = threading.Lock()
+    latencies, errors = [], 0
+
+    def worker():
+        nonlocal errors
+        connection = getattr(local, 'connection', None)
+        if connection is None:
+            connection = local.connection = http.client.HTTPConnection('127.0.0.1', port, timeout=30)
+        while True:
+            with lock:
+                spec = next(pending, None)
+            if spec is None:
+                return
+            method, path, body, headers = spec
+            start = time.perf_counter()
+            connection.request(method, path, body=body, headers=headers)
+            response = connection.getresponse()
+            response.read()
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+                if response.status >= 300:
+                    errors += 1
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as executor:
+        for future in [executor.submit(worker) for _ in range(concurrency)]:
+            future.result()
+    return latencies, errors, time.perf_counter() - start
+
+class Command(BaseCommand):
+    help = ('Compares requests/sec and latency of the async and DRF endpoints under uvicorn; '
+            'everything it creates is deleted afterwards')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Requests per scenario')
+        parser.add_argument('--concurrency', type=int, default=16)
+        parser.add_argument('--port', type=int, default=8765)
+
+    def scenarios(self, name, prefix, count, token, run_id):
+        auth = {'Content-Type': 'application/json', 'Authorization': f'Token {token.key}'}
+        json_headers = {'Content-Type': 'application/json'}
+        user = token.user
+        expires_at = timezone.now() + timezone.timedelta(hours=1)
+        secrets, protected = [], []
+        for i in range(count * 2):
+            secret = Secret(user=user, expires_at=expires_at)
+            secret.encrypt_message('benchmark secret', 'benchmark' if i % 2 else None)
+            (protected if i % 2 else secrets).append(secret)
+        Secret.objects.bulk_create(secrets + protected)
+        # Users with a known OTP; the store is shared with the server through
+        # the database (or a shared cache)
+        otp_users = User.objects.bulk_create([
+            User(email=f'bench-{run_id}-{name}-otp-{i}@example.com') for i in range(count)
+        ])
+        store = get_otp_store()
+        codes = [(otp_user.email, store.issue(otp_user)) for otp_user in otp_users]
+        return [
+            ('login', [
+                ('POST', f'{prefix}/users/login/',
+                 json.dumps({'email': f'bench-{run_id}-{name}-{i}@example.com'}), json_headers)
+                for i in range(count)
+            ]),
+            ('verify', [
+                ('POST', f'{prefix}/users/verify_otp/', json.dumps({'email': email, 'otp': code}), json_headers)
+                for email, code in codes
+            ]),
+            ('create', [
+                ('POST', f'{prefix}/secrets/', json.dumps({'message': 'benchmark secret'}), auth)
+                for _ in range(count)
+            ]),
+            ('retrieve', [
+                ('GET', f'{prefix}/secrets/{secret.pk}/', None, {})
+                for secret in secrets
+            ]),
+            ('protected', [
+                ('POST', f'{prefix}/secrets/{secret.pk}/view_protected/',
+                 json.dumps({'passphrase': 'benchmark'}), json_headers)
+                for secret in protected
+            ]),
+        ]
+
+    def handle(self, *args, **options):
+        if importlib.util.find_spec('uvicorn') is None:
+            raise CommandError('This benchmark needs uvicorn: pip install uvicorn')
+
+        run_id = uuid.uuid4().hex[:8]
+        started_at = timezone.now()
+        user = User.objects.create(email=f'bench-{run_id}@example.com')
+        token = CustomToken.objects.create(
+            user=user,
+            key=uuid.uuid4().hex + uuid.uuid4().hex[:8],
+            expires_at=timezone.now() + timezone.timedelta(hours=1),
+        )
+        self.env = {
+            **os.environ,
+            # Lift the per-IP limits and keep SMTP out of the measurement
+            'OTS_LOGIN_RATE': '',
+            'OTS_OTP_VERIFY_RATE': '',
+            'OTS_SECRET_VIEW_RATE': '',
+            'OTS_EMAIL_OUTBOX': 'True',
+        }
+
+        self.stdout.write(f'{options["requests"]} requests per scenario, concurrency {options["concurrency"]}')
+        self.stdout.write(f'{"server":<6} {"endpoint":<9} {"req/s":>8} {"p50 ms":>8} {"p99 ms":>8} {"errors":>7}')
+        try:
+            for name, target, prefix in SERVERS:
+                self.benchmark(name, target, prefix, token, run_id, options)
+        finally:
+            # The bench users' secrets, tokens and OTPs go with them
+            User.objects.filter(email__startswith=f'bench-{run_id}').delete()
+            queued = OutboxEmail.objects.filter(created_at__gte=started_at).values_list('pk', 'recipients')
+            OutboxEmail.objects.filter(pk__in=[
+                pk for pk, recipients in queued
+                if any(email.startswith(f'bench-{run_id}-') for email in recipients)
+            ]).delete()
+
+    def benchmark(self, name, target, prefix, token, run_id, options):
+        port = options['port']
+        server = subprocess.Popen(
+            [sys.executable, '-m', 'uvicorn', *target, '--port', str(port), '--log-level', 'warning'],
+            cwd=settings.BASE_DIR,
+            env=self.env,
+        )
+        try:
+            wait_for_port(port)
+            for endpoint, requests in self.scenarios(name, prefix, options['requests'], token, run_id):
+                latencies, errors, elapsed = run_load(port, requests, options['concurrency'])
+                latencies.sort()
+                self.stdout.write(
+                    f'{name:<6} {endpoint:<9} {len(latencies) / elapsed:>8.1f} '
+                    f'{statistics.median(latencies) * 1000:>8.1f} '
+                    f'{latencies[int(len(latencies) * 0.99)] * 1000:>8.1f} {errors:>7}'
+                )
+        finally:
+            server.terminate()
+            server.wait()
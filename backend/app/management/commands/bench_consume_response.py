@@ -0,0 +1,51 @@
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.utils import timezone
+
+from app.middleware import QueryTimer
+from app.models import Secret
+from app.serializers import SecretViewSerializer, consumed_secret_data
+
+class Command(BaseCommand):
+    help = 'Compares building the view response of a consumed secret with SecretViewSerializer and as a plain dict'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=20000)
+
+    def measure(self, fn, iterations):
+        queries = QueryTimer()
+        with connection.execute_wrapper(queries):
+            start = time.perf_counter()
+            for _ in range(iterations):
+                fn()
+            elapsed = time.perf_counter() - start
+        return elapsed * 1e6 / iterations, queries.count / iterations
+
+    def handle(self, *args, **options):
+        now = timezone.now()
+        # Never saved: building the response needs no database
+        secret = Secret(id=uuid.uuid4(), created_at=now, expires_at=now + timedelta(hours=1), is_viewed=True)
+        message = 'top secret'
+
+        def serializer():
+            secret._decrypted_message = message
+            return SecretViewSerializer(secret).data
+
+        if dict(serializer()) != consumed_secret_data(secret, message):
+            raise AssertionError('Responses differ')
+
+        iterations = options['iterations']
+        self.stdout.write(f'{iterations} responses')
+        self.stdout.write(f'{"builder":<22} {"µs/response":>12} {"queries":>8}')
+        results = {}
+        for name, fn in (('SecretViewSerializer', serializer),
+                         ('consumed_secret_data', lambda: consumed_secret_data(secret, message))):
+            results[name] = self.measure(fn, iterations)
+            micros, queries = results[name]
+            self.stdout.write(f'{name:<22} {micros:>12.1f} {queries:>8.2f}')
+        saved = results['SecretViewSerializer'][0] - results['consumed_secret_data'][0]
+        self.stdout.write(self.style.SUCCESS(f'Saves {saved:.1f}µs per consumed secret'))
@@ -0,0 +1,57 @@
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.test import override_settings
+from django.utils import timezone
+from rest_framework.test import APIClient
+
+from app.models import User, Token as CustomToken
+
+class Command(BaseCommand):
+    help = 'Compares secrets/sec of POST /api/secrets/ against POST /api/secrets/bulk/'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--count', type=int, default=500, help='Secrets created by each path')
+        parser.add_argument('--batch-size', type=int, default=100, help='Secrets per bulk request')
+        parser.add_argument('--passphrase', default=None,
+                            help='Protect every secret with this passphrase (adds one scrypt hash each)')
+
+    def run(self, client, url, bodies):
+        start = time.perf_counter()
+        for body in bodies:
+            response = client.post(url, body, format='json')
+            if response.status_code != 201:
+                self.stderr.write(f'{url} returned {response.status_code}: {response.data}')
+        return time.perf_counter() - start
+
+    def handle(self, *args, **options):
+        count, batch_size = options['count'], options['batch_size']
+        item = {'message': 'benchmark secret'}
+        if options['passphrase']:
+            item['passphrase'] = options['passphrase']
+
+        user = User.objects.create(email=f'bench-{uuid.uuid4().hex[:8]}@example.com')
+        token = CustomToken.objects.create(
+            user=user,
+            key=uuid.uuid4().hex + uuid.uuid4().hex[:8],
+            expires_at=timezone.now() + timezone.timedelta(hours=1),
+        )
+        client = APIClient()
+        client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+        try:
+            # Let the in-process client through ALLOWED_HOSTS
+            with override_settings(ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver']):
+                single = self.run(client, '/api/secrets/', [item] * count)
+                batches = [[item] * min(batch_size, count - i) for i in range(0, count, batch_size)]
+                bulk = self.run(client, '/api/secrets/bulk/', batches)
+        finally:
+            # Along with its secrets and token
+            user.delete()
+
+        self.stdout.write(f'{count} secrets, bulk batches of {batch_size}')
+        self.stdout.write(f'{"path":<8} {"secrets/s":>10} {"ms/secret":>10}')
+        for name, elapsed in (('single', single), ('bulk', bulk)):
+            self.stdout.write(f'{name:<8} {count / elapsed:>10.1f} {elapsed * 1000 / count:>10.2f}')
+        self.stdout.write(self.style.SUCCESS(f'Bulk create is {single / bulk:.1f}x faster'))
@@ -0,0 +1,70 @@
+import importlib.util
+import io
+import time
+import uuid
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from rest_framework.parsers import JSONParser
+from rest_framework.renderers import JSONRenderer
+
+from app.models import Secret
+from app.serializers import SecretCreateSerializer, SecretViewSerializer
+
+class Command(BaseCommand):
+    help = "Compares DRF's JSON renderer and parser with the orjson ones (OTS_FAST_JSON)"
+
+    def add_arguments(self, parser):
+        parser.add_argument('--seconds', type=float, default=1.0, help='Time spent measuring each case')
+
+    def payloads(self):
+        now = timezone.now()
+        secrets = [
+            Secret(id=uuid.uuid4(), created_at=now, expires_at=now + timedelta(minutes=10),
+                   destruction_animation='fire', file_name='', file_size=None)
+            for _ in range(500)
+        ]
+        page = SecretCreateSerializer(secrets[:10], many=True).data
+        viewed = secrets[0]
+        viewed._decrypted_message = 'top secret ' * 20
+        return {
+            # What the views render: serializer output, plus a raw model row
+            'view': SecretViewSerializer(viewed).data,
+            'list page (10)': {'next': None, 'previous': None, 'results': page},
+            'bulk create (500)': SecretCreateSerializer(secrets, many=True).data,
+            'raw datetimes/UUIDs (500)': [
+                {'id': secret.id, 'created_at': secret.created_at, 'expires_at': secret.expires_at}
+                for secret in secrets
+            ],
+        }
+
+    def rate(self, fn, seconds):
+        done, start = 0, time.perf_counter()
+        while time.perf_counter() - start < seconds:
+            fn()
+            done += 1
+        return (time.perf_counter() - start) * 1e6 / done
+
+    def handle(self, *args, **options):
+        if importlib.util.find_spec('orjson') is None:
+            raise CommandError('This benchmark needs orjson: pip install orjson')
+        from app.renderers import ORJSONParser, ORJSONRenderer
+
+        seconds = options['seconds']
+        self.stdout.write(f'{"payload":<27} {"step":<7} {"drf µs":>9} {"orjson µs":>10} {"speedup":>8}')
+        for name, data in self.payloads().items():
+            content = JSONRenderer().render(data)
+            if ORJSONRenderer().render(data) != content:
+                raise CommandError(f'{name}: orjson output differs from JSONRenderer')
+            steps = (
+                ('render', lambda r: r().render(data), JSONRenderer, ORJSONRenderer),
+                ('parse', lambda p: p().parse(io.BytesIO(content)), JSONParser, ORJSONParser),
+            )
+            for step, fn, drf, fast in steps:
+                slow_us = self.rate(lambda: fn(drf), seconds)
+                fast_us = self.rate(lambda: fn(fast), seconds)
+                self.stdout.write(
+                    f'{name:<27} {step:<7} {slow_us:>9.1f} {fast_us:>10.1f} {slow_us / fast_us:>7.1f}x'
+                )
+        self.stdout.write(self.style.SUCCESS('orjson output is identical for every payload'))
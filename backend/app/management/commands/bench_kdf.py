@@ -0,0 +1,49 @@
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.kdf import make_hash, verify_hash
+
+class Command(BaseCommand):
+    help = 'Measures passphrase verifications per second per core for several scrypt costs'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--costs', type=lambda value: [int(n) for n in value.split(',')],
+                            default=[2 ** 12, 2 ** 13, 2 ** 14, 2 ** 15, 2 ** 16],
+                            help='Comma-separated scrypt N values')
+        parser.add_argument('--threads', type=int, default=settings.OTS_KDF_WORKERS)
+        parser.add_argument('--seconds', type=float, default=2.0,
+                            help='Time spent measuring each cost')
+
+    def rate(self, stored, threads, seconds):
+        deadline = time.perf_counter() + seconds
+
+        def worker():
+            done = 0
+            while time.perf_counter() < deadline:
+                verify_hash('correct horse battery staple', stored)
+                done += 1
+            return done
+
+        start = time.perf_counter()
+        with ThreadPoolExecutor(threads) as executor:
+            total = sum(executor.map(lambda _: worker(), range(threads)))
+        return total / (time.perf_counter() - start)
+
+    def handle(self, *args, **options):
+        threads = options['threads']
+        cores = min(threads, os.cpu_count() or 1)
+        r, p = settings.OTS_PASSPHRASE_SCRYPT_R, settings.OTS_PASSPHRASE_SCRYPT_P
+        self.stdout.write(f'r={r} p={p}, {threads} threads on {os.cpu_count()} cores')
+        self.stdout.write(f'{"N":>8} {"memory":>8} {"1 thread/s":>11} {"pool/s":>9} {"per core/s":>11}')
+        for n in options['costs']:
+            stored = make_hash('correct horse battery staple', n=n, r=r, p=p)
+            single = self.rate(stored, 1, options['seconds'])
+            pooled = self.rate(stored, threads, options['seconds'])
+            memory = f'{128 * r * n // (1024 * 1024)}MB'
+            self.stdout.write(
+                f'{n:>8} {memory:>8} {single:>11.1f} {pooled:>9.1f} {pooled / cores:>11.1f}'
+            )
@@ -0,0 +1,92 @@
+import multiprocessing
+import os
+import sqlite3
+import tempfile
+import time
+import uuid
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from app.sqlite import apply_pragmas, backoff, is_lock_error
+
+PROFILES = ('stock', 'tuned')
+
+def connect(path, profile):
+    # timeout=5 is what Django uses by default
+    connection = sqlite3.connect(path, timeout=5, isolation_level=None)
+    if profile == 'tuned':
+        apply_pragmas(connection, settings.OTS_SQLITE_BUSY_TIMEOUT_MS)
+    return connection
+
+def worker(path, profile, seconds, start, results):
+    """Run request-shaped write transactions until time is up; reports
+    (commits, lock errors)"""
+    connection = connect(path, profile)
+    begin = 'BEGIN IMMEDIATE' if profile == 'tuned' else 'BEGIN'
+    commits = errors = 0
+    start.wait()
+    deadline = time.monotonic() + seconds
+    while time.monotonic() < deadline:
+        attempt = 0
+        try:
+            while True:
+                try:
+                    connection.execute(begin)
+                    break
+                except sqlite3.OperationalError as exc:
+                    attempt += 1
+                    if profile != 'tuned' or attempt > settings.OTS_SQLITE_LOCK_RETRIES or not is_lock_error(exc):
+                        raise
+                    time.sleep(backoff(attempt))
+            # Like verify_otp: read the user, stamp the login, add a token
+            user_id = commits % 100 + 1
+            connection.execute('SELECT id, last_login_at FROM user WHERE id = ?', (user_id,)).fetchone()
+            connection.execute('UPDATE user SET last_login_at = ? WHERE id = ?', (time.time(), user_id))
+            connection.execute('INSERT INTO token (key, user_id) VALUES (?, ?)', (uuid.uuid4().hex, user_id))
+            connection.execute('COMMIT')
+            commits += 1
+        except sqlite3.OperationalError as exc:
+            if not is_lock_error(exc):
+                raise
+            if connection.in_transaction:
+                connection.execute('ROLLBACK')
+            errors += 1
+    results.put((commits, errors))
+
+class Command(BaseCommand):
+    help = 'Measures sustained write transactions/sec of N processes on stock and tuned SQLite'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--processes', type=lambda value: [int(n) for n in value.split(',')],
+                            default=[1, 2, 4, 8], help='Comma-separated process counts')
+        parser.add_argument('--seconds', type=float, default=3.0, help='Time spent measuring each case')
+
+    def run(self, profile, processes, seconds):
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'bench.sqlite3')
+            connection = connect(path, profile)
+            connection.execute('CREATE TABLE user (id INTEGER PRIMARY KEY, last_login_at REAL)')
+            connection.execute('CREATE TABLE token (key TEXT PRIMARY KEY, user_id INTEGER)')
+            connection.executemany('INSERT INTO user (id) VALUES (?)', [(n,) for n in range(1, 101)])
+            connection.close()
+
+            start = multiprocessing.Barrier(processes)
+            results = multiprocessing.Queue()
+            workers = [
+                multiprocessing.Process(target=worker, args=(path, profile, seconds, start, results))
+                for _ in range(processes)
+            ]
+            for process in workers:
+                process.start()
+            totals = [results.get() for _ in workers]
+            for process in workers:
+                process.join()
+        return sum(commits for commits, _ in totals) / seconds, sum(errors for _, errors in totals)
+
+    def handle(self, *args, **options):
+        self.stdout.write(f'{"processes":>9} {"profile":<7} {"commits/s":>10} {"lock errors":>12}')
+        for processes in options['processes']:
+            for profile in PROFILES:
+                rate, errors = self.run(profile, processes, options['seconds'])
+                self.stdout.write(f'{processes:>9} {profile:<7} {rate:>10.0f} {errors:>12}')
@@ -0,0 +1,91 @@
+import multiprocessing
+import os
+import statistics
+import tempfile
+import time
+
+from django.contrib.auth.models import AnonymousUser
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.test import RequestFactory, override_settings
+
+from app.throttling import SharedRateThrottle
+
+class BenchThrottle(SharedRateThrottle):
+    scope = 'bench'
+
+def make_requests(count):
+    factory = RequestFactory()
+    requests = []
+    for i in range(count):
+        request = factory.get('/', REMOTE_ADDR=f'10.{i // 65536 % 256}.{i // 256 % 256}.{i % 256}')
+        request.user = AnonymousUser()
+        requests.append(request)
+    return requests
+
+def allowed_in_process(rate, attempts, throttle_db):
+    with override_settings(OTS_THROTTLE_DB=throttle_db):
+        throttle_class = type('ProcessThrottle', (BenchThrottle,), {'rate': rate})
+        request = make_requests(1)[0]
+        return sum(throttle_class().allow_request(request, None) for _ in range(attempts))
+
+class Command(BaseCommand):
+    help = 'Compares per-check latency of the cache-based and shared-SQLite throttles'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--checks', type=int, default=20000)
+        parser.add_argument('--keys', type=int, default=1000,
+                            help='Number of distinct client IPs')
+        parser.add_argument('--rate', default='100/minute')
+        parser.add_argument('--processes', type=int, default=4,
+                            help='Worker processes for the cross-process enforcement check')
+
+    def measure(self, throttle_db, requests, rate, checks):
+        throttle_class = type('Throttle', (BenchThrottle,), {'rate': rate})
+        timings = []
+        allowed = 0
+        with override_settings(OTS_THROTTLE_DB=throttle_db):
+            for i in range(checks):
+                request = requests[i % len(requests)]
+                start = time.perf_counter_ns()
+                allowed += throttle_class().allow_request(request, None)
+                timings.append(time.perf_counter_ns() - start)
+        timings.sort()
+        return {
+            'mean': statistics.fmean(timings) / 1000,
+            'p50': timings[len(timings) // 2] / 1000,
+            'p99': timings[int(len(timings) * 0.99)] / 1000,
+            'allowed': allowed,
+        }
+
+    def handle(self, *args, **options):
+        requests = make_requests(options['keys'])
+        with tempfile.TemporaryDirectory() as tmp:
+            backends = [
+                ('cache', ''),
+                ('shared', os.path.join(tmp, 'throttle.sqlite3')),
+            ]
+            self.stdout.write(f'{"backend":<8} {"mean us":>9} {"p50 us":>9} {"p99 us":>9} {"allowed":>8}')
+            for name, throttle_db in backends:
+                cache.clear()
+                result = self.measure(throttle_db, requests, options['rate'], options['checks'])
+                self.stdout.write(
+                    f'{name:<8} {result["mean"]:>9.1f} {result["p50"]:>9.1f} '
+                    f'{result["p99"]:>9.1f} {result["allowed"]:>8}'
+                )
+
+            # One client hammering N processes: how many requests get through?
+            limit = int(options['rate'].split('/')[0])
+            context = multiprocessing.get_context('fork')
+            self.stdout.write(f'\nOne client, {options["processes"]} processes, limit {options["rate"]}:')
+            enforce_backends = [
+                ('cache', ''),
+                # A fresh file, so children never share the parent's SQLite connection
+                ('shared', os.path.join(tmp, 'enforce.sqlite3')),
+            ]
+            for name, throttle_db in enforce_backends:
+                cache.clear()
+                args = [(options['rate'], limit * 2, throttle_db)] * options['processes']
+                with context.Pool(options['processes']) as pool:
+                    allowed = sum(pool.starmap(allowed_in_process, args))
+                self.stdout.write(f'{name:<8} allowed {allowed} (limit {limit})')
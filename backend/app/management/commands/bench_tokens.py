@@ -0,0 +1,55 @@
+import time
+import uuid
+
+from django.core.cache import cache
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import override_settings
+from django.utils import timezone
+
+from app.authentication import CustomTokenAuthentication, create_session_token, token_usage
+from app.middleware import QueryTimer
+from app.models import User, Token as CustomToken
+
+class Command(BaseCommand):
+    help = 'Compares issuing and checking DB-backed session tokens with signed ones'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--tokens', type=int, default=1000, help='Tokens issued per mode')
+        parser.add_argument('--uses', type=int, default=10, help='Authenticated requests per token')
+
+    def measure(self, fn, items):
+        queries = QueryTimer()
+        with connection.execute_wrapper(queries):
+            start = time.perf_counter()
+            for item in items:
+                fn(item)
+            elapsed = time.perf_counter() - start
+        return elapsed * 1e6 / len(items), queries.count / len(items)
+
+    def handle(self, *args, **options):
+        user, _ = User.objects.get_or_create(email=f'bench-{uuid.uuid4().hex[:8]}@example.com')
+        authentication = CustomTokenAuthentication()
+        count, uses = options['tokens'], options['uses']
+        self.stdout.write(f'{count} tokens, {uses} uses each')
+        self.stdout.write(f'{"mode":<7} {"step":<10} {"µs/op":>9} {"queries/op":>11}')
+        try:
+            for mode, signed in (('db', False), ('signed', True)):
+                cache.clear()
+                with override_settings(OTS_SIGNED_TOKENS=signed):
+                    keys = []
+                    results = [
+                        ('issue', self.measure(
+                            lambda _: keys.append(create_session_token(user, timezone.now())[0]), range(count)
+                        )),
+                        # First request with each token: nothing cached yet
+                        ('first use', self.measure(authentication.authenticate_credentials, keys)),
+                        ('reuse', self.measure(authentication.authenticate_credentials, keys * (uses - 1) or keys)),
+                    ]
+                    token_usage.flush()
+                for step, (micros, queries) in results:
+                    self.stdout.write(f'{mode:<7} {step:<10} {micros:>9.1f} {queries:>11.2f}')
+        finally:
+            CustomToken.objects.filter(user=user).delete()
+            user.delete()
+            cache.clear()
@@ -1,13 +1,45 @@
+from collections import Counter
+
 from django.core.management.base import BaseCommand
-from django.contrib.auth import get_user_model
 
-User = get_user_model()
+from app.models import User, Secret, Token as CustomToken
+from app.retention import inactive_users, purge_inactive_users
 
 class Command(BaseCommand):
-    help = 'Deletes user accounts that have been inactive for 30 days'
+    help = 'Deletes user accounts (and everything they own) that have been inactive for a number of days'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=30,
+                            help='Delete users who have not logged in for this many days')
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Users deleted per transaction')
+        parser.add_argument('--max-runtime', type=float, default=None,
+                            help='Stop after the batch that passes this many seconds; rerun to continue')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be deleted')
 
     def handle(self, *args, **options):
-        count = User.cleanup_inactive_users()
+        if options['dry_run']:
+            users = inactive_users(options['days'])
+            count = users.count()
+            secrets = Secret.objects.filter(user__in=users.values('pk')).count()
+            tokens = CustomToken.objects.filter(user__in=users.values('pk')).count()
+            self.stdout.write(f'Would delete {count} inactive users with {secrets} secrets and {tokens} tokens')
+            return
+
+        total_users, totals = 0, Counter()
+        batches = purge_inactive_users(
+            days=options['days'],
+            batch_size=options['batch_size'],
+            max_runtime=options['max_runtime'],
+        )
+        for users, deleted, last_pk in batches:
+            total_users += users
+            totals.update(deleted)
+            dependents = ', '.join(f'{count} {label}' for label, count in sorted(deleted.items())
+                                   if count and label != User._meta.label)
+            self.stdout.write(f'Deleted {users} users ({dependents}), last id {last_pk}')
+
         self.stdout.write(
-            self.style.SUCCESS(f'Successfully deleted {count} inactive user accounts')
-        ) 
\ No newline at end of file
+            self.style.SUCCESS(f'Successfully deleted {total_users} inactive user accounts')
+        )
@@ -0,0 +1,37 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from app.metrics import metrics
+from app.outbox import MAX_ATTEMPTS, deliver_batch, outbox_stats
+
+class Command(BaseCommand):
+    help = 'Sends queued emails from the outbox'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help='Emails sent per mail connection')
+        parser.add_argument('--max-attempts', type=int, default=MAX_ATTEMPTS)
+        parser.add_argument('--loop', action='store_true',
+                            help='Keep running and poll for new emails')
+        parser.add_argument('--interval', type=float, default=1.0,
+                            help='Seconds to wait when the outbox is empty (with --loop)')
+        parser.add_argument('--stats', action='store_true',
+                            help='Only print queue depth and exit')
+
+    def handle(self, *args, **options):
+        if options['stats']:
+            for name, value in outbox_stats(options['max_attempts']).items():
+                self.stdout.write(f'{name}: {value}')
+            return
+
+        while True:
+            sent, failed = deliver_batch(options['batch_size'], options['max_attempts'])
+            if sent or failed:
+                self.stdout.write(f'Sent {sent} emails, {failed} failed')
+            if metrics.flush_due():
+                metrics.flush_quietly()
+            if not options['loop']:
+                break
+            if sent + failed < options['batch_size']:
+                time.sleep(options['interval'])
@@ -0,0 +1,42 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand, CommandError
+
+from app.partitions import create_partitions, drop_expired_partitions, expired_partitions, partition_secrets
+
+class Command(BaseCommand):
+    help = 'Creates upcoming daily secret partitions and drops expired ones (PostgreSQL)'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--setup', action='store_true',
+                            help='First convert the secret table into partitions (locks it while copying)')
+        parser.add_argument('--days-ahead', type=int, default=None,
+                            help='Days of partitions to keep ready (default: OTS_MAX_EXPIRY plus 2)')
+        parser.add_argument('--grace-minutes', type=int, default=None,
+                            help='Only drop days that ended longer ago than this (default: OTS_PURGE_GRACE)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report which partitions would be dropped')
+
+    def handle(self, *args, **options):
+        grace = None
+        if options['grace_minutes'] is not None:
+            grace = timedelta(minutes=options['grace_minutes'])
+        try:
+            if options['dry_run']:
+                for name in expired_partitions(grace).values():
+                    self.stdout.write(f'Would drop {name}')
+                return
+            if options['setup']:
+                if partition_secrets(options['days_ahead']):
+                    self.stdout.write('Converted the secret table into daily partitions')
+                else:
+                    self.stdout.write('The secret table is already partitioned')
+            for name in create_partitions(options['days_ahead']):
+                self.stdout.write(f'Created {name}')
+            dropped = 0
+            for name, rows in drop_expired_partitions(grace):
+                dropped += 1
+                self.stdout.write(f'Dropped {name} ({rows} secrets)')
+        except ValueError as e:
+            raise CommandError(str(e))
+        self.stdout.write(self.style.SUCCESS(f'Successfully dropped {dropped} expired partitions'))
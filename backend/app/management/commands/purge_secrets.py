@@ -0,0 +1,50 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+from django.db.models import Sum
+
+from app.retention import PURGE_DELETE, PURGE_SCRUB, purge_secrets, purgeable_secrets, payload_size
+
+class Command(BaseCommand):
+    help = 'Deletes or scrubs viewed, destroyed and expired secrets in batches'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--mode', choices=[PURGE_DELETE, PURGE_SCRUB], default=PURGE_DELETE,
+                            help='Delete rows, or only wipe their encrypted payload')
+        parser.add_argument('--grace-minutes', type=int, default=None,
+                            help='Only purge secrets consumed/expired longer ago than this (default: OTS_PURGE_GRACE)')
+        parser.add_argument('--batch-size', type=int, default=1000)
+        parser.add_argument('--sleep', type=float, default=0,
+                            help='Seconds to pause between batches')
+        parser.add_argument('--start-after', default=None,
+                            help='Resume after this secret id (as printed by a previous run)')
+        parser.add_argument('--dry-run', action='store_true',
+                            help='Only report what would be purged')
+
+    def handle(self, *args, **options):
+        grace = None
+        if options['grace_minutes'] is not None:
+            grace = timedelta(minutes=options['grace_minutes'])
+
+        if options['dry_run']:
+            totals = purgeable_secrets(grace).aggregate(bytes=Sum(payload_size()))
+            count = purgeable_secrets(grace).count()
+            self.stdout.write(f'Would purge {count} secrets ({totals["bytes"] or 0} bytes)')
+            return
+
+        total_rows = total_bytes = 0
+        batches = purge_secrets(
+            mode=options['mode'],
+            grace=grace,
+            batch_size=options['batch_size'],
+            sleep=options['sleep'],
+            start_after=options['start_after'],
+        )
+        for rows, size, last_pk in batches:
+            total_rows += rows
+            total_bytes += size
+            self.stdout.write(f'Purged {rows} secrets ({size} bytes), last id {last_pk}')
+
+        self.stdout.write(
+            self.style.SUCCESS(f'Successfully purged {total_rows} secrets, reclaimed {total_bytes} bytes')
+        )
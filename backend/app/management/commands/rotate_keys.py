@@ -0,0 +1,63 @@
+import time
+
+from django.core.management.base import BaseCommand
+from django.db import connections, router, transaction
+
+from app.keyring import rewrap_key, wrap_key
+from app.models import Secret
+
+class Command(BaseCommand):
+    help = 'Re-wraps every secret data key with the primary OTS_MASTER_KEYS key'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=2000)
+
+    def flush(self, batch):
+        """Write one batch of (pk, key) pairs as a single executemany.
+
+        bulk_update() would build a CASE with one branch per row, which gets
+        quadratically slower with the batch size.
+        """
+        if not batch:
+            return 0
+        using = router.db_for_write(Secret)
+        connection = connections[using]
+        meta = Secret._meta
+        qn = connection.ops.quote_name
+        sql = (
+            f'UPDATE {qn(meta.db_table)} SET {qn(meta.get_field("encryption_key").column)} = %s, '
+            f'{qn(meta.get_field("key_wrapped").column)} = %s WHERE {qn(meta.pk.column)} = %s'
+        )
+        key_field = meta.get_field('encryption_key')
+        params = [
+            (key_field.get_db_prep_value(key, connection), True, meta.pk.get_db_prep_value(pk, connection))
+            for pk, key in batch
+        ]
+        with transaction.atomic(using=using), connection.cursor() as cursor:
+            cursor.executemany(sql, params)
+        return len(batch)
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        start = time.monotonic()
+        scanned = rotated = 0
+        batch = []
+        # Only the small key column is read; iterator() streams it through a
+        # server-side cursor where the backend has one
+        keys = Secret.objects.exclude(encryption_key=b'').values_list(
+            'pk', 'encryption_key', 'key_wrapped'
+        ).iterator(chunk_size=batch_size)
+        for pk, key, wrapped in keys:
+            scanned += 1
+            new_key = rewrap_key(key) if wrapped else wrap_key(bytes(key))
+            if new_key is not None:
+                batch.append((pk, new_key))
+            if len(batch) >= batch_size:
+                rotated += self.flush(batch)
+                batch = []
+                self.stdout.write(f'Scanned {scanned}, re-wrapped {rotated}')
+        rotated += self.flush(batch)
+
+        self.stdout.write(self.style.SUCCESS(
+            f'Re-wrapped {rotated} of {scanned} secret keys in {time.monotonic() - start:.1f}s'
+        ))
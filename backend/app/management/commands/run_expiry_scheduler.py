@@ -0,0 +1,46 @@
+import signal
+import threading
+
+from django.core.management.base import BaseCommand
+from django.utils import timezone
+
+from app.metrics import metrics
+from app.retention import expire_due_secrets, next_expiry
+
+# Shortest wait between rounds, e.g. while another node holds the due batch
+MIN_SLEEP = 0.5
+
+class Command(BaseCommand):
+    help = 'Destroys secrets as they expire; several nodes can run it at once'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help='Secrets destroyed per transaction')
+        parser.add_argument('--max-sleep', type=float, default=60.0,
+                            help='Longest wait in seconds, so new short-lived secrets are not missed')
+        parser.add_argument('--once', action='store_true',
+                            help='Destroy everything that is due, then exit')
+
+    def handle(self, *args, **options):
+        stop = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        batch_size, total = options['batch_size'], 0
+        while not stop.is_set():
+            destroyed = expire_due_secrets(batch_size)
+            total += destroyed
+            if destroyed:
+                self.stdout.write(f'Destroyed {destroyed} expired secrets')
+            if metrics.flush_due():
+                metrics.flush_quietly()
+            if destroyed == batch_size:
+                continue
+            if options['once']:
+                break
+            # Sleep until the next secret is due rather than polling
+            due = next_expiry()
+            wait = options['max_sleep']
+            if due is not None:
+                wait = min(max((due - timezone.now()).total_seconds(), MIN_SLEEP), wait)
+            stop.wait(wait)
+        self.stdout.write(self.style.SUCCESS(f'Successfully destroyed {total} expired secrets'))
@@ -0,0 +1,170 @@
+"""Prometheus-style metrics that add up across all worker processes.
+
+Each process counts in memory and adds its counts to a shared SQLite (WAL)
+file every few seconds, the same way the throttle store shares its
+counters. /api/metrics renders the totals from that file, so any worker can
+answer a scrape for all of them; another worker's most recent requests show
+up after its next flush.
+"""
+import atexit
+import logging
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+from .sqlite_store import SharedSQLiteStore, get_shared_store
+
+# Seconds; Prometheus' default buckets
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+COUNTER = 'counter'
+HISTOGRAM = 'histogram'
+
+# name: (type, help)
+METRICS = {
+    'ots_http_requests_total': (COUNTER, 'Requests handled, by action, method and status'),
+    'ots_http_request_duration_seconds': (HISTOGRAM, 'Time to build the response, by action'),
+    'ots_db_queries_total': (COUNTER, 'Database queries run while handling requests, by action'),
+    'ots_db_query_duration_seconds': (HISTOGRAM, 'Time spent in database queries per request, by action'),
+    'ots_crypto_duration_seconds': (HISTOGRAM, 'Time spent encrypting, decrypting and hashing passphrases'),
+    'ots_throttle_rejections_total': (COUNTER, 'Requests rejected by a rate limit, by scope'),
+    'ots_secrets_expired_total': (COUNTER, 'Secrets destroyed by the expiry scheduler'),
+    'ots_email_send_duration_seconds': (HISTOGRAM, 'Time to hand an email to the mail server, by result'),
+}
+
+def format_labels(labels):
+    def escape(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+    return ','.join(f'{key}="{escape(value)}"' for key, value in sorted(labels.items()))
+
+class SharedMetricsStore(SharedSQLiteStore):
+    """Totals of every process in a SQLite file, one row per counter or
+    histogram bucket (buckets are stored non-cumulative)"""
+    schema = (
+        'CREATE TABLE IF NOT EXISTS metrics (name TEXT, labels TEXT, le TEXT, value REAL NOT NULL, '
+        'PRIMARY KEY (name, labels, le)) WITHOUT ROWID'
+    )
+
+    def add(self, rows):
+        """Add ``(name, labels, le, value)`` increments in one transaction"""
+        connection = self.connection
+        with connection:
+            connection.execute('BEGIN IMMEDIATE')
+            connection.executemany(
+                'INSERT INTO metrics (name, labels, le, value) VALUES (?, ?, ?, ?) '
+                'ON CONFLICT(name, labels, le) DO UPDATE SET value = value + excluded.value',
+                rows,
+            )
+
+    def rows(self):
+        return self.connection.execute('SELECT name, labels, le, value FROM metrics').fetchall()
+
+    def clear(self):
+        self.connection.execute('DELETE FROM metrics')
+
+class MetricsRegistry:
+    """In-memory counts of this process, flushed to the shared store"""
+
+    def __init__(self, flush_interval=10):
+        self.flush_interval = flush_interval
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._last_flush = time.monotonic()
+
+    def _add(self, key, value):
+        with self._lock:
+            self._pending[key] = self._pending.get(key, 0) + value
+
+    def inc(self, name, value=1, **labels):
+        self._add((name, format_labels(labels), ''), value)
+
+    def observe(self, name, seconds, **labels):
+        labels = format_labels(labels)
+        le = next((str(bound) for bound in DURATION_BUCKETS if seconds <= bound), '+Inf')
+        with self._lock:
+            for key, value in (((name, labels, le), 1), ((name, labels, 'sum'), seconds), ((name, labels, 'count'), 1)):
+                self._pending[key] = self._pending.get(key, 0) + value
+
+    @contextmanager
+    def timer(self, name, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def flush_due(self):
+        return time.monotonic() - self._last_flush >= self.flush_interval
+
+    def flush(self):
+        """Add this process' counts to the shared store; returns the rows written"""
+        store = get_metrics_store()
+        if store is None:
+            return 0
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            self._last_flush = time.monotonic()
+        if not pending:
+            return 0
+        try:
+            store.add([(*key, value) for key, value in pending.items()])
+        except sqlite3.Error:
+            # Keep the counts for the next flush rather than losing them
+            with self._lock:
+                for key, value in pending.items():
+                    self._pending[key] = self._pending.get(key, 0) + value
+            raise
+        return len(pending)
+
+    def flush_quietly(self):
+        """flush() for callers that must carry on when the shared store can't
+        be written (requests, worker loops); the counts wait for the next try"""
+        try:
+            return self.flush()
+        except sqlite3.Error:
+            logger.exception('Could not write metrics to %s', settings.OTS_METRICS_DB)
+            return 0
+
+    def totals(self):
+        """{(name, labels, le): value} over all processes"""
+        store = get_metrics_store()
+        if store is None:
+            with self._lock:
+                return dict(self._pending)
+        self.flush()
+        return {(name, labels, le): value for name, labels, le, value in store.rows()}
+
+    def render(self):
+        """The totals in the Prometheus text exposition format"""
+        series = {}
+        for (name, labels, le), value in self.totals().items():
+            series.setdefault(name, {}).setdefault(labels, {})[le] = value
+
+        lines = []
+        for name, (kind, help_text) in METRICS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            for labels, values in sorted(series.get(name, {}).items()):
+                if kind == COUNTER:
+                    lines.append(f'{name}{{{labels}}} {values[""]:g}')
+                    continue
+                prefix = f'{labels},' if labels else ''
+                cumulative = 0
+                for le in [*map(str, DURATION_BUCKETS), '+Inf']:
+                    cumulative += values.get(le, 0)
+                    lines.append(f'{name}_bucket{{{prefix}le="{le}"}} {cumulative:g}')
+                lines.append(f'{name}_sum{{{labels}}} {values.get("sum", 0):.6f}')
+                lines.append(f'{name}_count{{{labels}}} {values.get("count", 0):g}')
+        return '\n'.join(lines) + '\n'
+
+def get_metrics_store():
+    """The shared store for OTS_METRICS_DB, or None to keep metrics per process"""
+    return get_shared_store(SharedMetricsStore, settings.OTS_METRICS_DB)
+
+metrics = MetricsRegistry()
+atexit.register(metrics.flush_quietly)
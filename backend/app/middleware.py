@@ -0,0 +1,96 @@
+import time
+from contextvars import ContextVar
+
+from asgiref.sync import iscoroutinefunction, markcoroutinefunction, sync_to_async
+
+from .metrics import metrics
+
+# The QueryTimer of the request being served. A context variable rather
+# than a per-request execute_wrapper: the async ORM runs its queries in
+# another thread, on another connection, but sync_to_async carries the
+# context over.
+_request_queries = ContextVar('ots_request_queries', default=None)
+
+class QueryTimer:
+    """execute_wrapper that counts and times the queries of one request"""
+
+    def __init__(self):
+        self.count = 0
+        self.duration = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.duration += time.perf_counter() - start
+            self.count += 1
+
+def time_query(execute, sql, params, many, context):
+    """execute_wrapper on every connection; counts into the current
+    request's QueryTimer, if there is one"""
+    queries = _request_queries.get()
+    if queries is None:
+        return execute(sql, params, many, context)
+    return queries(execute, sql, params, many, context)
+
+def install_query_timer(sender, connection, **kwargs):
+    """connection_created receiver"""
+    if time_query not in connection.execute_wrappers:
+        # Outermost, so a query's time includes any lock retries. Django's
+        # execute_wrapper() context pops the last wrapper when it exits, so
+        # a permanent one must not be appended after such a context's.
+        connection.execute_wrappers.insert(0, time_query)
+
+class MetricsMiddleware:
+    """Request counts, latency and DB time per view action"""
+    sync_capable = True
+    async_capable = True
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        if iscoroutinefunction(get_response):
+            markcoroutinefunction(self)
+
+    def process_view(self, request, view_func, view_args, view_kwargs):
+        # Viewsets map the method to an action (list, retrieve, login, ...)
+        actions = getattr(view_func, 'actions', None)
+        if actions:
+            request.metrics_action = actions.get(request.method.lower(), 'unknown')
+        else:
+            request.metrics_action = view_func.__name__
+
+    def start(self):
+        queries = QueryTimer()
+        return queries, _request_queries.set(queries), time.perf_counter()
+
+    def record(self, request, response, queries, start):
+        action = getattr(request, 'metrics_action', 'unmatched')
+        metrics.observe('ots_http_request_duration_seconds', time.perf_counter() - start, action=action)
+        metrics.inc('ots_http_requests_total', action=action, method=request.method, status=response.status_code)
+        metrics.inc('ots_db_queries_total', queries.count, action=action)
+        metrics.observe('ots_db_query_duration_seconds', queries.duration, action=action)
+
+    def __call__(self, request):
+        if iscoroutinefunction(self):
+            return self.__acall__(request)
+        queries, token, start = self.start()
+        try:
+            response = self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, queries, start)
+        if metrics.flush_due():
+            metrics.flush_quietly()
+        return response
+
+    async def __acall__(self, request):
+        queries, token, start = self.start()
+        try:
+            response = await self.get_response(request)
+        finally:
+            _request_queries.reset(token)
+        self.record(request, response, queries, start)
+        if metrics.flush_due():
+            await sync_to_async(metrics.flush_quietly)()
+        return response
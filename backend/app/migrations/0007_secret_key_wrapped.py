@@ -0,0 +1,18 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:22
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0006_secret_blob_name_secret_content_type_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='secret',
+            name='key_wrapped',
+            field=models.BooleanField(default=False),
+        ),
+    ]
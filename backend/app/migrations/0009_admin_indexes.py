@@ -0,0 +1,29 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:53
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0008_user_tokens_valid_after'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['-created_at'], name='app_otp_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='otp',
+            index=models.Index(fields=['is_used', '-created_at'], name='app_otp_used_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='secret',
+            index=models.Index(fields=['-created_at'], name='app_secret_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='secret',
+            index=models.Index(fields=['is_viewed', 'is_destroyed', '-created_at'], name='app_secret_status_created_idx'),
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:56
+
+import django.db.models.deletion
+from django.conf import settings
+from django.db import migrations, models
+
+
+def count_existing_secrets(apps, schema_editor):
+    Secret = apps.get_model('app', 'Secret')
+    SecretCounts = apps.get_model('app', 'SecretCounts')
+    totals = (
+        Secret.objects.using(schema_editor.connection.alias)
+        .values('user')
+        .annotate(created=models.Count('pk'), viewed=models.Count('pk', filter=models.Q(is_viewed=True)))
+        .order_by()
+    )
+    SecretCounts.objects.using(schema_editor.connection.alias).bulk_create(
+        [SecretCounts(user_id=row['user'], created=row['created'], viewed=row['viewed']) for row in totals.iterator()],
+        batch_size=1000,
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0009_admin_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SecretCounts',
+            fields=[
+                ('user', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='secret_counts', serialize=False, to=settings.AUTH_USER_MODEL)),
+                ('created', models.PositiveIntegerField(default=0)),
+                ('viewed', models.PositiveIntegerField(default=0)),
+                ('burned', models.PositiveIntegerField(default=0)),
+            ],
+        ),
+        migrations.AddField(
+            model_name='secret',
+            name='burned_at',
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='secret',
+            index=models.Index(condition=models.Q(('burned_at', None), ('is_viewed', False)), fields=['user', 'expires_at'], name='app_secret_unviewed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='secret',
+            index=models.Index(condition=models.Q(('is_viewed', True)), fields=['user', '-created_at'], name='app_secret_viewed_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='secret',
+            index=models.Index(condition=models.Q(('burned_at__isnull', False)), fields=['user', '-created_at'], name='app_secret_burned_idx'),
+        ),
+        migrations.RunPython(count_existing_secrets, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.18 on 2026-10-18 04:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('app', '0010_secret_status_counts'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='secret',
+            index=models.Index(condition=models.Q(('is_destroyed', False), ('is_viewed', False)), fields=['expires_at'], name='app_secret_pending_expiry_idx'),
+        ),
+    ]
@@ -1,11 +1,17 @@
-from django.db import models
+from asgiref.sync import sync_to_async
+from django.db import IntegrityError, models, connections, router, transaction
+from django.db.models import F, Q
 from django.contrib.auth.models import AbstractUser, BaseUserManager
 from django.utils import timezone
 from django.conf import settings
 import uuid
 from cryptography.fernet import Fernet
 import base64
-from datetime import timedelta
+
+from . import blobstore
+from . import kdf
+from .metrics import metrics
+from .keyring import unwrap_key, wrap_key
 
 class UserManager(BaseUserManager):
     def create_user(self, email, password=None, **extra_fields):
@@ -27,6 +33,8 @@ class User(AbstractUser):
     username = None
     email = models.EmailField('email address', unique=True)
     last_login_at = models.DateTimeField(null=True, blank=True)
+    # Signed session tokens issued before this moment are revoked
+    tokens_valid_after = models.DateTimeField(null=True, blank=True)
     
     USERNAME_FIELD = 'email'
     REQUIRED_FIELDS = []
@@ -35,19 +43,13 @@ class User(AbstractUser):
 
     def update_last_login(self):
         self.last_login_at = timezone.now()
-        self.save()
+        self.save(update_fields=['last_login_at'])
 
     @classmethod
-    def cleanup_inactive_users(cls, days=30):
+    def cleanup_inactive_users(cls, days=30, batch_size=500):
         """Delete users who haven't logged in for the specified number of days"""
-        cutoff_date = timezone.now() - timedelta(days=days)
-        inactive_users = cls.objects.filter(
-            last_login_at__lt=cutoff_date,
-            is_superuser=False  # Don't delete admin users
-        )
-        count = inactive_users.count()
-        inactive_users.delete()
-        return count
+        from .retention import purge_inactive_users
+        return sum(users for users, _, _ in purge_inactive_users(days, batch_size))
 
 class Token(models.Model):
     user = models.ForeignKey(User, on_delete=models.CASCADE)
@@ -74,6 +76,8 @@ class OTP(models.Model):
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
     is_used = models.BooleanField(default=False)
+    # Guesses at this code so far, counted by ModelOTPStore
+    attempts = models.PositiveSmallIntegerField(default=0)
 
     def is_valid(self):
         return (
@@ -84,23 +88,213 @@ class OTP(models.Model):
     def __str__(self):
         return f"OTP for {self.user.email}"
 
+    class Meta:
+        indexes = [
+            # Admin changelist: newest first, optionally by status
+            models.Index(fields=['-created_at'], name='app_otp_created_idx'),
+            models.Index(fields=['is_used', '-created_at'], name='app_otp_used_created_idx'),
+        ]
+
+def supports_update_returning(connection):
+    """Whether the backend can run UPDATE ... RETURNING"""
+    if connection.vendor == 'postgresql':
+        return True
+    if connection.vendor == 'sqlite':
+        # SQLite gained RETURNING in 3.35, same as for INSERT
+        return connection.features.can_return_columns_from_insert
+    return False
+
+SECRET_STATUSES = ('active', 'viewed', 'burned', 'expired')
+
+class SecretQuerySet(models.QuerySet):
+    def live(self, now=None):
+        """Secrets that have not been viewed, destroyed or expired yet"""
+        return self.filter(
+            is_viewed=False,
+            is_destroyed=False,
+            expires_at__gt=now or timezone.now(),
+        )
+
+    def with_status(self, status, now=None):
+        """Secrets in one of SECRET_STATUSES; per user, each status has a partial index"""
+        now = now or timezone.now()
+        if status == 'active':
+            return self.live(now).filter(burned_at=None)
+        if status == 'viewed':
+            return self.filter(is_viewed=True)
+        if status == 'burned':
+            return self.filter(burned_at__isnull=False)
+        if status == 'expired':
+            return self.filter(is_viewed=False, burned_at=None, expires_at__lte=now)
+        raise ValueError(f"Unknown status: {status}")
+
+    def claim(self, pk, now=None, allow_passphrase=True):
+        """Mark a live secret as viewed in one conditional UPDATE.
+
+        Only the caller whose UPDATE actually flipped ``is_viewed`` gets the
+        row back (including the ciphertext); every other caller gets None.
+        """
+        now = now or timezone.now()
+        using = self._db or router.db_for_write(self.model)
+        connection = connections[using]
+        if supports_update_returning(connection):
+            return self._claim_returning(connection, using, pk, now, allow_passphrase)
+        return self._claim_locked(using, pk, now, allow_passphrase)
+
+    def _claim_returning(self, connection, using, pk, now, allow_passphrase):
+        meta = self.model._meta
+        qn = connection.ops.quote_name
+        fields = meta.concrete_fields
+
+        def column(name):
+            return qn(meta.get_field(name).column)
+
+        sql = (
+            f'UPDATE {qn(meta.db_table)} SET {column("is_viewed")} = %s '
+            f'WHERE {column("id")} = %s AND {column("is_viewed")} = %s '
+            f'AND {column("is_destroyed")} = %s AND {column("expires_at")} > %s'
+        )
+        params = [
+            True,
+            meta.pk.get_db_prep_value(meta.pk.to_python(pk), connection),
+            False,
+            False,
+            meta.get_field('expires_at').get_db_prep_value(now, connection),
+        ]
+        if not allow_passphrase:
+            sql += f' AND {column("has_passphrase")} = %s'
+            params.append(False)
+        sql += ' RETURNING ' + ', '.join(qn(field.column) for field in fields)
+
+        with connection.cursor() as cursor:
+            cursor.execute(sql, params)
+            row = cursor.fetchone()
+        if row is None:
+            return None
+
+        # Run the same converters the ORM would apply to a SELECT
+        values = []
+        for field, value in zip(fields, row):
+            col = field.get_col(meta.db_table)
+            converters = connection.ops.get_db_converters(col) + field.get_db_converters(connection)
+            for converter in converters:
+                value = converter(value, col, connection)
+            values.append(value)
+        return self.model.from_db(using, [field.attname for field in fields], values)
+
+    def _claim_locked(self, using, pk, now, allow_passphrase):
+        queryset = self.using(using).live(now).filter(pk=pk)
+        if not allow_passphrase:
+            queryset = queryset.filter(has_passphrase=False)
+        with transaction.atomic(using=using):
+            secret = queryset.select_for_update().first()
+            # The conditional UPDATE decides the winner even where
+            # SELECT ... FOR UPDATE is a no-op
+            if secret is None or not queryset.update(is_viewed=True):
+                return None
+        secret.is_viewed = True
+        return secret
+
+    def consume(self, pk, passphrase=None):
+        """View a secret exactly once.
+
+        Returns ``(secret, message)`` to the single winning caller (``message``
+        is None for file secrets) and raises
+        ``ValueError`` (or ``DoesNotExist``) for everyone else.
+        """
+        now = timezone.now()
+        # Everything here runs on the primary, never on a lagging replica
+        using = self._db or router.db_for_write(self.model)
+        if passphrase:
+            # Verify before claiming so a wrong passphrase never burns the secret
+            secret = self.using(using).live(now).filter(pk=pk).only('has_passphrase', 'passphrase_hash').first()
+            if secret is not None and not secret.check_passphrase(passphrase):
+                raise ValueError("Invalid passphrase")
+        with transaction.atomic(using=using):
+            secret = self.claim(pk, now=now, allow_passphrase=bool(passphrase))
+            if secret is not None:
+                SecretCounts.add(secret.user_id, viewed=1)
+        if secret is None:
+            raise self._unavailable_reason(pk, now)
+        if secret.is_file:
+            # File contents are streamed by the caller with iter_file()
+            return secret, None
+        return secret, secret.read_message()
+
+    async def aconsume(self, pk, passphrase=None):
+        """Async version of consume().
+
+        The claim is a conditional UPDATE; only its winner reads the row
+        back, so the ciphertext still goes to exactly one caller.
+        """
+        now = timezone.now()
+        using = self._db or router.db_for_write(self.model)
+        if passphrase:
+            secret = await self.using(using).live(now).filter(pk=pk).only('has_passphrase', 'passphrase_hash').afirst()
+            if secret is not None and not await secret.acheck_passphrase(passphrase):
+                raise ValueError("Invalid passphrase")
+        claimable = self.live(now).filter(pk=pk)
+        if not passphrase:
+            claimable = claimable.filter(has_passphrase=False)
+        secret = await sync_to_async(self._claim_counted)(claimable, pk)
+        if secret is None:
+            raise await sync_to_async(self._unavailable_reason)(pk, now)
+        if secret.is_file:
+            return secret, None
+        return secret, secret.read_message()
+
+    def _claim_counted(self, claimable, pk):
+        """Claim, read back and count the secret in one transaction"""
+        with transaction.atomic(using=self._db or router.db_for_write(self.model)):
+            if not claimable.update(is_viewed=True):
+                return None
+            secret = self.get(pk=pk)
+            SecretCounts.add(secret.user_id, viewed=1)
+        return secret
+
+    def _unavailable_reason(self, pk, now):
+        """Work out why a claim failed; only runs on the error path"""
+        secret = self.filter(pk=pk).only(
+            'is_viewed', 'is_destroyed', 'expires_at', 'has_passphrase'
+        ).first()
+        if secret is None:
+            return self.model.DoesNotExist("Secret matching query does not exist.")
+        if secret.is_viewed or secret.is_destroyed:
+            return ValueError("This secret has already been viewed or destroyed")
+        if secret.expires_at <= now:
+            self.filter(pk=pk, is_destroyed=False).update(is_destroyed=True)
+            return ValueError("This secret has expired")
+        return ValueError("Passphrase required")
+
 class Secret(models.Model):
     id = models.UUIDField(primary_key=True, default=uuid.uuid4, editable=False)
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     encrypted_message = models.BinaryField()
+    # The per-secret data key, wrapped with the OTS_MASTER_KEYS keyring
+    # (rows from before envelope encryption hold it in plaintext)
     encryption_key = models.BinaryField()
+    key_wrapped = models.BooleanField(default=False)
     has_passphrase = models.BooleanField(default=False)
     passphrase_hash = models.BinaryField(null=True, blank=True)
     created_at = models.DateTimeField(auto_now_add=True)
     expires_at = models.DateTimeField()
     is_viewed = models.BooleanField(default=False)
     is_destroyed = models.BooleanField(default=False)
+    # Set when the owner burns the secret (is_destroyed also covers expiry)
+    burned_at = models.DateTimeField(null=True, blank=True)
     destruction_animation = models.CharField(max_length=20, default='none', choices=[
         ('none', 'No Animation'),
         ('fire', 'Fire'),
         ('explode', 'Explode'),
         ('shred', 'Shred')
     ])
+    # File secrets keep their ciphertext in the blob store, not in this row
+    blob_name = models.CharField(max_length=64, blank=True)
+    file_name = models.CharField(max_length=255, blank=True)
+    content_type = models.CharField(max_length=100, blank=True)
+    file_size = models.PositiveBigIntegerField(null=True, blank=True)
+
+    objects = SecretQuerySet.as_manager()
 
     @property
     def is_expired(self):
@@ -108,22 +302,58 @@ class Secret(models.Model):
         return timezone.now() > self.expires_at
 
     def encrypt_message(self, message, passphrase=None):
-        # Generate a unique encryption key for this secret
+        with metrics.timer('ots_crypto_duration_seconds', operation='encrypt'):
+            # Generate a unique encryption key for this secret
+            key = Fernet.generate_key()
+            f = Fernet(key)
+
+            # Encrypt the message
+            encrypted_data = f.encrypt(message.encode())
+
+            # Store the encrypted message and the wrapped key
+            self.encrypted_message = encrypted_data
+            self.set_data_key(key)
+        self.set_passphrase(passphrase)
+
+    def encrypt_file(self, uploaded_file, passphrase=None):
+        """Encrypt an uploaded file chunk by chunk into the blob store"""
         key = Fernet.generate_key()
         f = Fernet(key)
-        
-        # Encrypt the message
-        encrypted_data = f.encrypt(message.encode())
-        
-        # Store the encrypted message and key
-        self.encrypted_message = encrypted_data
-        self.encryption_key = key
-        
-        # If passphrase is provided, hash it
+        self.file_size = 0
+
+        def chunks():
+            for chunk in uploaded_file.chunks(blobstore.CHUNK_SIZE):
+                self.file_size += len(chunk)
+                yield chunk
+
+        self.blob_name = self.id.hex
+        blobstore.get_blob_store().save(self.blob_name, blobstore.encrypt_chunks(f, chunks()))
+        self.encrypted_message = b''
+        self.set_data_key(key)
+        self.file_name = uploaded_file.name or ''
+        self.content_type = uploaded_file.content_type or 'application/octet-stream'
+        self.set_passphrase(passphrase)
+
+    def set_data_key(self, key):
+        self.encryption_key = wrap_key(key)
+        self.key_wrapped = True
+
+    def data_key(self):
+        """The plaintext Fernet key of this secret"""
+        if self.key_wrapped:
+            return unwrap_key(self.encryption_key)
+        return bytes(self.encryption_key)
+
+    def set_passphrase(self, passphrase):
+        # If passphrase is provided, hash it (scrypt, on the bounded KDF pool)
         if passphrase:
             self.has_passphrase = True
-            # In a real application, use a proper password hashing algorithm
-            self.passphrase_hash = passphrase.encode()
+            self.passphrase_hash = kdf.hash_passphrase(passphrase)
+
+    async def aset_passphrase(self, passphrase):
+        if passphrase:
+            self.has_passphrase = True
+            self.passphrase_hash = await kdf.ahash_passphrase(passphrase)
 
     def check_passphrase(self, passphrase):
         """Check if the provided passphrase matches the stored hash"""
@@ -131,8 +361,14 @@ class Secret(models.Model):
             return True
         if not passphrase:
             return False
-        # In a real application, use a proper password hash comparison
-        return passphrase.encode() == self.passphrase_hash
+        return kdf.check_passphrase(passphrase, self.passphrase_hash)
+
+    async def acheck_passphrase(self, passphrase):
+        if not self.has_passphrase:
+            return True
+        if not passphrase:
+            return False
+        return await kdf.acheck_passphrase(passphrase, self.passphrase_hash)
 
     def decrypt_message(self, passphrase=None):
         # First check if the secret is already viewed or destroyed
@@ -149,12 +385,11 @@ class Secret(models.Model):
         if self.has_passphrase:
             if not passphrase:
                 raise ValueError("Passphrase required")
-            if passphrase.encode() != self.passphrase_hash:
+            if not self.check_passphrase(passphrase):
                 raise ValueError("Invalid passphrase")
         
         # Finally decrypt the message
-        f = Fernet(self.encryption_key)
-        decrypted_message = f.decrypt(self.encrypted_message).decode()
+        decrypted_message = self.read_message()
         
         # Mark as viewed and save
         self.is_viewed = True
@@ -162,6 +397,43 @@ class Secret(models.Model):
         
         return decrypted_message
 
+    def read_message(self):
+        """Decrypt the stored ciphertext without touching any flags"""
+        with metrics.timer('ots_crypto_duration_seconds', operation='decrypt'):
+            f = Fernet(self.data_key())
+            return f.decrypt(bytes(self.encrypted_message)).decode()
+
+    @property
+    def is_file(self):
+        return bool(self.blob_name)
+
+    def iter_file(self):
+        """Stream the decrypted file, deleting the blob once it has been read
+        (or the client went away), so a file can only be downloaded once"""
+        store = blobstore.get_blob_store()
+        try:
+            with store.open(self.blob_name) as stream:
+                yield from blobstore.decrypt_chunks(Fernet(self.data_key()), stream)
+        finally:
+            store.delete(self.blob_name)
+
+    async def aiter_file(self):
+        """iter_file() for async responses: each chunk is read and decrypted
+        in a thread, so only one chunk at a time is held in memory"""
+        chunks = self.iter_file()
+        next_chunk = sync_to_async(next)
+        try:
+            while (chunk := await next_chunk(chunks, None)) is not None:
+                yield chunk
+        finally:
+            await sync_to_async(chunks.close)()
+
+    def discard_blob(self):
+        """Delete the stored file of a file secret; returns the bytes freed"""
+        if not self.blob_name:
+            return 0
+        return blobstore.get_blob_store().delete(self.blob_name)
+
     def mark_as_viewed(self):
         """Mark the secret as viewed"""
         self.is_viewed = True
@@ -171,6 +443,39 @@ class Secret(models.Model):
         """Destroy the secret"""
         self.is_destroyed = True
         self.save()
+        self.discard_blob()
+
+    def insert(self):
+        """Save a new secret and count it for its owner"""
+        with transaction.atomic(using=router.db_for_write(Secret)):
+            self.save(force_insert=True)
+            SecretCounts.add(self.user_id, created=1)
+
+    async def ainsert(self):
+        await sync_to_async(self.insert)()
+
+    def burn(self, now=None):
+        """Destroy the secret and its payload before anyone views it.
+
+        Returns False if it was already viewed, burned or expired.
+        """
+        now = now or timezone.now()
+        with transaction.atomic(using=router.db_for_write(Secret)):
+            burned = Secret.objects.live(now).filter(pk=self.pk).update(
+                is_destroyed=True,
+                burned_at=now,
+                encrypted_message=b'',
+                encryption_key=b'',
+                passphrase_hash=None,
+                blob_name='',
+            )
+            if burned:
+                SecretCounts.add(self.user_id, burned=1)
+        if not burned:
+            return False
+        self.discard_blob()
+        self.is_destroyed, self.burned_at, self.blob_name = True, now, ''
+        return True
 
     def __str__(self):
         return f"Secret {self.id} by {self.user.email}"
@@ -179,4 +484,70 @@ class Secret(models.Model):
         indexes = [
             models.Index(fields=['user', 'created_at']),
             models.Index(fields=['expires_at']),
+            # Admin changelist: newest first, optionally by status
+            models.Index(fields=['-created_at'], name='app_secret_created_idx'),
+            models.Index(fields=['is_viewed', 'is_destroyed', '-created_at'], name='app_secret_status_created_idx'),
+            # Per-user status lists and counts (SecretQuerySet.with_status)
+            models.Index(fields=['user', 'expires_at'], condition=Q(is_viewed=False, burned_at=None),
+                         name='app_secret_unviewed_idx'),
+            models.Index(fields=['user', '-created_at'], condition=Q(is_viewed=True), name='app_secret_viewed_idx'),
+            models.Index(fields=['user', '-created_at'], condition=Q(burned_at__isnull=False),
+                         name='app_secret_burned_idx'),
+            # The expiry scheduler's queue: only secrets still waiting for a viewer
+            models.Index(fields=['expires_at'], condition=Q(is_viewed=False, is_destroyed=False),
+                         name='app_secret_pending_expiry_idx'),
+        ]
+
+class SecretCounts(models.Model):
+    """Lifetime totals of a user's secrets, updated in the same transaction
+    as the change they count, so a summary never scans the user's history"""
+    user = models.OneToOneField(User, on_delete=models.CASCADE, primary_key=True, related_name='secret_counts')
+    created = models.PositiveIntegerField(default=0)
+    viewed = models.PositiveIntegerField(default=0)
+    burned = models.PositiveIntegerField(default=0)
+
+    @classmethod
+    def add(cls, user_id, **deltas):
+        """Add to the user's totals; call inside the transaction making the change"""
+        increments = {name: F(name) + value for name, value in deltas.items()}
+        if cls.objects.filter(pk=user_id).update(**increments):
+            return
+        try:
+            with transaction.atomic(using=router.db_for_write(cls)):
+                cls.objects.create(user_id=user_id, **deltas)
+        except IntegrityError:
+            # Another transaction created the row first
+            cls.objects.filter(pk=user_id).update(**increments)
+
+    @classmethod
+    def summary(cls, user, now=None):
+        """Counts of the user's secrets by status; only active is counted
+        per call, the rest comes from the counters (see api_doc.md)"""
+        counts = cls.objects.filter(pk=user.pk).first() or cls(user=user)
+        active = Secret.objects.filter(user=user).with_status('active', now).count()
+        return {
+            'active': active,
+            'viewed': counts.viewed,
+            'burned': counts.burned,
+            'expired': max(counts.created - counts.viewed - counts.burned - active, 0),
+            'total': counts.created,
+        }
+
+class OutboxEmail(models.Model):
+    """An email waiting to be delivered by the deliver_outbox worker"""
+    subject = models.CharField(max_length=255)
+    body = models.TextField()
+    from_email = models.CharField(max_length=254, blank=True)
+    recipients = models.JSONField(default=list)
+    created_at = models.DateTimeField(auto_now_add=True)
+    next_attempt_at = models.DateTimeField(default=timezone.now)
+    attempts = models.PositiveIntegerField(default=0)
+    last_error = models.TextField(blank=True)
+
+    def __str__(self):
+        return f"Email to {', '.join(self.recipients)}"
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['next_attempt_at']),
         ]
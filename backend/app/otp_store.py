@@ -0,0 +1,169 @@
+"""Where login OTPs live between `login` and `verify_otp`.
+
+The default CacheOTPStore keeps an HMAC of the code in the cache with a TTL,
+so logins write nothing to the database. ModelOTPStore keeps the old
+behaviour of OTP rows. Both give a user `max_attempts` guesses per code,
+and a code can only be consumed once, even by concurrent requests.
+"""
+import hashlib
+import hmac
+import secrets
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import F
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from .models import OTP
+
+class OTPStore:
+    lifetime = timedelta(minutes=10)
+    max_attempts = 5
+
+    def generate_code(self):
+        return ''.join(secrets.choice('0123456789') for _ in range(6))
+
+    def attempts_key(self, user):
+        return f'ots:otp-attempts:{user.pk}'
+
+    def count_attempt(self, user):
+        """Count a guess; raises ValueError once the code has had too many"""
+        key = self.attempts_key(user)
+        timeout = self.lifetime.total_seconds()
+        attempts = 1
+        if not cache.add(key, attempts, timeout):
+            try:
+                attempts = cache.incr(key)
+            except ValueError:
+                # The counter expired or was evicted since add()
+                if not cache.add(key, attempts, timeout):
+                    attempts = cache.incr(key)
+        if attempts > self.max_attempts:
+            self.discard(user)
+            raise ValueError('Too many attempts, request a new OTP')
+
+    async def acount_attempt(self, user):
+        key = self.attempts_key(user)
+        timeout = self.lifetime.total_seconds()
+        attempts = 1
+        if not await cache.aadd(key, attempts, timeout):
+            try:
+                attempts = await cache.aincr(key)
+            except ValueError:
+                if not await cache.aadd(key, attempts, timeout):
+                    attempts = await cache.aincr(key)
+        if attempts > self.max_attempts:
+            await self.adiscard(user)
+            raise ValueError('Too many attempts, request a new OTP')
+
+    def issue(self, user, now=None):
+        """Replace the user's OTP with a new one; returns the code"""
+        raise NotImplementedError
+
+    def verify(self, user, code, now=None):
+        """Consume the user's OTP if `code` matches, else raise ValueError"""
+        raise NotImplementedError
+
+    def discard(self, user):
+        raise NotImplementedError
+
+    async def aissue(self, user, now=None):
+        return await sync_to_async(self.issue)(user, now)
+
+    async def averify(self, user, code, now=None):
+        return await sync_to_async(self.verify)(user, code, now)
+
+    async def adiscard(self, user):
+        return await sync_to_async(self.discard)(user)
+
+class CacheOTPStore(OTPStore):
+    """Hashed codes in the cache; needs a cache shared by all workers (CACHE_URL)"""
+
+    def key(self, user):
+        return f'ots:otp:{user.pk}'
+
+    def digest(self, user, code):
+        message = f'{user.pk}:{code}'.encode()
+        return hmac.new(settings.SECRET_KEY.encode(), message, hashlib.sha256).hexdigest()
+
+    def entry(self, user, now):
+        code = self.generate_code()
+        # Kept past its expiry for as long again, to tell expired codes from wrong ones
+        return code, (self.digest(user, code), now + self.lifetime), 2 * self.lifetime.total_seconds()
+
+    def check(self, user, code, entry, now):
+        if entry is None or not hmac.compare_digest(entry[0], self.digest(user, code)):
+            raise ValueError('No matching OTP found')
+        if now > entry[1]:
+            raise ValueError(f'OTP expired at {entry[1]}')
+
+    def issue(self, user, now=None):
+        code, entry, timeout = self.entry(user, now or timezone.now())
+        cache.set(self.key(user), entry, timeout)
+        cache.delete(self.attempts_key(user))
+        return code
+
+    def verify(self, user, code, now=None):
+        self.count_attempt(user)
+        self.check(user, code, cache.get(self.key(user)), now or timezone.now())
+        # Only one request gets to delete the entry
+        if not cache.delete(self.key(user)):
+            raise ValueError('No matching OTP found')
+
+    def discard(self, user):
+        cache.delete(self.key(user))
+
+    async def aissue(self, user, now=None):
+        code, entry, timeout = self.entry(user, now or timezone.now())
+        await cache.aset(self.key(user), entry, timeout)
+        await cache.adelete(self.attempts_key(user))
+        return code
+
+    async def averify(self, user, code, now=None):
+        await self.acount_attempt(user)
+        self.check(user, code, await cache.aget(self.key(user)), now or timezone.now())
+        if not await cache.adelete(self.key(user)):
+            raise ValueError('No matching OTP found')
+
+    async def adiscard(self, user):
+        await cache.adelete(self.key(user))
+
+class ModelOTPStore(OTPStore):
+    """OTP rows in the database; a user has at most one row at a time.
+    Guesses are counted on the row, so the limit holds for all workers
+    without a shared cache."""
+
+    def issue(self, user, now=None):
+        now = now or timezone.now()
+        code = self.generate_code()
+        OTP.objects.filter(user=user).delete()
+        OTP.objects.create(user=user, code=code, expires_at=now + self.lifetime)
+        return code
+
+    def count_attempt(self, user):
+        unused = OTP.objects.filter(user=user, is_used=False)
+        if unused.filter(attempts__lt=self.max_attempts).update(attempts=F('attempts') + 1):
+            return
+        if not unused.exists():
+            raise ValueError('No matching OTP found')
+        self.discard(user)
+        raise ValueError('Too many attempts, request a new OTP')
+
+    def verify(self, user, code, now=None):
+        self.count_attempt(user)
+        otp = OTP.objects.filter(user=user, code=code, is_used=False).order_by('-created_at').first()
+        if otp is None:
+            raise ValueError('No matching OTP found')
+        if (now or timezone.now()) > otp.expires_at:
+            raise ValueError(f'OTP expired at {otp.expires_at}')
+        if not OTP.objects.filter(pk=otp.pk, is_used=False).update(is_used=True):
+            raise ValueError('No matching OTP found')
+
+    def discard(self, user):
+        OTP.objects.filter(user=user).delete()
+
+def get_otp_store():
+    return import_string(settings.OTS_OTP_STORE)()
@@ -0,0 +1,152 @@
+import time
+from datetime import timedelta
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection, send_mail
+from django.db import connections, router, transaction
+from django.db.models import Min
+from django.utils import timezone
+
+from .metrics import metrics
+from .models import OutboxEmail
+from .otp_store import OTPStore
+
+MAX_ATTEMPTS = 5
+RETRY_BASE = timedelta(seconds=30)
+RETRY_MAX = timedelta(hours=1)
+# How long a claimed batch is hidden from other workers while it is being sent
+LEASE = timedelta(minutes=5)
+# The outbox carries login OTPs, which are useless (but still secret) once
+# the code has expired: such emails are dropped rather than sent
+MAX_AGE = OTPStore.lifetime
+
+def timed_send(send, *args, **kwargs):
+    """Call a mail sending function, recording its latency and result"""
+    start = time.perf_counter()
+    result = 'failed'
+    try:
+        value = send(*args, **kwargs)
+        result = 'sent'
+        return value
+    finally:
+        metrics.observe('ots_email_send_duration_seconds', time.perf_counter() - start, result=result)
+
+def queue_mail(subject, message, from_email, recipient_list):
+    """Queue an email for the outbox worker, or send it inline when the
+    outbox is disabled (the default with DEBUG, so console mail keeps working)"""
+    if not settings.OTS_EMAIL_OUTBOX:
+        timed_send(send_mail, subject, message, from_email, recipient_list, fail_silently=False)
+        return None
+    return OutboxEmail.objects.create(
+        subject=subject,
+        body=message,
+        from_email=from_email or '',
+        recipients=list(recipient_list),
+    )
+
+async def aqueue_mail(subject, message, from_email, recipient_list):
+    """Async version of queue_mail"""
+    if not settings.OTS_EMAIL_OUTBOX:
+        await sync_to_async(timed_send)(send_mail, subject, message, from_email, recipient_list, fail_silently=False)
+        return None
+    return await OutboxEmail.objects.acreate(
+        subject=subject,
+        body=message,
+        from_email=from_email or '',
+        recipients=list(recipient_list),
+    )
+
+def retry_delay(attempts):
+    """Exponential backoff after the given number of failed attempts"""
+    return min(RETRY_BASE * (2 ** (attempts - 1)), RETRY_MAX)
+
+def claim_batch(batch_size, max_attempts=MAX_ATTEMPTS, now=None):
+    """Lease up to `batch_size` due emails so concurrent workers skip them"""
+    now = now or timezone.now()
+    using = router.db_for_write(OutboxEmail)
+    queryset = OutboxEmail.objects.using(using).filter(
+        next_attempt_at__lte=now,
+        attempts__lt=max_attempts,
+    ).order_by('next_attempt_at')
+    with transaction.atomic(using=using):
+        if connections[using].features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        batch = list(queryset[:batch_size])
+        OutboxEmail.objects.using(using).filter(
+            pk__in=[email.pk for email in batch]
+        ).update(next_attempt_at=now + LEASE)
+    return batch
+
+def reschedule(email, error, max_attempts=MAX_ATTEMPTS):
+    attempts = email.attempts + 1
+    fields = {
+        'attempts': attempts,
+        'last_error': str(error),
+        'next_attempt_at': timezone.now() + retry_delay(attempts),
+    }
+    if attempts >= max_attempts:
+        # Given up on; keep the row for outbox_stats, not the code in it
+        fields['body'] = ''
+    OutboxEmail.objects.filter(pk=email.pk).update(**fields)
+
+def drop_expired(now=None):
+    """Delete emails older than MAX_AGE, including given up ones; returns how many"""
+    now = now or timezone.now()
+    deleted, _ = OutboxEmail.objects.filter(created_at__lt=now - MAX_AGE).delete()
+    return deleted
+
+def deliver_batch(batch_size=100, max_attempts=MAX_ATTEMPTS):
+    """Send one batch of due emails over a single mail connection.
+
+    Delivered emails are deleted; failures are rescheduled with backoff
+    until `max_attempts` is reached, then kept without their body until
+    they are MAX_AGE old. Returns ``(sent, failed)``.
+    """
+    drop_expired()
+    batch = claim_batch(batch_size, max_attempts)
+    if not batch:
+        return 0, 0
+
+    connection = get_connection(fail_silently=False)
+    try:
+        connection.open()
+    except Exception as e:
+        for email in batch:
+            reschedule(email, e, max_attempts)
+        return 0, len(batch)
+
+    sent, failed = [], 0
+    try:
+        for email in batch:
+            message = EmailMessage(
+                email.subject,
+                email.body,
+                email.from_email or settings.DEFAULT_FROM_EMAIL,
+                email.recipients,
+                connection=connection,
+            )
+            try:
+                timed_send(connection.send_messages, [message])
+            except Exception as e:
+                failed += 1
+                reschedule(email, e, max_attempts)
+            else:
+                sent.append(email.pk)
+    finally:
+        connection.close()
+
+    OutboxEmail.objects.filter(pk__in=sent).delete()
+    return len(sent), failed
+
+def outbox_stats(max_attempts=MAX_ATTEMPTS, now=None):
+    """Queue depth of the outbox"""
+    now = now or timezone.now()
+    pending = OutboxEmail.objects.filter(attempts__lt=max_attempts)
+    oldest = pending.aggregate(oldest=Min('created_at'))['oldest']
+    return {
+        'due': pending.filter(next_attempt_at__lte=now).count(),
+        'scheduled': pending.filter(next_attempt_at__gt=now).count(),
+        'dead': OutboxEmail.objects.filter(attempts__gte=max_attempts).count(),
+        'oldest_age_seconds': (now - oldest).total_seconds() if oldest else 0,
+    }
@@ -0,0 +1,178 @@
+"""Daily range partitions of the secret table by expires_at (PostgreSQL only).
+
+`partition_secrets` turns app_secret into a table partitioned by
+``expires_at``, with one partition per UTC day and a default partition for
+anything outside them. The primary key becomes ``(id, expires_at)`` since
+PostgreSQL needs the partition key in it; lookups by id still use the
+per-partition primary key index, one probe per partition. Expired days are
+then removed by detaching and dropping their partition instead of deleting
+row by row.
+"""
+import re
+from datetime import datetime, time, timedelta, timezone as dt_timezone
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.utils import timezone
+
+from .blobstore import get_blob_store
+from .models import Secret
+
+TABLE = Secret._meta.db_table
+DEFAULT_PARTITION = f'{TABLE}_default'
+UNPARTITIONED = f'{TABLE}_unpartitioned'
+
+def partition_name(day):
+    return f'{TABLE}_p{day:%Y%m%d}'
+
+def day_bounds(day):
+    start = datetime.combine(day, time.min, tzinfo=dt_timezone.utc)
+    return start, start + timedelta(days=1)
+
+def get_connection(using=None):
+    connection = connections[using or router.db_for_write(Secret)]
+    if connection.vendor != 'postgresql':
+        raise ValueError('Secret partitions need PostgreSQL')
+    return connection
+
+def is_partitioned(connection):
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [connection.ops.quote_name(TABLE)]
+        )
+        row = cursor.fetchone()
+    return row is not None and row[0] == 'p'
+
+def partitions(connection):
+    """{day: partition name} of the daily partitions"""
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT child.relname FROM pg_inherits "
+            "JOIN pg_class child ON child.oid = pg_inherits.inhrelid "
+            "WHERE pg_inherits.inhparent = to_regclass(%s)",
+            [connection.ops.quote_name(TABLE)],
+        )
+        names = [name for name, in cursor.fetchall()]
+    pattern = re.compile(rf'^{re.escape(TABLE)}_p(\d{{8}})$')
+    days = {}
+    for name in names:
+        match = pattern.match(name)
+        if match:
+            days[datetime.strptime(match.group(1), '%Y%m%d').date()] = name
+    return days
+
+def attach_partition(connection, day):
+    """Create the partition for `day`, moving in any of its rows that
+    landed in the default partition meanwhile"""
+    qn = connection.ops.quote_name
+    name = partition_name(day)
+    start, end = day_bounds(day)
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'CREATE TABLE {qn(name)} (LIKE {qn(TABLE)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)')
+        cursor.execute(
+            f'WITH moved AS (DELETE FROM {qn(DEFAULT_PARTITION)} '
+            f'WHERE expires_at >= %s AND expires_at < %s RETURNING *) '
+            f'INSERT INTO {qn(name)} SELECT * FROM moved',
+            [start, end],
+        )
+        # Bounds are literals: DDL takes no parameters. Attaching builds the
+        # parent's indexes on the new table.
+        cursor.execute(
+            f"ALTER TABLE {qn(TABLE)} ATTACH PARTITION {qn(name)} "
+            f"FOR VALUES FROM ('{start.isoformat()}') TO ('{end.isoformat()}')"
+        )
+    return name
+
+def create_partitions(days_ahead=None, now=None, using=None):
+    """Make sure every day from today to `days_ahead` days out has a
+    partition; returns the names of the ones created"""
+    connection = get_connection(using)
+    if not is_partitioned(connection):
+        raise ValueError('The secret table is not partitioned yet, run partition_secrets --setup')
+    if days_ahead is None:
+        days_ahead = settings.OTS_MAX_EXPIRY.days + 2
+    today = (now or timezone.now()).astimezone(dt_timezone.utc).date()
+    existing = partitions(connection)
+    created = []
+    for offset in range(days_ahead + 1):
+        day = today + timedelta(days=offset)
+        if day not in existing:
+            created.append(attach_partition(connection, day))
+    return created
+
+def expired_partitions(grace=None, now=None, using=None):
+    """{day: name} of partitions whose every secret expired more than
+    `grace` (OTS_PURGE_GRACE) ago"""
+    if grace is None:
+        grace = settings.OTS_PURGE_GRACE
+    cutoff = (now or timezone.now()) - grace
+    return {
+        day: name for day, name in sorted(partitions(get_connection(using)).items())
+        if day_bounds(day)[1] <= cutoff
+    }
+
+def drop_expired_partitions(grace=None, now=None, using=None):
+    """Detach and drop expired partitions, then delete their file blobs.
+
+    Yields ``(name, rows)`` per dropped partition. Finding the blob names
+    (and the row count) reads the partition once; the drop itself doesn't
+    depend on its size.
+    """
+    connection = get_connection(using)
+    qn = connection.ops.quote_name
+    store = get_blob_store()
+    for day, name in expired_partitions(grace, now, using).items():
+        with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+            cursor.execute(
+                f"SELECT count(*), array_agg(blob_name) FILTER (WHERE blob_name <> '') FROM {qn(name)}"
+            )
+            rows, blob_names = cursor.fetchone()
+            cursor.execute(f'ALTER TABLE {qn(TABLE)} DETACH PARTITION {qn(name)}')
+            cursor.execute(f'DROP TABLE {qn(name)}')
+        for blob_name in blob_names or []:
+            store.delete(blob_name)
+        yield name, rows
+
+def partition_secrets(days_ahead=None, now=None, using=None):
+    """Convert the secret table into daily partitions, copying its rows.
+
+    Holds an exclusive lock on the table while it copies, so run it in a
+    maintenance window. Returns False if the table is already partitioned.
+    """
+    connection = get_connection(using)
+    if is_partitioned(connection):
+        return False
+    qn = connection.ops.quote_name
+    with transaction.atomic(using=connection.alias), connection.cursor() as cursor:
+        cursor.execute(f'LOCK TABLE {qn(TABLE)} IN ACCESS EXCLUSIVE MODE')
+        cursor.execute(
+            "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE conrelid = to_regclass(%s) AND contype = 'f'",
+            [qn(TABLE)],
+        )
+        foreign_keys = cursor.fetchall()
+        cursor.execute(
+            "SELECT indexname, indexdef FROM pg_indexes WHERE schemaname = current_schema() "
+            "AND tablename = %s AND indexname <> %s",
+            [TABLE, f'{TABLE}_pkey'],
+        )
+        indexes = cursor.fetchall()
+
+        cursor.execute(f'ALTER TABLE {qn(TABLE)} RENAME TO {qn(UNPARTITIONED)}')
+        cursor.execute(f'ALTER INDEX {qn(TABLE + "_pkey")} RENAME TO {qn(UNPARTITIONED + "_pkey")}')
+        cursor.execute(
+            f'CREATE TABLE {qn(TABLE)} (LIKE {qn(UNPARTITIONED)} INCLUDING DEFAULTS INCLUDING CONSTRAINTS) '
+            f'PARTITION BY RANGE (expires_at)'
+        )
+        cursor.execute(f'ALTER TABLE {qn(TABLE)} ADD CONSTRAINT {qn(TABLE + "_pkey")} PRIMARY KEY (id, expires_at)')
+        for constraint, definition in foreign_keys:
+            cursor.execute(f'ALTER TABLE {qn(TABLE)} ADD CONSTRAINT {qn(constraint)} {definition}')
+        cursor.execute(f'CREATE TABLE {qn(DEFAULT_PARTITION)} PARTITION OF {qn(TABLE)} DEFAULT')
+        create_partitions(days_ahead, now, connection.alias)
+
+        cursor.execute(f'INSERT INTO {qn(TABLE)} SELECT * FROM {qn(UNPARTITIONED)}')
+        cursor.execute(f'DROP TABLE {qn(UNPARTITIONED)}')
+        # Same index names as before, so later migrations still find them
+        for _, definition in indexes:
+            cursor.execute(re.sub(r' ON (ONLY )?\S+ USING ', f' ON {qn(TABLE)} USING ', definition, count=1))
+    return True
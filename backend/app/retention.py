@@ -0,0 +1,208 @@
+import time
+from collections import Counter
+from datetime import timedelta
+
+from django.conf import settings
+from django.db import connections, router, transaction
+from django.db.models import CASCADE, DO_NOTHING, SET_NULL, Min, Q
+from django.db.models.functions import Coalesce, Length
+from django.utils import timezone
+
+from .blobstore import get_blob_store
+from .metrics import metrics
+from .models import Secret, User
+
+PURGE_DELETE = 'delete'
+PURGE_SCRUB = 'scrub'
+
+def purgeable_secrets(grace=None, now=None):
+    """Secrets that were consumed or expired more than `grace` ago.
+
+    We don't record when a secret was viewed or burned, so consumed secrets
+    are aged by their creation time instead.
+    """
+    if grace is None:
+        grace = settings.OTS_PURGE_GRACE
+    cutoff = (now or timezone.now()) - grace
+    return Secret.objects.filter(
+        Q(is_viewed=True, created_at__lt=cutoff)
+        | Q(is_destroyed=True, created_at__lt=cutoff)
+        | Q(expires_at__lt=cutoff)
+    )
+
+def payload_size():
+    """Bytes held by the payload columns of a secret"""
+    return (
+        Length('encrypted_message')
+        + Length('encryption_key')
+        + Coalesce(Length('passphrase_hash'), 0)
+    )
+
+def purge_secrets(mode=PURGE_DELETE, grace=None, batch_size=1000, sleep=0, start_after=None, now=None):
+    """Delete or scrub purgeable secrets (and their file blobs) in
+    primary-key ordered batches.
+
+    Yields ``(rows, bytes, last_pk)`` after every batch. Each batch is its own
+    short statement, so the purge can be interrupted at any point and
+    resumed by passing the last reported pk as `start_after` (or simply
+    rerun, since finished rows no longer match).
+    """
+    if mode not in (PURGE_DELETE, PURGE_SCRUB):
+        raise ValueError(f"Unknown purge mode: {mode}")
+    now = now or timezone.now()
+    queryset = purgeable_secrets(grace, now)
+    if mode == PURGE_SCRUB:
+        # Every unscrubbed secret has a key, file secrets included
+        queryset = queryset.exclude(encryption_key=b'')
+    store = get_blob_store()
+
+    last_pk = start_after
+    while True:
+        batch = queryset.order_by('pk')
+        if last_pk is not None:
+            batch = batch.filter(pk__gt=last_pk)
+        rows = list(batch.annotate(size=payload_size()).values_list('pk', 'size', 'blob_name')[:batch_size])
+        if not rows:
+            return
+        pks = [pk for pk, _, _ in rows]
+        last_pk = pks[-1]
+
+        targets = queryset.filter(pk__in=pks)
+        if mode == PURGE_DELETE:
+            count, _ = targets.delete()
+        else:
+            count = targets.update(
+                encrypted_message=b'',
+                encryption_key=b'',
+                passphrase_hash=None,
+                blob_name='',
+                is_destroyed=True,
+            )
+        freed = sum(size or 0 for _, size, _ in rows)
+        freed += sum(store.delete(blob_name) for _, _, blob_name in rows if blob_name)
+        yield count, freed, last_pk
+
+        if len(rows) < batch_size:
+            return
+        if sleep:
+            time.sleep(sleep)
+
+def pending_secrets():
+    """Secrets nobody has viewed or destroyed yet, expired or not"""
+    return Secret.objects.filter(is_viewed=False, is_destroyed=False)
+
+def expire_due_secrets(batch_size=500, now=None):
+    """Destroy one batch of secrets whose expiry has passed, oldest first,
+    wiping their payload and file. Returns how many were destroyed.
+
+    The batch comes off the partial expires_at index of pending secrets.
+    Where the database has SELECT ... FOR UPDATE SKIP LOCKED, workers on
+    several nodes take disjoint batches. SQLite runs one write transaction
+    at a time (BEGIN IMMEDIATE), so there the next worker only sees what is
+    left after this batch commits.
+    """
+    now = now or timezone.now()
+    using = router.db_for_write(Secret)
+    queryset = pending_secrets().using(using).filter(expires_at__lte=now).order_by('expires_at')
+    with transaction.atomic(using=using):
+        if connections[using].features.has_select_for_update_skip_locked:
+            queryset = queryset.select_for_update(skip_locked=True)
+        batch = list(queryset.values_list('pk', 'blob_name')[:batch_size])
+        destroyed = pending_secrets().using(using).filter(pk__in=[pk for pk, _ in batch]).update(
+            is_destroyed=True,
+            encrypted_message=b'',
+            encryption_key=b'',
+            passphrase_hash=None,
+            blob_name='',
+        )
+    store = get_blob_store()
+    for _, blob_name in batch:
+        if blob_name:
+            store.delete(blob_name)
+    metrics.inc('ots_secrets_expired_total', destroyed)
+    return destroyed
+
+def next_expiry():
+    """When the next pending secret expires (None if there is none). Read
+    from the primary: a lagging replica would still list secrets that were
+    just destroyed."""
+    using = router.db_for_write(Secret)
+    return pending_secrets().using(using).aggregate(next=Min('expires_at'))['next']
+
+def inactive_users(days=30, now=None):
+    """Users who haven't logged in for `days` (never admins)"""
+    cutoff = (now or timezone.now()) - timedelta(days=days)
+    return User.objects.filter(last_login_at__lt=cutoff, is_superuser=False)
+
+def delete_rows(queryset, deleted):
+    """Delete `queryset` and, first, everything that cascades from it, with
+    one set-based statement per table instead of loading the rows.
+
+    Relations this can't handle without the rows (PROTECT, SET_DEFAULT,
+    custom handlers) fall back to Django's collector for that queryset.
+    """
+    model = queryset.model
+    pks = queryset.values('pk')
+    relations = [rel for rel in model._meta.related_objects if not rel.many_to_many]
+    if any(rel.on_delete not in (CASCADE, SET_NULL, DO_NOTHING) for rel in relations):
+        _, counts = queryset.delete()
+        deleted.update(counts)
+        return
+
+    # Many-to-many links, declared on this model or pointing at it
+    links = [(field.remote_field.through, field.m2m_field_name()) for field in model._meta.local_many_to_many]
+    links += [
+        (rel.through, rel.field.m2m_reverse_field_name())
+        for rel in model._meta.related_objects if rel.many_to_many
+    ]
+    for through, field_name in links:
+        rows = through._base_manager.using(queryset.db).filter(**{f'{field_name}__in': pks})
+        deleted[through._meta.label] += rows._raw_delete(queryset.db)
+    for rel in relations:
+        children = rel.related_model._base_manager.using(queryset.db).filter(**{f'{rel.field.name}__in': pks})
+        if rel.on_delete is CASCADE:
+            delete_rows(children, deleted)
+        elif rel.on_delete is SET_NULL:
+            children.update(**{rel.field.name: None})
+    deleted[model._meta.label] += queryset._raw_delete(queryset.db)
+
+def purge_inactive_users(days=30, batch_size=500, max_runtime=None, now=None):
+    """Delete inactive users and everything they own in user-id chunks.
+
+    Yields ``(users, deleted, last_pk)`` per chunk, where `deleted` counts
+    rows per model. Each chunk is its own transaction, so the purge can be
+    stopped at any point (or by `max_runtime` seconds) and simply rerun.
+    """
+    started = time.monotonic()
+    queryset = inactive_users(days, now)
+    using = router.db_for_write(User)
+    store = get_blob_store()
+    last_pk = None
+    while True:
+        chunk = queryset.order_by('pk')
+        if last_pk is not None:
+            chunk = chunk.filter(pk__gt=last_pk)
+        pks = list(chunk.values_list('pk', flat=True)[:batch_size])
+        if not pks:
+            return
+        last_pk = pks[-1]
+        selected = len(pks)
+
+        deleted = Counter()
+        with transaction.atomic(using=using):
+            # Re-check under lock: someone may have logged in meanwhile
+            users = queryset.using(using).filter(pk__in=pks).select_for_update()
+            pks = list(users.values_list('pk', flat=True))
+            blob_names = list(
+                Secret.objects.using(using).filter(user__in=pks).exclude(blob_name='')
+                .values_list('blob_name', flat=True)
+            )
+            delete_rows(User.objects.using(using).filter(pk__in=pks), deleted)
+        for blob_name in blob_names:
+            store.delete(blob_name)
+        yield deleted[User._meta.label], deleted, last_pk
+
+        if selected < batch_size:
+            return
+        if max_runtime is not None and time.monotonic() - started >= max_runtime:
+            return
@@ -1,7 +1,9 @@
 from rest_framework import serializers
 from django.utils import timezone
 from django.conf import settings
-from .models import User, OTP, Secret
+from django.db import transaction
+from . import kdf
+from .models import User, OTP, Secret, SecretCounts
 
 class UserSerializer(serializers.ModelSerializer):
     class Meta:
@@ -32,8 +34,34 @@ class OTPVerificationSerializer(serializers.Serializer):
     email = serializers.EmailField()
     code = serializers.CharField(max_length=6)
 
+class SecretBulkCreateSerializer(serializers.ListSerializer):
+    """Creates a batch of message secrets with one INSERT, keeping input order"""
+
+    def validate(self, attrs):
+        if any('file' in item for item in attrs):
+            raise serializers.ValidationError('File secrets cannot be created in bulk')
+        return attrs
+
+    def create(self, validated_data):
+        secrets = []
+        for item in validated_data:
+            secret = self.child.build_secret(item)
+            secret.encrypt_message(item['message'])
+            secrets.append(secret)
+        protected = [(secret, item['passphrase']) for secret, item in zip(secrets, validated_data)
+                     if item.get('passphrase')]
+        hashes = kdf.hash_passphrases([passphrase for _, passphrase in protected])
+        for (secret, _), passphrase_hash in zip(protected, hashes):
+            secret.has_passphrase = True
+            secret.passphrase_hash = passphrase_hash
+        with transaction.atomic():
+            Secret.objects.bulk_create(secrets)
+            SecretCounts.add(self.context['request'].user.pk, created=len(secrets))
+        return secrets
+
 class SecretCreateSerializer(serializers.ModelSerializer):
-    message = serializers.CharField(write_only=True)
+    message = serializers.CharField(required=False, write_only=True)
+    file = serializers.FileField(required=False, write_only=True)
     passphrase = serializers.CharField(required=False, write_only=True, allow_blank=True)
     expiry_minutes = serializers.IntegerField(required=False, min_value=1, max_value=10080)  # 7 days in minutes
     destruction_animation = serializers.ChoiceField(required=False, choices=[
@@ -45,14 +73,25 @@ class SecretCreateSerializer(serializers.ModelSerializer):
 
     class Meta:
         model = Secret
-        fields = ('id', 'message', 'passphrase', 'expiry_minutes', 'destruction_animation', 'created_at', 'expires_at')
-        read_only_fields = ('id', 'created_at', 'expires_at')
+        fields = ('id', 'message', 'file', 'passphrase', 'expiry_minutes', 'destruction_animation', 'created_at', 'expires_at', 'file_name', 'file_size')
+        read_only_fields = ('id', 'created_at', 'expires_at', 'file_name', 'file_size')
+        list_serializer_class = SecretBulkCreateSerializer
 
-    def create(self, validated_data):
-        message = validated_data.pop('message')
-        passphrase = validated_data.pop('passphrase', None)
-        expiry_minutes = validated_data.pop('expiry_minutes', None)
-        destruction_animation = validated_data.pop('destruction_animation', 'none')
+    def validate_file(self, value):
+        if value.size > settings.OTS_MAX_FILE_SIZE:
+            raise serializers.ValidationError(
+                f'File is larger than {settings.OTS_MAX_FILE_SIZE // (1024 * 1024)} MB'
+            )
+        return value
+
+    def validate(self, attrs):
+        if ('message' in attrs) == ('file' in attrs):
+            raise serializers.ValidationError('Provide either a message or a file')
+        return attrs
+
+    def build_secret(self, validated_data):
+        """An unsaved Secret with expiry and options applied, before encryption"""
+        expiry_minutes = validated_data.get('expiry_minutes')
 
         # Calculate expiry time
         if expiry_minutes:
@@ -60,15 +99,23 @@ class SecretCreateSerializer(serializers.ModelSerializer):
         else:
             expires_at = timezone.now() + settings.OTS_DEFAULT_EXPIRY
 
-        # Create secret
-        secret = Secret(
+        return Secret(
             user=self.context['request'].user,
             expires_at=expires_at,
-            destruction_animation=destruction_animation,
-            **validated_data
+            destruction_animation=validated_data.get('destruction_animation', 'none'),
         )
-        secret.encrypt_message(message, passphrase)
-        secret.save()
+
+    def create(self, validated_data):
+        passphrase = validated_data.get('passphrase')
+        uploaded_file = validated_data.get('file')
+
+        # Create secret
+        secret = self.build_secret(validated_data)
+        if uploaded_file is not None:
+            secret.encrypt_file(uploaded_file, passphrase)
+        else:
+            secret.encrypt_message(validated_data['message'], passphrase)
+        secret.insert()
         return secret
 
 class SecretViewSerializer(serializers.ModelSerializer):
@@ -81,27 +128,28 @@ class SecretViewSerializer(serializers.ModelSerializer):
         read_only_fields = ('id', 'message', 'copy', 'has_passphrase', 'created_at', 'expires_at', 'is_viewed', 'is_destroyed', 'destruction_animation')
 
     def get_message(self, obj):
-        """Get decrypted message if conditions are met"""
-        # If message is already decrypted in the view, return it
-        if hasattr(obj, '_decrypted_message'):
-            return obj._decrypted_message
-            
-        # For passphrase-protected secrets, try to decrypt with passphrase
-        if obj.has_passphrase:
-            passphrase = self.context.get('passphrase')
-            if not passphrase:
-                return None
-            try:
-                return obj.decrypt_message(passphrase)
-            except ValueError:
-                return None
-                
-        # For non-passphrase secrets, try to decrypt
-        try:
-            return obj.decrypt_message()
-        except ValueError:
-            return None
+        """The message the view decrypted when it consumed the secret"""
+        # Never decrypt here: consuming is the view's job and happens once
+        return getattr(obj, '_decrypted_message', None)
 
     def get_copy(self, obj):
         """Get the same message for copy functionality"""
-        return self.get_message(obj) 
\ No newline at end of file
+        return self.get_message(obj)
+
+_datetime_field = serializers.DateTimeField()
+
+def consumed_secret_data(secret, message):
+    """What SecretViewSerializer returns for a just-consumed secret, built
+    as a plain dict: the message is the one already decrypted, and there is
+    no field introspection on the hot path"""
+    return {
+        'id': str(secret.id),
+        'message': message,
+        'copy': message,
+        'has_passphrase': secret.has_passphrase,
+        'created_at': _datetime_field.to_representation(secret.created_at),
+        'expires_at': _datetime_field.to_representation(secret.expires_at),
+        'is_viewed': secret.is_viewed,
+        'is_destroyed': secret.is_destroyed,
+        'destruction_animation': secret.destruction_animation,
+    }
\ No newline at end of file
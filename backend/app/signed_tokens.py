@@ -0,0 +1,75 @@
+"""Stateless session tokens, checked without a Token table lookup.
+
+A token reads ``s1.<key id>.<user id>.<issued ms>.<expires s>.<signature>``,
+signed with HMAC-SHA256 by the first of OTS_TOKEN_SIGNING_KEYS. Tokens
+signed by any listed key verify, so keys can be rotated by prepending a
+new one. Logging out moves the user's ``tokens_valid_after`` forward, which
+revokes every token issued before it.
+"""
+import base64
+import hashlib
+import hmac
+from datetime import datetime, timezone as dt_timezone
+from functools import lru_cache
+
+from django.conf import settings
+from rest_framework.exceptions import AuthenticationFailed
+
+PREFIX = 's1'
+
+def key_id(key):
+    return hashlib.sha256(key.encode()).hexdigest()[:8]
+
+@lru_cache(maxsize=4)
+def _signing_keys(keys):
+    return key_id(keys[0]), {key_id(key): key.encode() for key in keys}
+
+def signing_keys():
+    """(primary key id, {key id: key}) for OTS_TOKEN_SIGNING_KEYS"""
+    return _signing_keys(tuple(settings.OTS_TOKEN_SIGNING_KEYS))
+
+def signature(key, payload):
+    digest = hmac.new(key, payload.encode(), hashlib.sha256).digest()
+    return base64.urlsafe_b64encode(digest).rstrip(b'=').decode()
+
+def is_signed_token(value):
+    return value.startswith(PREFIX + '.')
+
+class SignedToken:
+    """The verified contents of a token; set as request.auth"""
+
+    def __init__(self, key, key_id, user_id, issued_ms, expires):
+        self.key = key
+        self.key_id = key_id
+        self.user_id = user_id
+        self.issued_ms = issued_ms
+        self.expires_at = datetime.fromtimestamp(expires, tz=dt_timezone.utc)
+
+    def issued_after(self, moment):
+        return moment is None or self.issued_ms > int(moment.timestamp() * 1000)
+
+def issue_token(user_id, now, lifetime):
+    """A new signed token for the user and its expiry time"""
+    primary, keys = signing_keys()
+    expires = int((now + lifetime).timestamp())
+    payload = f'{PREFIX}.{primary}.{user_id}.{int(now.timestamp() * 1000)}.{expires}'
+    key = f'{payload}.{signature(keys[primary], payload)}'
+    return key, datetime.fromtimestamp(expires, tz=dt_timezone.utc)
+
+def verify_token(value, now):
+    """Check signature and expiry; returns a SignedToken"""
+    payload, _, sig = value.rpartition('.')
+    parts = payload.split('.')
+    if len(parts) != 5 or parts[0] != PREFIX:
+        raise AuthenticationFailed('Invalid token')
+    _, kid, user_id, issued_ms, expires = parts
+    key = signing_keys()[1].get(kid)
+    if key is None or not hmac.compare_digest(sig, signature(key, payload)):
+        raise AuthenticationFailed('Invalid token')
+    try:
+        token = SignedToken(value, kid, int(user_id), int(issued_ms), int(expires))
+    except ValueError:
+        raise AuthenticationFailed('Invalid token')
+    if token.expires_at <= now:
+        raise AuthenticationFailed('Token has expired')
+    return token
@@ -0,0 +1,80 @@
+"""SQLite tuned for several worker processes writing at once (OTS_SQLITE_TUNING).
+
+Every request writes something, and stock SQLite fails those writes with
+"database is locked" as soon as two workers overlap: the rollback journal
+blocks readers during a write, and a deferred transaction that reads first
+cannot wait for the write lock once another connection holds it. The
+settings make Django start transactions with BEGIN IMMEDIATE (they take the
+write lock up front, so SQLite can wait for it). Each new connection then
+gets WAL (readers don't block the writer), synchronous=NORMAL, a busy
+timeout, mmap and a bigger page cache. LockRetry retries the statements
+that can still fail on the lock.
+"""
+import random
+import time
+
+from django.conf import settings
+from django.db import OperationalError
+
+# Applied to every new connection, in order
+PRAGMAS = (
+    'PRAGMA journal_mode=WAL',
+    # With WAL only a power loss, not a crash, can drop the last commits
+    'PRAGMA synchronous=NORMAL',
+    'PRAGMA mmap_size=268435456',
+    'PRAGMA cache_size=-65536',
+    'PRAGMA temp_store=MEMORY',
+)
+
+def apply_pragmas(cursor, busy_timeout_ms):
+    cursor.execute(f'PRAGMA busy_timeout={int(busy_timeout_ms)}')
+    for pragma in PRAGMAS:
+        cursor.execute(pragma)
+
+def is_lock_error(exc):
+    # "database table is locked" comes from shared-cache (in-memory) databases
+    message = str(exc)
+    return 'database is locked' in message or 'database table is locked' in message
+
+def backoff(attempt):
+    """Seconds to wait before retry `attempt` (1-based), with jitter"""
+    return random.uniform(0.5, 1.0) * min(0.01 * 2 ** attempt, 0.5)
+
+class LockRetry:
+    """execute_wrapper that retries statements failing on the database lock.
+
+    Only statements outside a transaction are retried, plus the BEGIN that
+    opens one: inside a transaction an earlier statement's work would be
+    silently lost if we retried.
+    """
+
+    def __init__(self, connection, attempts):
+        self.connection = connection
+        self.attempts = attempts
+
+    def __call__(self, execute, sql, params, many, context):
+        attempt = 0
+        while True:
+            try:
+                return execute(sql, params, many, context)
+            except OperationalError as exc:
+                attempt += 1
+                if attempt > self.attempts or self.connection.in_atomic_block or not is_lock_error(exc):
+                    raise
+                time.sleep(backoff(attempt))
+
+def configure_connection(sender, connection, **kwargs):
+    """connection_created receiver"""
+    if connection.vendor != 'sqlite' or not settings.OTS_SQLITE_TUNING:
+        return
+    with connection.cursor() as cursor:
+        apply_pragmas(cursor, settings.OTS_SQLITE_BUSY_TIMEOUT_MS)
+        if connection.is_in_memory_db():
+            # Shared-cache (in-memory test) databases lock per table and
+            # ignore the busy timeout, so a reader on another connection
+            # fails a write inside a transaction that can't be retried.
+            # Readers that skip the table locks avoid that.
+            cursor.execute('PRAGMA read_uncommitted=1')
+    if not any(isinstance(wrapper, LockRetry) for wrapper in connection.execute_wrappers):
+        # First, so the execute_wrapper() contexts above it still pop their own
+        connection.execute_wrappers.insert(0, LockRetry(connection, settings.OTS_SQLITE_LOCK_RETRIES))
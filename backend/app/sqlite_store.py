@@ -0,0 +1,37 @@
+"""Small SQLite (WAL) files that every worker process on the host shares,
+outside the Django database: the throttle counters and the metrics totals.
+"""
+import sqlite3
+import threading
+
+class SharedSQLiteStore:
+    """One SQLite file with a connection per thread; subclasses give the
+    CREATE TABLE statement of their `schema`"""
+    schema = None
+
+    def __init__(self, path):
+        self.path = str(path)
+        self._local = threading.local()
+
+    @property
+    def connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = sqlite3.connect(self.path, timeout=5, isolation_level=None)
+            connection.execute('PRAGMA journal_mode=WAL')
+            # Counters, not records: losing the last writes to a crash is fine
+            connection.execute('PRAGMA synchronous=OFF')
+            connection.execute(self.schema)
+            self._local.connection = connection
+        return connection
+
+_stores = {}
+
+def get_shared_store(store_class, path):
+    """The process-wide `store_class` instance for `path`, or None if it is empty"""
+    if not path:
+        return None
+    key = (store_class, str(path))
+    if key not in _stores:
+        _stores[key] = store_class(path)
+    return _stores[key]
@@ -1,3 +1,1295 @@
-from django.test import TestCase
+import io
+import json
+import os
+import sqlite3
+import tempfile
+import threading
+from contextlib import contextmanager
+from datetime import timedelta
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.contrib import admin
+from django.contrib.auth.models import Group
+from django.core import mail
+from django.core.cache import cache
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import CommandError, call_command
+from django.db import DEFAULT_DB_ALIAS, connection, connections
+from django.test import AsyncClient, AsyncRequestFactory, Client, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from cryptography.fernet import Fernet
+from rest_framework.exceptions import AuthenticationFailed
+from rest_framework.test import APIClient
+
+from . import async_views, kdf
+from .admin import SecretAdmin
+from .authentication import CustomTokenAuthentication, token_cache_key, token_usage
+from .db_router import ReplicaRouter, pin_scope
+from .metrics import MetricsRegistry, get_metrics_store, metrics
+from .checks import check_auth_cache, check_otp_store
+from .blobstore import decrypt_chunks, encrypt_chunks, get_blob_store
+from .models import User, OTP, Secret, SecretCounts, OutboxEmail, Token as CustomToken
+from .pagination import EstimatedCountPaginator
+from .partitions import create_partitions, drop_expired_partitions, partition_name, partition_secrets, partitions
+from .otp_store import CacheOTPStore, ModelOTPStore, get_otp_store
+from .outbox import MAX_AGE, MAX_ATTEMPTS, deliver_batch, outbox_stats, queue_mail
+from .throttling import SharedThrottleStore, get_throttle_store
+from .retention import PURGE_SCRUB, expire_due_secrets, next_expiry, purge_inactive_users, purge_secrets
+from .serializers import SecretCreateSerializer, SecretViewSerializer, consumed_secret_data
+from .signed_tokens import issue_token
+from .sqlite import LockRetry
+
+
+_shared_stores = tempfile.TemporaryDirectory()
+_shared_store_settings = override_settings(
+    OTS_METRICS_DB=os.path.join(_shared_stores.name, 'metrics.sqlite3'),
+    OTS_THROTTLE_DB=os.path.join(_shared_stores.name, 'throttle.sqlite3'),
+)
+
+def setUpModule():
+    # Keep the shared metrics and throttle files out of the source tree
+    _shared_store_settings.enable()
+
+def tearDownModule():
+    metrics.flush()
+    _shared_store_settings.disable()
+    _shared_stores.cleanup()
+
+def reset_throttles():
+    cache.clear()
+    store = get_throttle_store()
+    if store is not None:
+        store.clear()
+
+
+def make_secret(user, message='top secret', passphrase=None, **extra):
+    secret = Secret(
+        user=user,
+        expires_at=extra.pop('expires_at', timezone.now() + timedelta(minutes=10)),
+        **extra
+    )
+    secret.encrypt_message(message, passphrase)
+    secret.save()
+    return secret
+
+def token_client(user):
+    """An APIClient authenticated as `user` with a fresh session token;
+    returns ``(client, token)``"""
+    token = CustomToken.objects.create(
+        user=user,
+        key='t' * 40,
+        expires_at=timezone.now() + timedelta(minutes=1),
+    )
+    client = APIClient()
+    client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+    return client, token
+
+
+class SecretConsumeTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.client = APIClient()
+
+    def test_consume_returns_message_once(self):
+        secret = make_secret(self.user)
+        claimed, message = Secret.objects.consume(secret.pk)
+        self.assertEqual(message, 'top secret')
+        self.assertTrue(claimed.is_viewed)
+        with self.assertRaisesMessage(ValueError, 'already been viewed'):
+            Secret.objects.consume(secret.pk)
+
+    def test_claim_is_a_single_statement(self):
+        secret = make_secret(self.user)
+        with CaptureQueriesContext(connection) as captured:
+            Secret.objects.consume(secret.pk)
+        # Besides the owner's view count
+        claim = [query['sql'] for query in captured if '"app_secret"' in query['sql']]
+        self.assertEqual(len(claim), 1 if connection.features.can_return_columns_from_insert else 2)
+
+    def test_wrong_passphrase_does_not_burn_secret(self):
+        secret = make_secret(self.user, passphrase='hunter2')
+        with self.assertRaisesMessage(ValueError, 'Invalid passphrase'):
+            Secret.objects.consume(secret.pk, 'wrong')
+        with self.assertRaisesMessage(ValueError, 'Passphrase required'):
+            Secret.objects.consume(secret.pk)
+        _, message = Secret.objects.consume(secret.pk, 'hunter2')
+        self.assertEqual(message, 'top secret')
+
+    def test_expired_secret_is_destroyed(self):
+        secret = make_secret(self.user, expires_at=timezone.now() - timedelta(seconds=1))
+        with self.assertRaisesMessage(ValueError, 'expired'):
+            Secret.objects.consume(secret.pk)
+        self.assertTrue(Secret.objects.get(pk=secret.pk).is_destroyed)
+
+    def test_view_endpoints(self):
+        secret = make_secret(self.user, passphrase='hunter2')
+        url = f'/api/secrets/{secret.pk}/view_protected/'
+        response = self.client.post(url, {}, format='json')
+        self.assertEqual(response.data['error'], 'Passphrase required')
+        response = self.client.post(url, {'passphrase': 'hunter2'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['message'], 'top secret')
+        self.assertEqual(response.data['copy'], 'top secret')
+        response = self.client.post(url, {'passphrase': 'hunter2'}, format='json')
+        self.assertEqual(response.data['error'], 'Secret is no longer available')
+        self.assertEqual(self.client.get('/api/secrets/not-a-uuid/').status_code, 404)
+
+
+class ConsumedSecretDataTests(TestCase):
+    def test_matches_serializer_without_decrypting_again(self):
+        user = User.objects.create_user(email='owner@example.com')
+        secret = make_secret(user, passphrase='hunter2', destruction_animation='fire')
+        instance, message = Secret.objects.consume(secret.pk, 'hunter2')
+        instance._decrypted_message = message
+
+        with mock.patch.object(Secret, 'read_message') as read_message, self.assertNumQueries(0):
+            data = consumed_secret_data(instance, message)
+            self.assertEqual(data, dict(SecretViewSerializer(instance).data))
+            # Without the view's message the serializer shows nothing rather than decrypting
+            del instance._decrypted_message
+            self.assertIsNone(SecretViewSerializer(instance).data['message'])
+        read_message.assert_not_called()
+        self.assertEqual(data['message'], 'top secret')
+        self.assertTrue(data['is_viewed'])
+
+
+class ORJSONRendererTests(TestCase):
+    def test_output_and_parsing_match_drf(self):
+        from decimal import Decimal
+        from rest_framework.exceptions import ErrorDetail, ParseError
+        from rest_framework.parsers import JSONParser
+        from rest_framework.renderers import JSONRenderer
+        from .renderers import ORJSONParser, ORJSONRenderer
+
+        user = User.objects.create_user(email='owner@example.com')
+        secret = make_secret(user)
+        now = timezone.now()
+        payloads = [
+            SecretCreateSerializer(secret).data,
+            {'id': secret.pk, 'created_at': now, 'date': now.date(), 'naive': now.replace(tzinfo=None),
+             'price': Decimal('1.10'), 'duration': timedelta(minutes=5), 'text': 'é \u2028 \u2029 "',
+             0: {'message': [ErrorDetail('This field is required.', code='required')]}},
+            [], None,
+        ]
+        for data in payloads:
+            content = JSONRenderer().render(data)
+            self.assertEqual(ORJSONRenderer().render(data), content)
+            if content:
+                self.assertEqual(ORJSONParser().parse(io.BytesIO(content)), JSONParser().parse(io.BytesIO(content)))
+        # Indented output is left to DRF
+        self.assertEqual(
+            ORJSONRenderer().render({'a': 1}, 'application/json; indent=2'),
+            JSONRenderer().render({'a': 1}, 'application/json; indent=2'),
+        )
+        with self.assertRaises(ParseError):
+            ORJSONParser().parse(io.BytesIO(b'{"a": NaN}'))
+
+
+class SecretConcurrentConsumeTests(TransactionTestCase):
+    workers = 8
+
+    def setUp(self):
+        reset_throttles()
+
+    def test_parallel_views_have_one_winner(self):
+        user = User.objects.create_user(email='owner@example.com')
+        secret = make_secret(user)
+        barrier = threading.Barrier(self.workers)
+        results = []
+
+        def view():
+            client = APIClient()
+            barrier.wait()
+            try:
+                response = client.get(f'/api/secrets/{secret.pk}/')
+                results.append((response.status_code, response.data.get('message')))
+            finally:
+                connection.close()
+
+        threads = [threading.Thread(target=view) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        winners = [message for code, message in results if code == 200]
+        self.assertEqual(winners, ['top secret'])
+        self.assertEqual(len(results), self.workers)
+
+
+@override_settings(OTS_DB_REPLICAS=['replica'])
+class ReplicaRouterTests(TransactionTestCase):
+    """Two separate databases: rows written to the primary never show up on
+    the replica, so which one served a read is visible in the response"""
+
+    @classmethod
+    def setUpClass(cls):
+        # A second local database standing in for a read replica, there for
+        # these tests only. configure_settings() fills in the defaults
+        # Django expects of an alias. `databases` names it only from here
+        # on, as the runner checks the listed databases before any setup.
+        connections.settings['replica'] = connections.configure_settings({
+            DEFAULT_DB_ALIAS: connections.settings[DEFAULT_DB_ALIAS],
+            'replica': {'ENGINE': 'django.db.backends.sqlite3', 'NAME': ':memory:'},
+        })['replica']
+        connections['replica'].creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+        cls.databases = {DEFAULT_DB_ALIAS, 'replica'}
+        super().setUpClass()
+
+    @classmethod
+    def tearDownClass(cls):
+        super().tearDownClass()
+        connections['replica'].creation.destroy_test_db(':memory:', verbosity=0)
+        del connections['replica']
+        del connections.settings['replica']
+
+    def setUp(self):
+        reset_throttles()
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.client, _ = token_client(self.user)
+        self.secret = make_secret(self.user)
+
+    def test_reads_go_to_replica_until_a_write(self):
+        router = ReplicaRouter()
+        with pin_scope():
+            self.assertEqual(router.db_for_read(Secret), 'replica')
+            replica_copy = Secret(pk=self.secret.pk)
+            replica_copy._state.db = 'replica'
+            self.assertEqual(router.db_for_write(Secret, instance=replica_copy), 'default')
+            self.assertEqual(router.db_for_read(Secret), 'default')
+            self.assertTrue(router.allow_relation(replica_copy, self.user))
+        with pin_scope():
+            self.assertEqual(router.db_for_read(Secret), 'replica')
+
+    def test_list_reads_replica_and_token_falls_back_to_primary(self):
+        response = self.client.get('/api/secrets/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['results'], [])
+
+    def test_client_reads_its_own_writes(self):
+        response = self.client.post('/api/secrets/', {'message': 'hello'}, format='json')
+        self.assertEqual(response.status_code, 201)
+        listed = self.client.get('/api/secrets/').data['results']
+        self.assertEqual(len(listed), 2)
+        # Once the stickiness runs out reads are back on the replica
+        cache.clear()
+        self.assertEqual(self.client.get('/api/secrets/').data['results'], [])
+        other = APIClient()
+        self.assertEqual(other.get('/api/secrets/').status_code, 401)
+
+    def test_consume_runs_on_primary(self):
+        response = self.client.get(f'/api/secrets/{self.secret.pk}/')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['message'], 'top secret')
+
+    @override_settings(OTS_OTP_STORE='app.otp_store.ModelOTPStore')
+    def test_issued_token_reads_its_login(self):
+        client = APIClient()
+        self.assertEqual(client.post('/api/users/login/', {'email': self.user.email}).status_code, 200)
+        code = OTP.objects.get(user=self.user).code
+        response = client.post('/api/users/verify_otp/', {'email': self.user.email, 'otp': code})
+        client.credentials(HTTP_AUTHORIZATION=f'Token {response.data["token"]}')
+        self.assertEqual(len(client.get('/api/secrets/').data['results']), 1)
+
+    def test_new_session_reads_its_login(self):
+        User.objects.create_superuser(email='admin@example.com', password='pw')
+        client = Client()
+        response = client.post('/admin/login/', {'username': 'admin@example.com', 'password': 'pw'})
+        self.assertEqual(response.status_code, 302)
+        # The session only exists on the primary; a replica read would log us out
+        self.assertEqual(client.get('/admin/').status_code, 200)
+
+    def test_scheduler_reads_next_expiry_from_primary(self):
+        with pin_scope():
+            self.assertEqual(next_expiry(), self.secret.expires_at)
+
+
+@skipUnless(connection.vendor == 'postgresql', 'Partitioning needs PostgreSQL (set DATABASE_URL)')
+class SecretPartitionTests(TransactionTestCase):
+    def test_partition_create_and_drop(self):
+        user = User.objects.create_user(email='owner@example.com')
+        now = timezone.now()
+        before = make_secret(user)
+        self.assertTrue(partition_secrets(days_ahead=3, now=now))
+        self.assertFalse(partition_secrets(now=now))
+        self.assertEqual(Secret.objects.consume(before.pk)[1], 'top secret')
+
+        # Past days the table didn't cover yet, and a day beyond the partitions
+        old_day = now - timedelta(days=5)
+        create_partitions(days_ahead=1, now=old_day)
+        old = make_secret(user, expires_at=old_day, blob_name='old-blob')
+        later = make_secret(user, expires_at=now + timedelta(days=20))
+        self.assertNotIn((now + timedelta(days=20)).date(), partitions(connection))
+        created = create_partitions(days_ahead=20, now=now)
+        self.assertIn(partition_name((now + timedelta(days=20)).date()), created)
+        self.assertEqual(Secret.objects.get(pk=later.pk).expires_at, later.expires_at)
+
+        with mock.patch('app.blobstore.FileSystemBlobStore.delete') as delete:
+            dropped = dict(drop_expired_partitions(grace=timedelta(days=1), now=now))
+        self.assertEqual(dropped[partition_name(old_day.date())], 1)
+        delete.assert_called_once_with('old-blob')
+        self.assertFalse(Secret.objects.filter(pk=old.pk).exists())
+        self.assertTrue(Secret.objects.filter(pk=later.pk).exists())
+
+
+class SecretPartitionCommandTests(TestCase):
+    def test_needs_postgresql(self):
+        if connection.vendor == 'postgresql':
+            self.skipTest('Covered by SecretPartitionTests')
+        with self.assertRaisesMessage(CommandError, 'Secret partitions need PostgreSQL'):
+            call_command('partition_secrets', stdout=io.StringIO())
+
+
+class AdminChangelistTests(TestCase):
+    def setUp(self):
+        self.admin = User.objects.create_superuser(email='admin@example.com', password='pw')
+        self.client.force_login(self.admin)
+
+    def changelist_queries(self, url):
+        with CaptureQueriesContext(connection) as captured:
+            self.assertEqual(self.client.get(url).status_code, 200)
+        return len(captured)
+
+    def test_secret_changelist(self):
+        owner = User.objects.create_user(email='owner@example.com')
+        secrets = [make_secret(owner) for _ in range(2)]
+        few = self.changelist_queries('/admin/app/secret/')
+        others = [User.objects.create_user(email=f'user{n}@example.com') for n in range(3)]
+        for user in others:
+            make_secret(user)
+        # Owners come with the page, not one query per row
+        self.assertEqual(self.changelist_queries('/admin/app/secret/'), few)
+
+        response = self.client.get('/admin/app/secret/', {'q': str(secrets[0].pk)})
+        self.assertEqual([secret.pk for secret in response.context['cl'].result_list], [secrets[0].pk])
+        response = self.client.get('/admin/app/secret/', {'q': 'user0@example.com'})
+        self.assertEqual(response.context['cl'].result_count, 1)
+
+    def test_estimated_count(self):
+        owner = User.objects.create_user(email='owner@example.com')
+        for _ in range(3):
+            make_secret(owner)
+        Secret.objects.filter(pk=Secret.objects.order_by('created_at')[0].pk).delete()
+        queryset = Secret.objects.order_by('-created_at')
+        self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 2)
+        if connection.vendor != 'sqlite':
+            return
+        with mock.patch.object(EstimatedCountPaginator, 'exact_below', 0):
+            # No estimate on SQLite, however big the table: deleted rows aren't counted
+            self.assertEqual(EstimatedCountPaginator(queryset, 10).count, 2)
+            self.assertEqual(EstimatedCountPaginator(queryset.filter(is_viewed=False), 10).count, 2)
+
+
+class SecretStatusTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.client = APIClient()
+        self.client.force_authenticate(self.user)
+
+    def create(self):
+        return self.client.post('/api/secrets/', {'message': 'hi'}, format='json').data['id']
+
+    def listed(self, status):
+        response = self.client.get('/api/secrets/', {'status': status})
+        return {item['id'] for item in response.data['results']}
+
+    def test_statuses_and_summary(self):
+        active, viewed, burned, expired, deleted = [self.create() for _ in range(5)]
+        self.client.post('/api/secrets/bulk/', [{'message': 'a'}], format='json')
+        Secret.objects.consume(viewed)
+        self.assertEqual(self.client.post(f'/api/secrets/{burned}/burn/').status_code, 200)
+        Secret.objects.filter(pk=expired).update(expires_at=timezone.now() - timedelta(minutes=1))
+        self.assertEqual(self.client.delete(f'/api/secrets/{deleted}/').status_code, 204)
+
+        self.assertIn(active, self.listed('active'))
+        self.assertEqual(self.listed('viewed'), {viewed})
+        self.assertEqual(self.listed('burned'), {burned})
+        self.assertEqual(self.listed('expired'), {expired})
+        self.assertEqual(self.client.get('/api/secrets/', {'status': 'lost'}).data['error'], 'Invalid status')
+
+        summary = self.client.get('/api/secrets/summary/').data
+        # The deleted secret counts as burned
+        self.assertEqual(summary, {'active': 2, 'viewed': 1, 'burned': 2, 'expired': 1, 'total': 6})
+
+    def test_burn(self):
+        secret_id = self.create()
+        self.assertEqual(self.client.post(f'/api/secrets/{secret_id}/burn/').data['message'], 'Secret burned')
+        secret = Secret.objects.get(pk=secret_id)
+        self.assertTrue(secret.is_destroyed)
+        self.assertEqual(bytes(secret.encrypted_message), b'')
+        response = self.client.post(f'/api/secrets/{secret_id}/burn/')
+        self.assertEqual(response.data['error'], 'Secret is no longer available')
+        with self.assertRaisesMessage(ValueError, 'already been viewed or destroyed'):
+            Secret.objects.consume(secret_id)
+        self.assertEqual(SecretCounts.objects.get(user=self.user).burned, 1)
+
+        # Only the owner can burn
+        other = APIClient()
+        other.force_authenticate(User.objects.create_user(email='other@example.com'))
+        self.assertEqual(other.post(f'/api/secrets/{self.create()}/burn/').status_code, 404)
+
+    def test_admin_add_is_counted(self):
+        secret = Secret(user=self.user, expires_at=timezone.now() + timedelta(minutes=5))
+        secret.encrypt_message('hi')
+        SecretAdmin(Secret, admin.site).save_model(None, secret, None, change=False)
+        summary = self.client.get('/api/secrets/summary/').data
+        self.assertEqual(summary, {'active': 1, 'viewed': 0, 'burned': 0, 'expired': 0, 'total': 1})
+
+    @skipUnless(connection.vendor == 'sqlite', 'Checks the SQLite query plan')
+    def test_active_count_uses_partial_index(self):
+        queryset = Secret.objects.filter(user=self.user).with_status('active')
+        self.assertIn('app_secret_unviewed_idx', queryset.explain())
+
+
+class SecretPurgeTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='owner@example.com')
+        old = timezone.now() - timedelta(days=3)
+        self.live = make_secret(self.user)
+        self.viewed = make_secret(self.user, is_viewed=True)
+        self.expired = [make_secret(self.user, expires_at=old) for _ in range(5)]
+        Secret.objects.filter(pk=self.viewed.pk).update(created_at=old)
+
+    def test_delete_in_batches(self):
+        batches = list(purge_secrets(batch_size=2, grace=timedelta(days=1)))
+        self.assertEqual(sum(rows for rows, _, _ in batches), 6)
+        self.assertTrue(all(size > 0 for _, size, _ in batches))
+        self.assertEqual(list(Secret.objects.values_list('pk', flat=True)), [self.live.pk])
+
+    def test_scrub_is_resumable(self):
+        first = next(purge_secrets(mode=PURGE_SCRUB, batch_size=4, grace=timedelta(days=1)))
+        self.assertEqual(first[0], 4)
+        rest = list(purge_secrets(mode=PURGE_SCRUB, batch_size=4, grace=timedelta(days=1)))
+        self.assertEqual([rows for rows, _, _ in rest], [2])
+        self.assertEqual(Secret.objects.count(), 7)
+        self.assertEqual(Secret.objects.exclude(encrypted_message=b'').get(), self.live)
+
+
+class ExpirySchedulerTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='owner@example.com')
+        now = timezone.now()
+        self.live = make_secret(self.user, expires_at=now + timedelta(minutes=5))
+        self.viewed = make_secret(self.user, is_viewed=True, expires_at=now - timedelta(minutes=1))
+        self.due = [make_secret(self.user, expires_at=now - timedelta(minutes=i)) for i in range(1, 4)]
+
+    def test_expires_oldest_first_in_batches(self):
+        self.assertEqual(expire_due_secrets(batch_size=2), 2)
+        self.assertEqual(set(Secret.objects.filter(is_destroyed=False, is_viewed=False)), {self.live, self.due[0]})
+        self.assertEqual(expire_due_secrets(batch_size=2), 1)
+        self.assertEqual(expire_due_secrets(batch_size=2), 0)
+        destroyed = Secret.objects.filter(is_destroyed=True)
+        self.assertEqual(set(destroyed), set(self.due))
+        self.assertFalse(destroyed.exclude(encrypted_message=b'').exists())
+        self.assertFalse(Secret.objects.get(pk=self.viewed.pk).is_destroyed)
+
+    def test_sleeps_until_next_expiry(self):
+        self.assertEqual(next_expiry(), self.due[-1].expires_at)
+        call_command('run_expiry_scheduler', '--once', '--batch-size=2', stdout=io.StringIO())
+        self.assertEqual(next_expiry(), self.live.expires_at)
+
+    def test_deletes_file_blobs(self):
+        Secret.objects.filter(pk=self.due[0].pk).update(blob_name='report')
+        store = mock.Mock()
+        with mock.patch('app.retention.get_blob_store', return_value=store):
+            self.assertEqual(expire_due_secrets(), 3)
+        store.delete.assert_called_once_with('report')
+
+
+class ExpirySchedulerConcurrencyTests(TransactionTestCase):
+    workers = 4
+
+    def test_workers_never_destroy_a_secret_twice(self):
+        user = User.objects.create_user(email='owner@example.com')
+        expired = timezone.now() - timedelta(minutes=1)
+        secrets = [make_secret(user, expires_at=expired) for _ in range(40)]
+        for secret in secrets:
+            Secret.objects.filter(pk=secret.pk).update(blob_name=secret.pk.hex)
+        store = mock.Mock()
+        barrier = threading.Barrier(self.workers)
+        destroyed = []
+
+        def worker():
+            barrier.wait()
+            try:
+                while count := expire_due_secrets(batch_size=5):
+                    destroyed.append(count)
+            finally:
+                connection.close()
+
+        with mock.patch('app.retention.get_blob_store', return_value=store):
+            threads = [threading.Thread(target=worker) for _ in range(self.workers)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+
+        self.assertEqual(sum(destroyed), len(secrets))
+        deleted = [call.args[0] for call in store.delete.call_args_list]
+        self.assertEqual(sorted(deleted), sorted(secret.pk.hex for secret in secrets))
+        self.assertEqual(Secret.objects.filter(is_destroyed=True).count(), len(secrets))
+
+
+class InactiveUserCleanupTests(TestCase):
+    def setUp(self):
+        blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(blob_root.cleanup)
+        overrides = override_settings(OTS_BLOB_ROOT=blob_root.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+
+        old = timezone.now() - timedelta(days=60)
+        self.inactive = [User.objects.create_user(email=f'old{i}@example.com', last_login_at=old) for i in range(5)]
+        self.active = User.objects.create_user(email='new@example.com', last_login_at=timezone.now())
+        User.objects.create_user(email='admin@example.com', last_login_at=old, is_superuser=True)
+        group = Group.objects.create(name='staff')
+        for user in [*self.inactive, self.active]:
+            make_secret(user)
+            user.groups.add(group)
+            CustomToken.objects.create(user=user, key=user.email[:40], expires_at=old)
+            OTP.objects.create(user=user, code='123456', expires_at=old)
+        self.file_secret = make_secret(self.inactive[0])
+        self.file_secret.encrypt_file(SimpleUploadedFile('a.txt', b'data'))
+        self.file_secret.save()
+
+    def test_deletes_dependents_without_loading_them(self):
+        with CaptureQueriesContext(connection) as queries:
+            batches = list(purge_inactive_users(days=30, batch_size=2))
+        self.assertEqual([users for users, _, _ in batches], [2, 2, 1])
+        self.assertEqual(sum(deleted['app.Secret'] for _, deleted, _ in batches), 6)
+        for query in queries.captured_queries:
+            self.assertNotIn('encrypted_message', query['sql'])
+
+        self.assertEqual(set(User.objects.values_list('email', flat=True)), {'new@example.com', 'admin@example.com'})
+        self.assertEqual(Secret.objects.get().user, self.active)
+        self.assertEqual(CustomToken.objects.get().user, self.active)
+        self.assertEqual(OTP.objects.get().user, self.active)
+        self.assertEqual(list(Group.objects.get().user_set.all()), [self.active])
+        with self.assertRaises(FileNotFoundError):
+            get_blob_store().open(self.file_secret.blob_name)
+
+    def test_command_dry_run_and_max_runtime(self):
+        out = io.StringIO()
+        call_command('cleanup_inactive_users', dry_run=True, stdout=out)
+        self.assertIn('Would delete 5 inactive users with 6 secrets and 5 tokens', out.getvalue())
+        self.assertEqual(User.objects.count(), 7)
+
+        # Stops after the first batch; a rerun picks up the rest
+        call_command('cleanup_inactive_users', batch_size=2, max_runtime=0, stdout=io.StringIO())
+        self.assertEqual(User.objects.count(), 5)
+        out = io.StringIO()
+        call_command('cleanup_inactive_users', days=30, stdout=out)
+        self.assertIn('Successfully deleted 3 inactive user accounts', out.getvalue())
+
+
+@override_settings(OTS_EMAIL_OUTBOX=True)
+class OutboxTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+
+    def test_login_only_enqueues(self):
+        response = APIClient().post('/api/users/login/', {'email': 'new@example.com'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(len(mail.outbox), 0)
+        self.assertEqual(outbox_stats()['due'], 1)
+
+        self.assertEqual(deliver_batch(), (1, 0))
+        self.assertEqual(mail.outbox[0].to, ['new@example.com'])
+        self.assertIn('Your OTP is:', mail.outbox[0].body)
+        self.assertFalse(OutboxEmail.objects.exists())
+
+    def test_failed_delivery_is_retried_with_backoff(self):
+        queue_mail('Subject', 'Body', None, ['a@example.com'])
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages',
+                        side_effect=OSError('connection reset')):
+            self.assertEqual(deliver_batch(), (0, 1))
+        email = OutboxEmail.objects.get()
+        self.assertEqual(email.attempts, 1)
+        self.assertEqual(email.last_error, 'connection reset')
+        self.assertGreater(email.next_attempt_at, timezone.now())
+        self.assertEqual(outbox_stats()['scheduled'], 1)
+        self.assertEqual(deliver_batch(), (0, 0))
+
+    def test_no_otp_outlives_delivery(self):
+        for email in ('sent@example.com', 'dead@example.com', 'late@example.com'):
+            APIClient().post('/api/users/login/', {'email': email}, format='json')
+        OutboxEmail.objects.filter(recipients=['late@example.com']).update(
+            created_at=timezone.now() - MAX_AGE - timedelta(seconds=1))
+        dead = OutboxEmail.objects.get(recipients=['dead@example.com'])
+        OutboxEmail.objects.filter(pk=dead.pk).update(attempts=MAX_ATTEMPTS - 1)
+
+        def send(messages):
+            if messages[0].to == ['dead@example.com']:
+                raise OSError('mailbox unavailable')
+            return 1
+        with mock.patch('django.core.mail.backends.locmem.EmailBackend.send_messages', side_effect=send):
+            self.assertEqual(deliver_batch(), (1, 1))
+
+        # Sent and expired emails are gone, the given up one kept without its code
+        dead.refresh_from_db()
+        self.assertEqual(dead.body, '')
+        self.assertEqual(list(OutboxEmail.objects.values_list('pk', flat=True)), [dead.pk])
+        self.assertEqual(outbox_stats()['dead'], 1)
+
+
+class TokenAuthenticationTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        token_usage.flush()
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.client, self.token = token_client(self.user)
+
+    @override_settings(OTS_AUTH_CACHE=True)
+    def test_cached_token_costs_no_queries(self):
+        authentication = CustomTokenAuthentication()
+        with self.assertNumQueries(1):
+            user, token = authentication.authenticate_credentials(self.token.key)
+            self.assertEqual(user, self.user)
+        with self.assertNumQueries(0):
+            authentication.authenticate_credentials(self.token.key)
+
+    @override_settings(OTS_AUTH_CACHE=False)
+    def test_per_process_cache_is_not_used(self):
+        # Another worker's logout could not clear this process' copy
+        authentication = CustomTokenAuthentication()
+        authentication.authenticate_credentials(self.token.key)
+        self.assertIsNone(cache.get(token_cache_key(self.token.key)))
+        CustomToken.objects.filter(pk=self.token.pk).delete()
+        with self.assertRaisesMessage(AuthenticationFailed, 'Invalid token'):
+            authentication.authenticate_credentials(self.token.key)
+
+    @override_settings(DEBUG=False, OTS_AUTH_CACHE=True)
+    def test_check_rejects_per_process_cache(self):
+        self.assertEqual([error.id for error in check_auth_cache(None)], ['app.E002'])
+        with override_settings(OTS_AUTH_CACHE=False):
+            self.assertEqual(check_auth_cache(None), [])
+
+    def test_last_used_at_is_written_behind(self):
+        CustomToken.objects.filter(pk=self.token.pk).update(last_used_at=timezone.now() - timedelta(hours=1))
+        CustomTokenAuthentication().authenticate_credentials(self.token.key)
+        stale = CustomToken.objects.get(pk=self.token.pk).last_used_at
+        self.assertLess(stale, timezone.now() - timedelta(minutes=30))
+        self.assertEqual(token_usage.flush(), 1)
+        self.assertGreater(CustomToken.objects.get(pk=self.token.pk).last_used_at, stale)
+
+    def test_logout_invalidates_cached_token(self):
+        self.assertEqual(self.client.get('/api/secrets/').status_code, 200)
+        self.assertEqual(self.client.post('/api/users/logout/').status_code, 200)
+        self.assertEqual(self.client.get('/api/secrets/').status_code, 401)
+
+
+class OTPStoreTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.user = User.objects.create_user(email='owner@example.com')
+
+    @override_settings(OTS_OTP_STORE='app.otp_store.CacheOTPStore')
+    def test_login_writes_no_otp_rows(self):
+        client = APIClient()
+        with CaptureQueriesContext(connection) as queries:
+            response = client.post('/api/users/login/', {'email': self.user.email})
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(any('app_otp' in query['sql'] for query in queries.captured_queries))
+        self.assertFalse(OTP.objects.exists())
+
+    def test_codes_are_hashed_and_consumed_once(self):
+        for store in (CacheOTPStore(), ModelOTPStore()):
+            with self.subTest(store=type(store).__name__):
+                code = store.issue(self.user)
+                if isinstance(store, CacheOTPStore):
+                    self.assertNotIn(code, str(cache.get(store.key(self.user))))
+                with self.assertRaisesMessage(ValueError, 'No matching OTP found'):
+                    store.verify(self.user, 'wrong')
+                store.verify(self.user, code)
+                with self.assertRaisesMessage(ValueError, 'No matching OTP found'):
+                    store.verify(self.user, code)
+
+    def test_expiry_and_attempt_limit(self):
+        for store in (CacheOTPStore(), ModelOTPStore()):
+            with self.subTest(store=type(store).__name__):
+                code = store.issue(self.user)
+                with self.assertRaisesMessage(ValueError, 'OTP expired at'):
+                    store.verify(self.user, code, now=timezone.now() + timedelta(minutes=11))
+
+                code = store.issue(self.user)
+                for _ in range(store.max_attempts - 1):
+                    with self.assertRaises(ValueError):
+                        store.verify(self.user, 'wrong')
+                with self.assertRaisesMessage(ValueError, 'No matching OTP found'):
+                    store.verify(self.user, 'wrong')
+                # The right code is no use after too many guesses
+                with self.assertRaisesMessage(ValueError, 'Too many attempts'):
+                    store.verify(self.user, code)
+
+    def test_attempt_counter_evicted_before_incr(self):
+        store = CacheOTPStore()
+        code = store.issue(self.user)
+        key = store.attempts_key(self.user)
+        cache.set(key, 1)
+
+        def evicted(key, *args, **kwargs):
+            cache.delete(key)
+            raise ValueError(f"Key '{key}' not found")
+
+        # The counter vanishing between add() and incr() must not leak that error
+        with mock.patch.object(cache, 'incr', side_effect=evicted):
+            store.verify(self.user, code)
+        self.assertEqual(cache.get(key), 1)
+
+    def test_model_store_counts_attempts_on_the_row(self):
+        store = ModelOTPStore()
+        code = store.issue(self.user)
+        for _ in range(store.max_attempts):
+            with self.assertRaises(ValueError):
+                store.verify(self.user, 'wrong')
+            # As if each guess went to another worker, with its own cache
+            cache.clear()
+        self.assertEqual(OTP.objects.get(user=self.user).attempts, store.max_attempts)
+        with self.assertRaisesMessage(ValueError, 'Too many attempts'):
+            store.verify(self.user, code)
+        self.assertFalse(OTP.objects.exists())
+
+    @override_settings(DEBUG=False, OTS_OTP_STORE='app.otp_store.CacheOTPStore')
+    def test_check_rejects_per_process_cache(self):
+        errors = check_otp_store(None)
+        self.assertEqual([error.id for error in errors], ['app.E001'])
+        with override_settings(OTS_OTP_STORE='app.otp_store.ModelOTPStore'):
+            self.assertEqual(check_otp_store(None), [])
+
+
+@override_settings(OTS_SIGNED_TOKENS=True)
+class SignedTokenTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.code = get_otp_store().issue(self.user)
+        self.client = APIClient()
+
+    def login(self):
+        response = self.client.post('/api/users/verify_otp/', {'email': self.user.email, 'otp': self.code})
+        self.assertEqual(response.status_code, 200)
+        return response.data['token']
+
+    @override_settings(OTS_AUTH_CACHE=True)
+    def test_verified_in_memory_and_revoked_on_logout(self):
+        key = self.login()
+        self.assertFalse(CustomToken.objects.exists())
+
+        authentication = CustomTokenAuthentication()
+        authentication.authenticate_credentials(key)
+        with self.assertNumQueries(0):
+            user, token = authentication.authenticate_credentials(key)
+        self.assertEqual(user, self.user)
+
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {key}')
+        self.assertEqual(self.client.get('/api/secrets/').status_code, 200)
+        self.assertEqual(self.client.post('/api/users/logout/').status_code, 200)
+        self.assertEqual(self.client.get('/api/secrets/').status_code, 401)
+
+    def test_tampered_expired_and_unknown_key_rejected(self):
+        key = self.login()
+        payload, _, sig = key.rpartition('.')
+        prefix, kid, user_id, issued, expires = payload.split('.')
+        forged = f'{prefix}.{kid}.{user_id}.{issued}.{int(expires) + 3600}.{sig}'
+        expired, _ = issue_token(self.user.pk, timezone.now() - timedelta(minutes=5), timedelta(minutes=1))
+        authentication = CustomTokenAuthentication()
+        for bad, detail in ((forged, 'Invalid token'), (expired, 'Token has expired')):
+            with self.assertRaisesMessage(AuthenticationFailed, detail):
+                authentication.authenticate_credentials(bad)
+
+        # Tokens signed by a key that is no longer listed stop working
+        with override_settings(OTS_TOKEN_SIGNING_KEYS=['new-key']):
+            with self.assertRaisesMessage(AuthenticationFailed, 'Invalid token'):
+                authentication.authenticate_credentials(key)
+        with override_settings(OTS_TOKEN_SIGNING_KEYS=['new-key', *settings.OTS_TOKEN_SIGNING_KEYS]):
+            self.assertEqual(authentication.authenticate_credentials(key)[0], self.user)
+
+
+# As deployed with a shared cache
+@override_settings(OTS_EMAIL_OUTBOX=True, OTS_OTP_STORE='app.otp_store.CacheOTPStore', OTS_AUTH_CACHE=True)
+class QueryBudgetTests(TestCase):
+    """Pins the queries (and writes) of every hot path; raise a budget only on purpose"""
+
+    def setUp(self):
+        reset_throttles()
+        token_usage.flush()
+        self.client = APIClient()
+        self.user = User.objects.create_user(email='owner@example.com', last_login_at=timezone.now())
+
+    @contextmanager
+    def assertBudget(self, queries, writes):
+        with CaptureQueriesContext(connection) as captured:
+            yield
+        statements = [
+            q['sql'] for q in captured.captured_queries
+            if not q['sql'].startswith(('BEGIN', 'COMMIT', 'ROLLBACK', 'SAVEPOINT', 'RELEASE SAVEPOINT'))
+        ]
+        executed = '\n'.join(statements)
+        self.assertEqual(len(statements), queries, f'Queries:\n{executed}')
+        self.assertEqual(
+            sum(sql.startswith(('INSERT', 'UPDATE', 'DELETE')) for sql in statements), writes,
+            f'Queries:\n{executed}',
+        )
+
+    def authenticate(self):
+        code = get_otp_store().issue(self.user)
+        response = self.client.post('/api/users/verify_otp/', {'email': self.user.email, 'otp': code})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {response.data["token"]}')
+
+    def test_login(self):
+        # user lookup, last_login_at, queued email
+        with self.assertBudget(queries=3, writes=2):
+            self.assertEqual(self.client.post('/api/users/login/', {'email': self.user.email}).status_code, 200)
+        with self.assertBudget(queries=3, writes=2):
+            self.assertEqual(self.client.post('/api/users/login/', {'email': 'new@example.com'}).status_code, 200)
+
+    def test_verify_otp(self):
+        code = get_otp_store().issue(self.user)
+        # user lookup, last_login_at, token
+        with self.assertBudget(queries=3, writes=2):
+            response = self.client.post('/api/users/verify_otp/', {'email': self.user.email, 'otp': code})
+        self.assertEqual(response.status_code, 200)
+
+    @override_settings(OTS_SIGNED_TOKENS=True)
+    def test_verify_otp_and_first_request_with_signed_token(self):
+        code = get_otp_store().issue(self.user)
+        with self.assertBudget(queries=2, writes=1):
+            response = self.client.post('/api/users/verify_otp/', {'email': self.user.email, 'otp': code})
+        self.client.credentials(HTTP_AUTHORIZATION=f'Token {response.data["token"]}')
+        with self.assertBudget(queries=2, writes=0):
+            self.assertEqual(self.client.get('/api/secrets/').status_code, 200)
+        with self.assertBudget(queries=1, writes=0):
+            self.assertEqual(self.client.get('/api/secrets/').status_code, 200)
+
+    def test_secret_endpoints(self):
+        self.authenticate()
+        # First request loads the token and creates the owner's counters,
+        # later ones hit the cache and only bump them
+        with self.assertBudget(queries=4, writes=3):
+            response = self.client.post('/api/secrets/', {'message': 'hi'}, format='json')
+        plain = response.data['id']
+        with self.assertBudget(queries=2, writes=2):
+            protected = self.client.post('/api/secrets/', {'message': 'hi', 'passphrase': 'pw'}, format='json').data['id']
+        with self.assertBudget(queries=2, writes=2):
+            self.client.post('/api/secrets/bulk/', [{'message': 'a'}, {'message': 'b'}], format='json')
+        with self.assertBudget(queries=1, writes=0):
+            self.assertEqual(self.client.get('/api/secrets/').status_code, 200)
+        with self.assertBudget(queries=1, writes=0):
+            self.assertEqual(self.client.get('/api/secrets/', {'status': 'active'}).status_code, 200)
+        with self.assertBudget(queries=2, writes=0):
+            self.assertEqual(self.client.get('/api/secrets/summary/').status_code, 200)
+
+        anonymous = APIClient()
+        with self.assertBudget(queries=2, writes=2):
+            self.assertEqual(anonymous.get(f'/api/secrets/{plain}/').status_code, 200)
+        with self.assertBudget(queries=3, writes=2):
+            response = anonymous.post(f'/api/secrets/{protected}/view_protected/', {'passphrase': 'pw'})
+        self.assertEqual(response.status_code, 200)
+
+    def test_logout(self):
+        self.authenticate()
+        self.client.get('/api/secrets/')
+        # token keys for the cache, one DELETE
+        with self.assertBudget(queries=2, writes=1):
+            self.assertEqual(self.client.post('/api/users/logout/').status_code, 200)
+
+
+@skipUnless(connection.vendor == 'sqlite', 'SQLite only')
+class SQLiteTuningTests(TestCase):
+    def test_connections_are_tuned(self):
+        with connection.cursor() as cursor:
+            cursor.execute('PRAGMA busy_timeout')
+            self.assertEqual(cursor.fetchone()[0], settings.OTS_SQLITE_BUSY_TIMEOUT_MS)
+        self.assertEqual(connection.transaction_mode, 'IMMEDIATE')
+        self.assertEqual(sum(isinstance(wrapper, LockRetry) for wrapper in connection.execute_wrappers), 1)
+
+    def test_lock_retry(self):
+        from django.db import OperationalError
+        calls = []
+
+        def execute(sql, params, many, context):
+            calls.append(sql)
+            if len(calls) < 3:
+                raise OperationalError('database is locked')
+            return 'done'
+
+        retry = LockRetry(mock.Mock(in_atomic_block=False), attempts=5)
+        with mock.patch('app.sqlite.time.sleep') as sleep:
+            self.assertEqual(retry(execute, 'BEGIN IMMEDIATE', None, False, {}), 'done')
+        self.assertEqual(len(calls), 3)
+        self.assertEqual(sleep.call_count, 2)
+
+        # Inside a transaction the statement is not repeated
+        calls.clear()
+        retry = LockRetry(mock.Mock(in_atomic_block=True), attempts=5)
+        with self.assertRaises(OperationalError):
+            retry(execute, 'UPDATE app_secret SET is_viewed = 1', None, False, {})
+        self.assertEqual(len(calls), 1)
+
+
+class SharedThrottleTests(TestCase):
+    def test_gcra_limits_across_store_instances(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            path = f'{tmp}/throttle.sqlite3'
+            # Two stores on one file behave like two worker processes
+            first, second = SharedThrottleStore(path), SharedThrottleStore(path)
+            now = 1000.0
+            allowed = [store.hit('k', 5, 60, now) == 0 for store in (first, second) * 3]
+            self.assertEqual(allowed, [True] * 5 + [False])
+            self.assertAlmostEqual(first.hit('k', 5, 60, now), 12.0)
+            self.assertEqual(second.hit('k', 5, 60, now + 12), 0)
+            self.assertEqual(first.hit('other', 5, 60, now), 0)
+
+    def test_login_is_throttled(self):
+        reset_throttles()
+        client = APIClient()
+        codes = [client.post('/api/users/login/', {'email': 'a@example.com'}).status_code for _ in range(6)]
+        self.assertEqual(codes, [200] * 5 + [429])
+
+
+class SecretListTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.client, _ = token_client(self.user)
+        for i in range(25):
+            make_secret(self.user, message=f'secret {i}')
+
+    def test_cursor_pages_without_count_or_payload(self):
+        seen = []
+        url = '/api/secrets/'
+        while url:
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.get(url)
+            self.assertEqual(response.status_code, 200)
+            seen += [item['id'] for item in response.data['results']]
+            url = response.data['next']
+            for query in queries.captured_queries:
+                self.assertNotIn('COUNT(', query['sql'])
+                self.assertNotIn('encrypted_message', query['sql'])
+        self.assertEqual(len(seen), 25)
+        self.assertEqual(len(set(seen)), 25)
+
+
+class SecretBulkCreateTests(TestCase):
+    def setUp(self):
+        self.user = User.objects.create_user(email='bulk@example.com')
+        self.client, _ = token_client(self.user)
+
+    def test_one_insert_in_input_order(self):
+        items = [{'message': f'secret {i}'} for i in range(5)]
+        items[2]['passphrase'] = 'pass'
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.post('/api/secrets/bulk/', items, format='json')
+        self.assertEqual(response.status_code, 201)
+        inserts = [q for q in queries.captured_queries if q['sql'].startswith('INSERT INTO "app_secret"')]
+        self.assertEqual(len(inserts), 1)
+
+        for i, item in enumerate(response.data):
+            secret = Secret.objects.get(pk=item['id'])
+            self.assertEqual(secret.user, self.user)
+            self.assertEqual(secret.has_passphrase, i == 2)
+            self.assertEqual(secret.read_message(), f'secret {i}')
+
+    def test_invalid_item_rejects_whole_batch(self):
+        response = self.client.post(
+            '/api/secrets/bulk/',
+            [{'message': 'fine'}, {'expiry_minutes': 5}],
+            format='json',
+        )
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(list(response.json()), ['1'])
+        self.assertFalse(Secret.objects.exists())
+
+        with override_settings(OTS_MAX_BULK_SECRETS=2):
+            response = self.client.post('/api/secrets/bulk/', [{'message': 'x'}] * 3, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class FileSecretTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(self.blob_root.cleanup)
+        overrides = override_settings(OTS_BLOB_ROOT=self.blob_root.name)
+        overrides.enable()
+        self.addCleanup(overrides.disable)
+        self.user = User.objects.create_user(email='owner@example.com')
+        self.client, _ = token_client(self.user)
+
+    def upload(self, content, **data):
+        upload = SimpleUploadedFile('report.pdf', content, content_type='application/pdf')
+        response = self.client.post('/api/secrets/', {'file': upload, **data}, format='multipart')
+        self.assertEqual(response.status_code, 201, response.data)
+        return Secret.objects.get(pk=response.data['id'])
+
+    @mock.patch('app.blobstore.CHUNK_SIZE', 1000)
+    def test_file_is_streamed_once(self):
+        content = os.urandom(4500)
+        secret = self.upload(content, passphrase='hunter2')
+        self.assertEqual(secret.encrypted_message, b'')
+        self.assertEqual(secret.file_size, 4500)
+        blob_path = get_blob_store().path(secret.blob_name)
+        self.assertTrue(os.path.exists(blob_path))
+
+        url = f'/api/secrets/{secret.pk}/view_protected/'
+        response = self.client.post(url, {'passphrase': 'hunter2'}, format='json')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn('attachment; filename="report.pdf"', response['Content-Disposition'])
+        self.assertEqual(b''.join(response.streaming_content), content)
+        response.close()
+        self.assertFalse(os.path.exists(blob_path))
+
+        response = self.client.post(url, {'passphrase': 'hunter2'}, format='json')
+        self.assertEqual(response.data['error'], 'Secret is no longer available')
+
+    def test_tampered_chunks_are_rejected(self):
+        fernet = Fernet(Fernet.generate_key())
+        chunks = list(encrypt_chunks(fernet, [b'one', b'two', b'three']))
+        stream = io.BytesIO(chunks[1] + chunks[0] + chunks[2])
+        with self.assertRaisesMessage(ValueError, 'out of order'):
+            list(decrypt_chunks(fernet, stream))
+        stream = io.BytesIO(chunks[0] + chunks[1])
+        with self.assertRaisesMessage(ValueError, 'truncated'):
+            list(decrypt_chunks(fernet, stream))
+
+    def test_message_or_file_required(self):
+        response = self.client.post('/api/secrets/', {}, format='json')
+        self.assertEqual(response.status_code, 400)
+
+
+class KeyRotationTests(TestCase):
+    old_key = Fernet.generate_key().decode()
+    new_key = Fernet.generate_key().decode()
+
+    def test_rotate_keys_rewraps_without_reading_ciphertext(self):
+        user = User.objects.create_user(email='owner@example.com')
+        with override_settings(OTS_MASTER_KEYS=[self.old_key]):
+            wrapped = make_secret(user, message='wrapped')
+            self.assertTrue(wrapped.key_wrapped)
+            self.assertNotEqual(bytes(wrapped.encryption_key), wrapped.data_key())
+
+        legacy_key = Fernet.generate_key()
+        legacy = Secret.objects.create(
+            user=user,
+            encrypted_message=Fernet(legacy_key).encrypt(b'legacy'),
+            encryption_key=legacy_key,
+            expires_at=timezone.now() + timedelta(minutes=10),
+        )
+
+        with override_settings(OTS_MASTER_KEYS=[self.new_key, self.old_key]):
+            current = make_secret(user, message='current')
+            with CaptureQueriesContext(connection) as queries:
+                call_command('rotate_keys', batch_size=1, stdout=io.StringIO())
+        for query in queries.captured_queries:
+            self.assertNotIn('encrypted_message', query['sql'])
+        updates = [q for q in queries.captured_queries if 'UPDATE' in q['sql']]
+        self.assertEqual(len(updates), 2)
+
+        with override_settings(OTS_MASTER_KEYS=[self.new_key]):
+            for secret, message in ((wrapped, 'wrapped'), (legacy, 'legacy'), (current, 'current')):
+                self.assertEqual(Secret.objects.consume(secret.pk)[1], message)
+
+
+class PassphraseKDFTests(TestCase):
+    def test_hash_and_verify(self):
+        stored = kdf.make_hash('hunter2', n=2 ** 10)
+        self.assertTrue(stored.startswith(b'scrypt$1024$8$1$'))
+        self.assertNotIn(b'hunter2', stored)
+        self.assertTrue(kdf.verify_hash('hunter2', stored))
+        self.assertFalse(kdf.verify_hash('hunter3', stored))
+        # Passphrases stored before hashing still verify
+        self.assertTrue(kdf.verify_hash('legacy', b'legacy'))
+
+    def test_saturated_pool_returns_503(self):
+        reset_throttles()
+        user = User.objects.create_user(email='owner@example.com')
+        secret = make_secret(user, passphrase='hunter2')
+        pool = kdf.KDFPool(workers=1, queue_limit=0)
+        release = threading.Event()
+        busy = pool.submit(release.wait)
+        try:
+            with mock.patch('app.kdf.get_pool', return_value=pool):
+                response = APIClient().post(
+                    f'/api/secrets/{secret.pk}/view_protected/', {'passphrase': 'hunter2'}, format='json'
+                )
+            self.assertEqual(response.status_code, 503)
+        finally:
+            release.set()
+            busy.result()
+        self.assertFalse(Secret.objects.get(pk=secret.pk).is_viewed)
+
+    @override_settings(OTS_PASSPHRASE_SCRYPT_N=2 ** 10)
+    def test_bulk_hashes_share_the_pool(self):
+        # No queue slots at all: only one call per thread may be in flight
+        pool = kdf.KDFPool(workers=2, queue_limit=0)
+        with mock.patch('app.kdf.get_pool', return_value=pool):
+            hashes = kdf.hash_passphrases([f'pass {i}' for i in range(5)])
+        self.assertEqual(len(hashes), 5)
+        self.assertTrue(kdf.verify_hash('pass 3', hashes[3]))
+        self.assertFalse(kdf.verify_hash('pass 3', hashes[2]))
+
+
+@override_settings(OTS_EMAIL_OUTBOX=True, OTS_OTP_STORE='app.otp_store.CacheOTPStore')
+class AsyncEndpointTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+
+    async def test_login_verify_create_and_consume(self):
+        client = AsyncClient()
+        response = await client.post('/api/async/users/login/', {'email': 'a@example.com'},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json(), {'message': 'OTP sent to your email', 'is_new_user': False})
+        self.assertEqual(await OutboxEmail.objects.acount(), 1)
+
+        email = await OutboxEmail.objects.aget()
+        otp = email.body.rsplit(':', 1)[1].strip()
+        self.assertFalse(await OTP.objects.aexists())
+        response = await client.post('/api/async/users/verify_otp/', {'email': 'a@example.com', 'otp': otp},
+                                     content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        token = response.json()['token']
+
+        response = await client.post('/api/async/secrets/', {'message': 'hi', 'passphrase': 'hunter2'},
+                                     content_type='application/json', headers={'Authorization': f'Token {token}'})
+        self.assertEqual(response.status_code, 201)
+        secret_id = response.json()['id']
+
+        url = f'/api/async/secrets/{secret_id}/view_protected/'
+        response = await client.post(url, {'passphrase': 'wrong'}, content_type='application/json')
+        self.assertEqual(response.json()['error'], 'Invalid passphrase')
+        response = await client.post(url, {'passphrase': 'hunter2'}, content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['message'], 'hi')
+        response = await client.post(url, {'passphrase': 'hunter2'}, content_type='application/json')
+        self.assertEqual(response.json()['error'], 'Secret is no longer available')
+
+    async def test_matches_sync_response(self):
+        user = await User.objects.acreate(email='owner@example.com')
+        first, second = [await sync_to_async(make_secret)(user) for _ in range(2)]
+        sync_response = await sync_to_async(APIClient().get)(f'/api/secrets/{first.pk}/')
+        async_response = await AsyncClient().get(f'/api/async/secrets/{second.pk}/')
+        expected = {**json.loads(sync_response.content), 'id': str(second.pk)}
+        expected['created_at'] = async_response.json()['created_at']
+        expected['expires_at'] = async_response.json()['expires_at']
+        self.assertEqual(async_response.json(), expected)
+
+    async def test_create_requires_token(self):
+        response = await AsyncClient().post('/api/async/secrets/', {'message': 'hi'},
+                                            content_type='application/json')
+        self.assertEqual(response.status_code, 401)
+
+    @mock.patch('app.blobstore.CHUNK_SIZE', 1000)
+    async def test_file_is_streamed_without_buffering(self):
+        blob_root = tempfile.TemporaryDirectory()
+        self.addCleanup(blob_root.cleanup)
+        # Spool the upload to disk so it is read back in CHUNK_SIZE pieces
+        with override_settings(OTS_BLOB_ROOT=blob_root.name, FILE_UPLOAD_MAX_MEMORY_SIZE=0):
+            user = await User.objects.acreate(email='owner@example.com')
+            token = await CustomToken.objects.acreate(user=user, key='f' * 40,
+                                                      expires_at=timezone.now() + timedelta(minutes=1))
+            client = APIClient()
+            client.credentials(HTTP_AUTHORIZATION=f'Token {token.key}')
+            content = os.urandom(4500)
+            upload = SimpleUploadedFile('report.pdf', content, content_type='application/pdf')
+            created = await sync_to_async(client.post)('/api/secrets/', {'file': upload}, format='multipart')
+            request = AsyncRequestFactory().get(f'/api/async/secrets/{created.data["id"]}/')
+            response = await async_views.retrieve_secret(request, created.data['id'])
+            self.assertEqual(response.status_code, 200)
+            self.assertTrue(response.is_async)
+            chunks = [chunk async for chunk in response.streaming_content]
+            self.assertGreater(len(chunks), 1)
+            self.assertEqual(b''.join(chunks), content)
+
+
+@override_settings(OTS_FAST_JSON=True)
+class ORJSONAsyncEndpointTests(AsyncEndpointTests):
+    """The async views again, rendering and parsing with orjson"""
+
+
+class MetricsTests(TestCase):
+    def setUp(self):
+        reset_throttles()
+        self.tmp = tempfile.TemporaryDirectory()
+        self.addCleanup(self.tmp.cleanup)
+        self.settings = override_settings(OTS_METRICS_DB=os.path.join(self.tmp.name, 'metrics.sqlite3'))
+        self.settings.enable()
+        self.addCleanup(self.settings.disable)
+        # Drop whatever earlier tests counted
+        metrics.flush()
+        get_metrics_store().clear()
+
+    def test_processes_add_up(self):
+        # Two registries stand in for two worker processes
+        first, second = MetricsRegistry(), MetricsRegistry()
+        first.inc('ots_throttle_rejections_total', scope='login')
+        second.inc('ots_throttle_rejections_total', 2, scope='login')
+        first.observe('ots_email_send_duration_seconds', 0.02, result='sent')
+        second.observe('ots_email_send_duration_seconds', 3, result='sent')
+        first.flush()
+        second.flush()
+
+        text = MetricsRegistry().render()
+        self.assertIn('ots_throttle_rejections_total{scope="login"} 3', text)
+        self.assertIn('ots_email_send_duration_seconds_bucket{result="sent",le="0.025"} 1', text)
+        self.assertIn('ots_email_send_duration_seconds_bucket{result="sent",le="+Inf"} 2', text)
+        self.assertIn('ots_email_send_duration_seconds_count{result="sent"} 2', text)
+
+    def test_endpoint_reports_actions_and_queries(self):
+        user = User.objects.create_user(email='owner@example.com')
+        secret = make_secret(user)
+        self.client.get(f'/api/secrets/{secret.pk}/')
+        self.client.get(f'/api/secrets/{secret.pk}/')
+
+        response = self.client.get('/api/metrics')
+        self.assertEqual(response.status_code, 200)
+        text = response.content.decode()
+        self.assertIn('ots_http_requests_total{action="retrieve",method="GET",status="200"} 1', text)
+        self.assertIn('ots_http_requests_total{action="retrieve",method="GET",status="400"} 1', text)
+        self.assertIn('ots_db_queries_total{action="retrieve"}', text)
+        self.assertIn('ots_crypto_duration_seconds_count{operation="decrypt"} 1', text)
+
+        with override_settings(OTS_METRICS_TOKEN='scrape'):
+            self.assertEqual(self.client.get('/api/metrics').status_code, 401)
+            response = self.client.get('/api/metrics', headers={'Authorization': 'Bearer scrape'})
+            self.assertEqual(response.status_code, 200)
+
+    @override_settings(OTS_EMAIL_OUTBOX=True)
+    async def test_async_views_report_queries(self):
+        response = await AsyncClient().post('/api/async/users/login/', {'email': 'a@example.com'},
+                                            content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        text = (await AsyncClient().get('/api/metrics')).content.decode()
+        self.assertRegex(text, r'ots_db_queries_total\{action="login"\} [1-9]')
+
+    @override_settings(OTS_EMAIL_OUTBOX=True)
+    def test_failed_flush_keeps_the_response(self):
+        error = sqlite3.OperationalError('database is locked')
+        with mock.patch.object(metrics, 'flush_due', return_value=True), \
+                mock.patch('app.metrics.SharedMetricsStore.add', side_effect=error), \
+                self.assertLogs('app.metrics', 'ERROR'):
+            response = self.client.post('/api/users/login/', {'email': 'a@example.com'},
+                                        content_type='application/json')
+        self.assertEqual(response.status_code, 200)
+        # Kept for the next flush
+        self.assertIn('ots_http_requests_total{action="login",method="POST",status="200"} 1',
+                      self.client.get('/api/metrics').content.decode())
+
+
+class APIBenchmarkTests(TransactionTestCase):
+    def test_bench_api_reports_every_endpoint(self):
+        with tempfile.TemporaryDirectory() as tmp:
+            output = os.path.join(tmp, 'results.json')
+            call_command('bench_api', users=2, concurrency=1, secrets=2, output=output, stdout=io.StringIO())
+            with open(output) as f:
+                report = json.load(f)
+        for endpoint, row in report['endpoints'].items():
+            self.assertGreater(row['requests'], 0, endpoint)
+            self.assertEqual(row['errors'], 0, endpoint)
+        self.assertFalse(User.objects.filter(email__startswith='bench-').exists())
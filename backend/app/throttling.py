@@ -1,13 +1,83 @@
+from django.conf import settings
 from rest_framework.throttling import AnonRateThrottle
 
-class LoginRateThrottle(AnonRateThrottle):
-    rate = '5/minute'  # 5 attempts per minute per IP
+from .metrics import metrics
+from .sqlite_store import SharedSQLiteStore, get_shared_store
+
+class SharedThrottleStore(SharedSQLiteStore):
+    """GCRA counters in a SQLite (WAL) file shared by every worker process on the host.
+
+    Each key holds a single "theoretical arrival time", so memory per client
+    is fixed no matter how many requests it makes. A check is one UPSERT.
+    """
+    schema = 'CREATE TABLE IF NOT EXISTS throttle (key TEXT PRIMARY KEY, tat REAL NOT NULL) WITHOUT ROWID'
+    # Drop fully recovered keys after this many checks per thread
+    prune_every = 1000
+
+    def hit(self, key, num_requests, duration, now):
+        """Record a request; returns 0 if allowed, else the seconds to wait"""
+        interval = duration / num_requests
+        connection = self.connection
+        allowed = connection.execute(
+            'INSERT INTO throttle (key, tat) VALUES (:key, :now + :interval) '
+            'ON CONFLICT(key) DO UPDATE SET tat = max(tat, :now) + :interval '
+            'WHERE max(tat, :now) + :interval - :now <= :duration',
+            {'key': key, 'now': now, 'interval': interval, 'duration': duration},
+        ).rowcount
+
+        self._local.checks = getattr(self._local, 'checks', 0) + 1
+        if self._local.checks % self.prune_every == 0:
+            connection.execute('DELETE FROM throttle WHERE tat < ?', (now,))
+
+        if allowed:
+            return 0
+        row = connection.execute('SELECT tat FROM throttle WHERE key = ?', (key,)).fetchone()
+        return max(row[0] + interval - now - duration, 0) if row else 0
+
+    def clear(self):
+        self.connection.execute('DELETE FROM throttle')
+
+def get_throttle_store():
+    """The shared store for OTS_THROTTLE_DB, or None to use Django's cache"""
+    return get_shared_store(SharedThrottleStore, settings.OTS_THROTTLE_DB)
+
+class SharedRateThrottle(AnonRateThrottle):
+    """Per-IP throttle enforced across all worker processes via SharedThrottleStore.
+
+    Falls back to DRF's cache-based sliding log when OTS_THROTTLE_DB is unset.
+    """
+
+    def allow_request(self, request, view):
+        store = get_throttle_store()
+        if store is None:
+            return super().allow_request(request, view)
+        if self.rate is None:
+            return True
+
+        self.key = self.get_cache_key(request, view)
+        if self.key is None:
+            return True
+
+        self.remaining_wait = store.hit(self.key, self.num_requests, self.duration, self.timer())
+        if self.remaining_wait:
+            return self.throttle_failure()
+        return True
+
+    def throttle_failure(self):
+        metrics.inc('ots_throttle_rejections_total', scope=self.scope)
+        return super().throttle_failure()
+
+    def wait(self):
+        if get_throttle_store() is None:
+            return super().wait()
+        return self.remaining_wait
+
+# Rates come from REST_FRAMEWORK['DEFAULT_THROTTLE_RATES'] (5 per minute per IP by default)
+class LoginRateThrottle(SharedRateThrottle):
     scope = 'login'
 
-class OTPVerifyRateThrottle(AnonRateThrottle):
-    rate = '5/minute'  # 5 attempts per minute per IP
+class OTPVerifyRateThrottle(SharedRateThrottle):
     scope = 'otp_verify'
 
-class SecretViewRateThrottle(AnonRateThrottle):
-    rate = '5/minute'  # 5 attempts per minute per IP
-    scope = 'secret_view' 
\ No newline at end of file
+class SecretViewRateThrottle(SharedRateThrottle):
+    scope = 'secret_view'
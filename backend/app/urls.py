@@ -1,11 +1,22 @@
 from django.urls import path, include
 from rest_framework.routers import DefaultRouter
-from . import views
+from . import async_views, views
 
 router = DefaultRouter()
 router.register(r'users', views.UserViewSet)
 router.register(r'secrets', views.SecretViewSet)
 
+# Native async versions of the hot endpoints, for ASGI deployments
+async_urlpatterns = [
+    path('users/login/', async_views.login),
+    path('users/verify_otp/', async_views.verify_otp),
+    path('secrets/', async_views.create_secret),
+    path('secrets/<uuid:pk>/', async_views.retrieve_secret),
+    path('secrets/<uuid:pk>/view_protected/', async_views.view_protected),
+]
+
 urlpatterns = [
+    path('metrics', views.metrics_exposition),
+    path('async/', include(async_urlpatterns)),
     path('', include(router.urls)),
 ] 
\ No newline at end of file
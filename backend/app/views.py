@@ -1,25 +1,31 @@
 from django.shortcuts import render
 from rest_framework import viewsets, status, generics
-from rest_framework.decorators import action, throttle_classes
+from rest_framework.decorators import action
 from rest_framework.response import Response
 from rest_framework.permissions import IsAuthenticated, AllowAny
 from django.utils import timezone
 from django.shortcuts import get_object_or_404
 from rest_framework.authtoken.models import Token
+import hmac
 import random
 import string
-from django.http import JsonResponse
+import uuid
+from django.http import Http404, HttpResponse, JsonResponse, StreamingHttpResponse
+from django.utils.http import content_disposition_header
 from django.views.decorators.http import require_http_methods
 from rest_framework.throttling import UserRateThrottle, AnonRateThrottle
 from rest_framework.authentication import TokenAuthentication
 from rest_framework.exceptions import AuthenticationFailed
 from django.contrib.auth import get_user_model
-from django.core.mail import send_mail
 from django.conf import settings
 from django.db.models import Q
 
-from .models import User, OTP, Secret, Token as CustomToken
-from .authentication import CustomTokenAuthentication
+from .metrics import metrics
+from .models import SECRET_STATUSES, User, Secret, SecretCounts
+from .authentication import CustomTokenAuthentication, create_session_token, delete_user_tokens
+from .otp_store import get_otp_store
+from .outbox import queue_mail
+from .pagination import SecretCursorPagination
 from .serializers import (
     UserSerializer,
     UserRegistrationSerializer,
@@ -27,6 +33,7 @@ from .serializers import (
     OTPVerificationSerializer,
     SecretCreateSerializer,
     SecretViewSerializer,
+    consumed_secret_data,
 )
 from .throttling import LoginRateThrottle, OTPVerifyRateThrottle, SecretViewRateThrottle
 
@@ -36,17 +43,35 @@ def generate_otp():
     """Generate a 6-digit alphanumeric OTP"""
     return ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
 
+def file_response(instance, chunks=None):
+    """Stream a claimed file secret back to the client; async views pass
+    instance.aiter_file() as `chunks`"""
+    if chunks is None:
+        chunks = instance.iter_file()
+    response = StreamingHttpResponse(chunks, content_type=instance.content_type)
+    response['Content-Length'] = str(instance.file_size)
+    response['Content-Disposition'] = content_disposition_header(True, instance.file_name or str(instance.id))
+    response['Cache-Control'] = 'no-store'
+    return response
+
 @require_http_methods(["GET"])
 def ratelimited_view(request):
     return JsonResponse({"message": "Rate limit exceeded"}, status=429)
 
+@require_http_methods(["GET"])
+def metrics_exposition(request):
+    """Prometheus scrape endpoint with the totals of all worker processes"""
+    token = settings.OTS_METRICS_TOKEN
+    if token and not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+        return HttpResponse(status=401, headers={'WWW-Authenticate': 'Bearer'})
+    return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
+
 class UserViewSet(viewsets.ModelViewSet):
     queryset = User.objects.all()
     serializer_class = UserSerializer
     permission_classes = [AllowAny]  # Allow unauthenticated access to login/register
 
-    @action(detail=False, methods=['post'])
-    @throttle_classes([LoginRateThrottle])
+    @action(detail=False, methods=['post'], throttle_classes=[LoginRateThrottle])
     def login(self, request):
         email = request.data.get('email')
         
@@ -59,33 +84,24 @@ class UserViewSet(viewsets.ModelViewSet):
             try:
                 user = User.objects.create_user(
                     email=email,
-                    password=None  # No password needed
+                    password=None,  # No password needed
+                    last_login_at=timezone.now()
                 )
-                user.update_last_login()
             except Exception as e:
                 return Response({
                     'error': 'Failed to create account',
                     'detail': str(e)
                 }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Delete any existing unused OTPs for this user
-        OTP.objects.filter(user=user, is_used=False).delete()
-        
-        # Generate and send OTP
-        otp = ''.join(random.choices(string.digits, k=6))
-        otp_obj = OTP.objects.create(
-            user=user,
-            code=otp,
-            expires_at=timezone.now() + timezone.timedelta(minutes=10)
-        )
+        # Generate and send OTP (replacing any earlier one)
+        otp = get_otp_store().issue(user)
         
         try:
-            send_mail(
+            queue_mail(
                 'Your OTP for Login',
                 f'Your OTP is: {otp}',
                 settings.DEFAULT_FROM_EMAIL,
                 [email],
-                fail_silently=False,
             )
         except Exception as e:
             # If email sending fails, still return the OTP in development
@@ -106,8 +122,7 @@ class UserViewSet(viewsets.ModelViewSet):
             'is_new_user': not user.last_login_at
         })
 
-    @action(detail=False, methods=['post'])
-    @throttle_classes([OTPVerifyRateThrottle])
+    @action(detail=False, methods=['post'], throttle_classes=[OTPVerifyRateThrottle])
     def verify_otp(self, request):
         email = request.data.get('email')
         otp = request.data.get('otp')
@@ -122,43 +137,24 @@ class UserViewSet(viewsets.ModelViewSet):
             user = User.objects.get(email=email)
             current_time = timezone.now()
             
-            # Get the most recent unused OTP
-            otp_obj = OTP.objects.filter(
-                user=user,
-                code=otp,
-                is_used=False
-            ).order_by('-created_at').first()
-            
-            if not otp_obj:
-                return Response({
-                    'error': 'Invalid OTP',
-                    'detail': 'No matching OTP found'
-                }, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Check if OTP is expired
-            if current_time > otp_obj.expires_at:
+            # Check and consume the OTP
+            try:
+                get_otp_store().verify(user, otp, current_time)
+            except ValueError as e:
                 return Response({
-                    'error': 'OTP has expired',
-                    'detail': f'OTP expired at {otp_obj.expires_at}'
+                    'error': 'OTP has expired' if 'expired' in str(e) else 'Invalid OTP',
+                    'detail': str(e)
                 }, status=status.HTTP_400_BAD_REQUEST)
             
-            # Mark OTP as used
-            otp_obj.is_used = True
-            otp_obj.save()
-            
             # Update last login time
             user.update_last_login()
             
             # Create token with 1-minute expiration
-            token = CustomToken.objects.create(
-                user=user,
-                key=''.join(random.choices(string.ascii_letters + string.digits, k=40)),
-                expires_at=current_time + timezone.timedelta(minutes=1)
-            )
+            key, expires_at = create_session_token(user, current_time)
             
             return Response({
-                'token': token.key,
-                'expires_at': token.expires_at
+                'token': key,
+                'expires_at': expires_at
             })
             
         except User.DoesNotExist:
@@ -170,7 +166,7 @@ class UserViewSet(viewsets.ModelViewSet):
     @action(detail=False, methods=['post'])
     def logout(self, request):
         if request.user.is_authenticated:
-            CustomToken.objects.filter(user=request.user).delete()
+            delete_user_tokens(request.user)
             return Response({'message': 'Logged out successfully'})
         return Response({'error': 'Not authenticated'}, status=status.HTTP_401_UNAUTHORIZED)
 
@@ -180,6 +176,7 @@ class SecretViewSet(viewsets.ModelViewSet):
     permission_classes = [IsAuthenticated]
     throttle_classes = [UserRateThrottle]
     authentication_classes = [CustomTokenAuthentication]
+    pagination_class = SecretCursorPagination
     
     def get_permissions(self):
         if self.action in ['retrieve', 'view_protected']:
@@ -199,90 +196,118 @@ class SecretViewSet(viewsets.ModelViewSet):
     def get_queryset(self):
         if self.action in ['retrieve', 'view_protected']:
             return Secret.objects.all()
-        return Secret.objects.filter(user=self.request.user)
+        queryset = Secret.objects.filter(user=self.request.user)
+        if self.action == 'list':
+            # The list serializer never returns the payload, so don't load it
+            queryset = queryset.defer('encrypted_message', 'encryption_key', 'passphrase_hash')
+            status_filter = self.request.query_params.get('status')
+            if status_filter in SECRET_STATUSES:
+                queryset = queryset.with_status(status_filter)
+        return queryset
+
+    def list(self, request, *args, **kwargs):
+        status_filter = request.query_params.get('status')
+        if status_filter and status_filter not in SECRET_STATUSES:
+            return Response({
+                'error': 'Invalid status',
+                'detail': f'Status must be one of: {", ".join(SECRET_STATUSES)}'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return super().list(request, *args, **kwargs)
+
+    @action(detail=False, methods=['get'])
+    def summary(self, request):
+        return Response(SecretCounts.summary(request.user))
+
+    @action(detail=True, methods=['post'])
+    def burn(self, request, pk=None):
+        secret = self.get_object()
+        if not secret.burn():
+            return Response({
+                'error': 'Secret is no longer available',
+                'detail': 'This secret has already been viewed, burned or expired'
+            }, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'message': 'Secret burned'})
+
+    def perform_destroy(self, instance):
+        # A secret nobody has seen yet is burned first, so it's counted and its file goes too
+        instance.burn()
+        instance.delete()
     
     def get_serializer_class(self):
         if self.action in ['retrieve', 'view_protected']:
             return SecretViewSerializer
         return SecretCreateSerializer
     
+    @action(detail=False, methods=['post'], url_path='bulk')
+    def bulk_create(self, request):
+        serializer = self.get_serializer(
+            data=request.data,
+            many=True,
+            allow_empty=False,
+            max_length=settings.OTS_MAX_BULK_SECRETS,
+        )
+        serializer.is_valid(raise_exception=True)
+        serializer.save()
+        return Response(serializer.data, status=status.HTTP_201_CREATED)
+
+    def consume_secret(self, passphrase=None):
+        """Claim the secret in the URL for this request, exactly once"""
+        lookup_url_kwarg = self.lookup_url_kwarg or self.lookup_field
+        try:
+            pk = uuid.UUID(str(self.kwargs[lookup_url_kwarg]))
+        except ValueError:
+            raise Http404
+        try:
+            return Secret.objects.consume(pk, passphrase)
+        except Secret.DoesNotExist:
+            raise Http404
+
+    def consumed_response(self, instance, message):
+        if instance.is_file:
+            return file_response(instance)
+        return Response(consumed_secret_data(instance, message))
+
     @action(detail=True, methods=['post'])
     def view_protected(self, request, pk=None):
-        instance = self.get_object()
-        
-        # Check if secret is expired
-        if instance.is_expired:
-            return Response({
-                'error': 'Secret has expired',
-                'detail': 'This secret is no longer available'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Check if secret is already viewed or destroyed
-        if instance.is_viewed or instance.is_destroyed:
-            return Response({
-                'error': 'Secret is no longer available',
-                'detail': 'This secret has already been viewed or destroyed'
-            }, status=status.HTTP_400_BAD_REQUEST)
-        
         # Get passphrase from request
         passphrase = request.data.get('passphrase')
         
-        # For passphrase-protected secrets, require passphrase
-        if instance.has_passphrase:
-            if not passphrase:
+        try:
+            instance, message = self.consume_secret(passphrase)
+        except ValueError as e:
+            if "expired" in str(e):
+                return Response({
+                    'error': 'Secret has expired',
+                    'detail': 'This secret is no longer available'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            elif "already been viewed or destroyed" in str(e):
+                return Response({
+                    'error': 'Secret is no longer available',
+                    'detail': 'This secret has already been viewed or destroyed'
+                }, status=status.HTTP_400_BAD_REQUEST)
+            elif "Passphrase required" in str(e):
                 return Response({
                     'error': 'Passphrase required',
                     'detail': 'Please provide a passphrase to view this secret'
                 }, status=status.HTTP_400_BAD_REQUEST)
-            
-            # Check passphrase
-            if not instance.check_passphrase(passphrase):
+            elif "Invalid passphrase" in str(e):
                 return Response({
                     'error': 'Invalid passphrase',
                     'detail': 'The provided passphrase is incorrect'
                 }, status=status.HTTP_400_BAD_REQUEST)
-        
-        # Try to decrypt the message
-        try:
-            message = instance.decrypt_message(passphrase)
-        except ValueError as e:
             return Response({
                 'error': 'Failed to decrypt secret',
                 'detail': str(e)
             }, status=status.HTTP_400_BAD_REQUEST)
         
-        # Serialize with passphrase context
-        serializer = self.get_serializer(instance, context={'passphrase': passphrase})
-        response_data = serializer.data
-        
-        # Ensure message is included in response
-        if not response_data.get('message'):
-            response_data['message'] = message
-        
-        return Response(response_data)
+        return self.consumed_response(instance, message)
     
     def retrieve(self, request, *args, **kwargs):
-        instance = self.get_object()
+        passphrase = request.data.get('passphrase')
         
-        # Try to decrypt the message
         try:
-            # For passphrase-protected secrets, require passphrase
-            if instance.has_passphrase:
-                passphrase = request.data.get('passphrase')
-                if not passphrase:
-                    return Response({
-                        'error': 'Passphrase required',
-                        'detail': 'This secret is passphrase protected'
-                    }, status=status.HTTP_400_BAD_REQUEST)
-                message = instance.decrypt_message(passphrase)
-            else:
-                # For non-passphrase secrets, decrypt without passphrase
-                message = instance.decrypt_message()
-            
-            # Set the decrypted message on the instance
-            instance._decrypted_message = message
-            serializer = self.get_serializer(instance)
-            return Response(serializer.data)
+            instance, message = self.consume_secret(passphrase)
+            return self.consumed_response(instance, message)
         except ValueError as e:
             if "already been viewed or destroyed" in str(e):
                 return Response({
@@ -294,6 +319,11 @@ class SecretViewSet(viewsets.ModelViewSet):
                     'error': 'Secret has expired',
                     'detail': str(e)
                 }, status=status.HTTP_400_BAD_REQUEST)
+            elif "Passphrase required" in str(e):
+                return Response({
+                    'error': 'Passphrase required',
+                    'detail': 'This secret is passphrase protected'
+                }, status=status.HTTP_400_BAD_REQUEST)
             else:
                 return Response({
                     'error': 'Failed to decrypt secret',
@@ -11,7 +11,10 @@ https://docs.djangoproject.com/en/5.1/ref/settings/
 """
 
 from pathlib import Path
+import base64
+import hashlib
 from datetime import timedelta
+import django
 import environ
 import os
 
@@ -22,6 +25,7 @@ env = environ.Env(
     DJANGO_SECRET_KEY=(str, 'default-unsafe-key'),
     DJANGO_ALLOWED_HOSTS=(list, ['localhost', '127.0.0.1']),
     DATABASE_URL=(str, 'sqlite:///db.sqlite3'),
+    CACHE_URL=(str, 'locmemcache://'),
     EMAIL_HOST=(str, 'localhost'),
     EMAIL_PORT=(int, 1025),
     EMAIL_USE_TLS=(bool, False),
@@ -30,6 +34,14 @@ env = environ.Env(
     CORS_ALLOWED_ORIGINS=(list, ['http://localhost:5173']),
     OTS_DEFAULT_EXPIRY_MINUTES=(int, 10),
     OTS_MAX_EXPIRY_MINUTES=(int, 10080),
+    OTS_PURGE_GRACE_MINUTES=(int, 1440),
+    OTS_BLOB_STORE=(str, 'app.blobstore.FileSystemBlobStore'),
+    OTS_MAX_FILE_SIZE_MB=(int, 100),
+    OTS_PASSPHRASE_SCRYPT_N=(int, 2 ** 14),
+    OTS_PASSPHRASE_SCRYPT_R=(int, 8),
+    OTS_PASSPHRASE_SCRYPT_P=(int, 1),
+    OTS_KDF_QUEUE_LIMIT=(int, 32),
+    OTS_MAX_BULK_SECRETS=(int, 500),
 )
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -65,6 +77,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'app.middleware.MetricsMiddleware',
+    'app.db_router.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'corsheaders.middleware.CorsMiddleware',
@@ -103,6 +117,34 @@ DATABASES = {
     'default': env.db(),
 }
 
+# SQLite set up for several worker processes writing at once: WAL and
+# other pragmas on every connection (app/sqlite.py), write transactions
+# that take the lock up front (needs Django 5.1+) and retries on lock
+# contention. `manage.py bench_sqlite` compares it with stock SQLite.
+OTS_SQLITE_TUNING = env.bool('OTS_SQLITE_TUNING', default=True)
+OTS_SQLITE_BUSY_TIMEOUT_MS = env.int('OTS_SQLITE_BUSY_TIMEOUT_MS', default=5000)
+OTS_SQLITE_LOCK_RETRIES = env.int('OTS_SQLITE_LOCK_RETRIES', default=5)
+if (OTS_SQLITE_TUNING and DATABASES['default']['ENGINE'] == 'django.db.backends.sqlite3'
+        and django.VERSION >= (5, 1)):
+    DATABASES['default'].setdefault('OPTIONS', {})['transaction_mode'] = 'IMMEDIATE'
+
+# Read replicas: comma-separated database URLs, added as replica1, replica2...
+# Reads go to them (app/db_router.py) unless the request has written or is
+# a POST/PUT/PATCH/DELETE; a client that wrote reads from the primary for
+# OTS_REPLICA_STICKY_SECONDS (tracked in the cache, so share it).
+OTS_DB_REPLICAS = []
+for number, url in enumerate(env.list('OTS_DB_REPLICA_URLS', default=[]), 1):
+    DATABASES[f'replica{number}'] = {**env.db_url_config(url), 'TEST': {'MIRROR': 'default'}}
+    OTS_DB_REPLICAS.append(f'replica{number}')
+OTS_REPLICA_STICKY_SECONDS = env.int('OTS_REPLICA_STICKY_SECONDS', default=5)
+DATABASE_ROUTERS = ['app.db_router.ReplicaRouter']
+
+# Cache for tokens and login OTPs. The default is per process; with several
+# workers use a shared one, e.g. redis://localhost:6379/0 or dbcache://ots_cache
+CACHES = {
+    'default': env.cache(),
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -151,8 +193,67 @@ AUTH_USER_MODEL = 'app.User'
 # Additional settings for one-time secrets
 OTS_DEFAULT_EXPIRY = timedelta(minutes=env('OTS_DEFAULT_EXPIRY_MINUTES'))
 OTS_MAX_EXPIRY = timedelta(minutes=env('OTS_MAX_EXPIRY_MINUTES'))
+# Largest batch accepted by POST /api/secrets/bulk/
+OTS_MAX_BULK_SECRETS = env('OTS_MAX_BULK_SECRETS')
+# Fernet master keys that wrap every secret's data key. The first one wraps
+# new keys; keep old ones listed until `manage.py rotate_keys` has run.
+# Without explicit keys one is derived from SECRET_KEY (fine for development).
+OTS_MASTER_KEYS = env.list('OTS_MASTER_KEYS', default=[
+    base64.urlsafe_b64encode(hashlib.sha256(SECRET_KEY.encode()).digest()).decode(),
+])
+
+# Issue HMAC-signed session tokens that are verified without a Token table
+# lookup. The first signing key signs; keep old ones listed for a minute
+# (the token lifetime) after rotating.
+OTS_SIGNED_TOKENS = env.bool('OTS_SIGNED_TOKENS', default=False)
+OTS_TOKEN_SIGNING_KEYS = env.list('OTS_TOKEN_SIGNING_KEYS', default=[
+    hashlib.sha256(b'ots-session-token' + SECRET_KEY.encode()).hexdigest(),
+])
+
+# scrypt cost for secret passphrases. Hashing runs on OTS_KDF_WORKERS threads;
+# once OTS_KDF_QUEUE_LIMIT more calls are waiting, requests get a 503.
+OTS_PASSPHRASE_SCRYPT_N = env('OTS_PASSPHRASE_SCRYPT_N')
+OTS_PASSPHRASE_SCRYPT_R = env('OTS_PASSPHRASE_SCRYPT_R')
+OTS_PASSPHRASE_SCRYPT_P = env('OTS_PASSPHRASE_SCRYPT_P')
+OTS_KDF_WORKERS = env.int('OTS_KDF_WORKERS', default=os.cpu_count() or 1)
+OTS_KDF_QUEUE_LIMIT = env('OTS_KDF_QUEUE_LIMIT')
+
+# SQLite file where every worker adds up its /api/metrics counters (empty:
+# per-process metrics only). With OTS_METRICS_TOKEN set, scrapes must send
+# it as a bearer token.
+OTS_METRICS_DB = env('OTS_METRICS_DB', default=str(BASE_DIR / 'metrics.sqlite3'))
+OTS_METRICS_TOKEN = env('OTS_METRICS_TOKEN', default='')
+
+# Where login OTPs are kept: app.otp_store.CacheOTPStore (hashed, in the
+# cache) or app.otp_store.ModelOTPStore (OTP rows in the database). The
+# cache is only the default when it is shared: with a per-process cache
+# the code would be checked on another worker than the one that stored it.
+PER_PROCESS_CACHES = (
+    'django.core.cache.backends.locmem.LocMemCache',
+    'django.core.cache.backends.dummy.DummyCache',
+)
+OTS_OTP_STORE = env('OTS_OTP_STORE', default=(
+    'app.otp_store.ModelOTPStore' if CACHES['default']['BACKEND'] in PER_PROCESS_CACHES
+    else 'app.otp_store.CacheOTPStore'
+))
+
+# Cache authenticated session tokens (and the users of signed tokens, with
+# their revocation time) for up to five minutes. Logging out only clears
+# the cache it can reach, so this is only on by default with a shared cache.
+OTS_AUTH_CACHE = env.bool('OTS_AUTH_CACHE', default=CACHES['default']['BACKEND'] not in PER_PROCESS_CACHES)
+
+# Where encrypted file attachments are stored
+OTS_BLOB_STORE = env('OTS_BLOB_STORE')
+OTS_BLOB_ROOT = env('OTS_BLOB_ROOT', default=str(BASE_DIR / 'blobs'))
+OTS_MAX_FILE_SIZE = env('OTS_MAX_FILE_SIZE_MB') * 1024 * 1024
+# How long consumed/expired secrets are kept before purge_secrets removes them
+OTS_PURGE_GRACE = timedelta(minutes=env('OTS_PURGE_GRACE_MINUTES'))
 
 # REST Framework settings
+# Render and parse API JSON with orjson (in requirements.txt); the output is
+# byte-for-byte the same as DRF's stdlib renderer
+OTS_FAST_JSON = env.bool('OTS_FAST_JSON', default=False)
+
 REST_FRAMEWORK = {
     'DEFAULT_AUTHENTICATION_CLASSES': [
         'app.authentication.CustomTokenAuthentication',
@@ -160,10 +261,31 @@ REST_FRAMEWORK = {
     'DEFAULT_PERMISSION_CLASSES': [
         'rest_framework.permissions.AllowAny',  # Make authentication optional by default
     ],
+    'DEFAULT_RENDERER_CLASSES': [
+        'app.renderers.ORJSONRenderer' if OTS_FAST_JSON else 'rest_framework.renderers.JSONRenderer',
+        'rest_framework.renderers.BrowsableAPIRenderer',
+    ],
+    'DEFAULT_PARSER_CLASSES': [
+        'app.renderers.ORJSONParser' if OTS_FAST_JSON else 'rest_framework.parsers.JSONParser',
+        'rest_framework.parsers.FormParser',
+        'rest_framework.parsers.MultiPartParser',
+    ],
     'DEFAULT_PAGINATION_CLASS': 'rest_framework.pagination.PageNumberPagination',
     'PAGE_SIZE': 10,
+    # Per-IP limits for the open endpoints; an empty value disables a limit
+    'DEFAULT_THROTTLE_RATES': {
+        'user': None,
+        'anon': None,
+        'login': env('OTS_LOGIN_RATE', default='5/minute') or None,
+        'otp_verify': env('OTS_OTP_VERIFY_RATE', default='5/minute') or None,
+        'secret_view': env('OTS_SECRET_VIEW_RATE', default='5/minute') or None,
+    },
 }
 
+# SQLite file holding rate-limit counters shared by all worker processes on
+# this host. Set OTS_THROTTLE_DB to an empty value to use Django's cache instead.
+OTS_THROTTLE_DB = env('OTS_THROTTLE_DB', default=str(BASE_DIR / 'throttle.sqlite3'))
+
 # Email settings
 EMAIL_BACKEND = 'django.core.mail.backends.smtp.EmailBackend' if not DEBUG else 'django.core.mail.backends.console.EmailBackend'
 EMAIL_HOST = env('EMAIL_HOST')
@@ -172,6 +294,9 @@ EMAIL_USE_TLS = env('EMAIL_USE_TLS')
 EMAIL_HOST_USER = env('EMAIL_HOST_USER')
 EMAIL_HOST_PASSWORD = env('EMAIL_HOST_PASSWORD')
 DEFAULT_FROM_EMAIL = EMAIL_HOST_USER
+# Queue outgoing mail for the deliver_outbox worker instead of sending it
+# inside the request. Off by default in DEBUG so console mail shows up directly.
+OTS_EMAIL_OUTBOX = env.bool('OTS_EMAIL_OUTBOX', default=not DEBUG)
 
 # CORS settings
 CORS_ALLOWED_ORIGINS = env('CORS_ALLOWED_ORIGINS')